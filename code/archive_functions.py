@@ -0,0 +1,515 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################## ARCHIVE FUNCTIONS ##############################
+###############################################################################
+
+#%% Notes
+
+# 1. The raw archive keeps every payload received from the stream so tweets
+#    can be reprocessed later. Payloads are appended as NDJSON to numbered
+#    segment files made of independently compressed gzip or zstd frames, so
+#    a segment can also be read from start to finish with gzip/zstd tools.
+
+# 2. Each segment has a sidecar index of fixed-width entries
+#        (tweet_id, timestamp_ms, frame offset, frame length, line offset)
+#    sorted by tweet_id (.idx), and the same entries sorted by timestamp_ms
+#    (.tidx). The indexes are memory-mapped and binary searched, so fetching
+#    a tweet or a time range only decompresses the frames holding them.
+
+# 3. While a segment is open its entries are appended unsorted to a .tmp
+#    index after each frame is written. The indexes are sorted when the
+#    segment is closed, or when the archive is next opened after a crash.
+
+# 4. Frames are handed to a writer thread once full or frameAge seconds old,
+#    so compressing and fsyncing them never blocks the stream reader. The
+#    segment and index are fsynced after every frame, so a crash loses at
+#    most the frames not yet written. A segment is only created once its
+#    first frame is written.
+
+# 5. zstandard is optional and only needed for zstd segments.
+
+
+#%% Required Libraries
+
+#os: Used to manage the segment files
+import os
+
+#re: Used to find the tweet ID and timestamp of a raw payload
+import re
+
+#struct: Used to pack the index entries
+import struct
+
+#mmap: Used to read the index files without loading them
+import mmap
+
+#zlib: Used to compress gzip frames
+import zlib
+
+#threading: Used to make the archive thread safe
+import threading
+
+#queue: Used to hand frames to the writer thread
+import queue
+
+#time: Used to flush frames by age
+import time
+
+#logging: Used to create logs
+import logging
+
+#zstandard: Used to compress zstd frames
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+#%% Configure logger
+
+logger = logging.getLogger(__name__)
+
+
+#%% Index Format
+
+#Index entry: tweet_id, timestamp_ms, frame offset, frame length, line offset
+INDEX_ENTRY = struct.Struct('<QQQII')
+
+#File extension of the segments of each compression
+EXTENSIONS = {'gzip' : '.ndjson.gz', 'zstd' : '.ndjson.zst'}
+
+#Frames waiting for the writer thread before Put waits for it to catch up
+MAX_PENDING_FRAMES = 64
+
+#Patterns finding the tweet ID (the first "id" of a tweet) and timestamp
+_ID = re.compile(rb'"id":\s*(\d+)')
+_TIMESTAMP = re.compile(rb'"timestamp_ms":\s*"?(\d+)')
+
+
+#Define a function to find the tweet ID and timestamp of a raw payload
+def PayloadKeys(data):
+    '''
+    This function returns the (tweet_id, timestamp_ms) of a raw stream payload
+    without parsing it, using 0 for either if it is missing.
+    '''
+    
+    tweetID = _ID.search(data)
+    
+    #timestamp_ms is the last field of a tweet so search the end first
+    timestamp = _TIMESTAMP.search(data, max(len(data) - 64, 0)) or _TIMESTAMP.search(data)
+    
+    #Return the keys
+    return(int(tweetID.group(1)) if tweetID else 0, int(timestamp.group(1)) if timestamp else 0)
+
+
+#Define a function to list the segments of an archive
+def _Segments(directory):
+    
+    segments = {}
+    
+    for fileName in os.listdir(directory):
+        for compression, extension in EXTENSIONS.items():
+            if fileName.startswith('raw-') and fileName.endswith(extension):
+                segments[int(fileName[4:-len(extension)])] = compression
+    
+    #Return {segment number : compression}
+    return(segments)
+
+
+#Define a function to write index entries to a file atomically
+def _WriteIndex(entries, indexPath):
+    
+    #Write atomically so readers only see complete indexes
+    with open(indexPath + '.sorting', 'wb') as outfile:
+        outfile.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+        
+    os.replace(indexPath + '.sorting', indexPath)
+    
+    
+#Define a function to sort the unsorted index of a segment
+def _SortIndex(temporaryPath, indexPath):
+    
+    with open(temporaryPath, 'rb') as infile:
+        data = infile.read()
+        
+    #Drop any partly written entry
+    data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+    entries = list(INDEX_ENTRY.iter_unpack(data))
+    
+    #Write the timestamp index first, so a segment with an .idx has both
+    _WriteIndex(sorted(entries, key = lambda entry: entry[1]), indexPath[:-4] + '.tidx')
+    _WriteIndex(sorted(entries), indexPath)
+    
+    os.remove(temporaryPath)
+
+
+#Define a function to find the first index entry whose field is at least value
+def _Search(index, count, field, value):
+    
+    low, high = 0, count
+    
+    while low < high:
+        middle = (low + high) // 2
+        
+        if INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)[field] < value:
+            low = middle + 1
+        else:
+            high = middle
+            
+    #Return the position of the entry
+    return(low)
+    
+    
+#%% Archive Writer
+
+#Define a class for archiving raw stream payloads
+class RawArchive():
+    '''
+    This class appends every raw stream payload to a compressed archive and
+    passes it on to a pipeline (StreamPipeline or StreamSpool), so it can be
+    used in place of the pipeline it wraps.
+    
+    Arguments:
+        directory    : directory holding the segments and indexes
+        pipeline     : optional pipeline that payloads are passed on to
+        compression  : 'gzip' or 'zstd'
+        segmentBytes : compressed size at which a new segment is started
+        frameBytes   : uncompressed size at which a frame is compressed
+        frameAge     : seconds before a partly full frame is compressed
+        level        : compression level
+    '''
+    
+    def __init__(self, directory, pipeline = None, compression = 'gzip', segmentBytes = 256 * 1024 * 1024,
+                 frameBytes = 1024 * 1024, frameAge = 5.0, level = None):
+        if compression not in EXTENSIONS:
+            #Add error to log and raise
+            logger.error('Incorrect Archive Compression Entered')
+            raise AttributeError('Expected "gzip" or "zstd" but got %s' % compression)
+        
+        if compression == 'zstd' and zstandard is None:
+            #Add error to log and raise
+            logger.error('zstandard Is Required for zstd Archives')
+            raise ImportError('zstandard is required for zstd archives')
+        
+        self.directory = directory
+        self.pipeline = pipeline
+        self.compression = compression
+        self.segmentBytes = segmentBytes
+        self.frameBytes = frameBytes
+        self.frameAge = frameAge
+        self.level = level
+        
+        os.makedirs(directory, exist_ok = True)
+        
+        #Sort the indexes of segments left open by a crash
+        for fileName in os.listdir(directory):
+            if fileName.endswith('.idx.tmp'):
+                logger.info('Recovering Archive Index %s' % fileName)
+                _SortIndex(os.path.join(directory, fileName), os.path.join(directory, fileName[:-4]))
+        
+        #Always append to a new segment after any existing ones, which is
+        #only created once its first frame is written
+        self.segment = max(_Segments(directory), default = 0)
+        self.segmentFile = None
+        
+        #Lines and keys of the frame being filled
+        self.frame = []
+        self.frameKeys = []
+        self.frameSize = 0
+        self.frameStarted = None
+        
+        #Lock protecting the frame being filled and lock protecting the statistics
+        self.lock = threading.Lock()
+        self.statsLock = threading.Lock()
+        
+        #Archive statistics
+        self.stats = {'payloads' : 0, 'frames' : 0, 'segments' : 0, 'rawBytes' : 0, 'compressedBytes' : 0}
+        
+        #Start a writer thread that compresses and writes full or aged frames
+        self.frames = queue.Queue()
+        self.writer = threading.Thread(target = self._Write, daemon = True)
+        self.writer.start()
+    
+    def Put(self, data):
+        '''
+        Archive a raw payload and pass it on to the pipeline.
+        '''
+        raw = data.encode('utf-8') if isinstance(data, str) else data
+        raw = raw.strip()
+        
+        with self.lock:
+            if not self.frame:
+                self.frameStarted = time.monotonic()
+            
+            #Remember where the line starts in the frame
+            self.frameKeys.append(PayloadKeys(raw) + (self.frameSize,))
+            self.frame.append(raw)
+            self.frameSize += len(raw) + 1
+            
+            if self.frameSize >= self.frameBytes or time.monotonic() - self.frameStarted >= self.frameAge:
+                self._QueueFrame()
+                
+        with self.statsLock:
+            self.stats['payloads'] += 1
+            
+        #Wait for the writer thread if it has fallen far behind
+        if self.frames.qsize() > MAX_PENDING_FRAMES:
+            self.frames.join()
+            
+        if self.pipeline is not None:
+            self.pipeline.Put(data)
+    
+    def Stats(self):
+        '''
+        Return a snapshot of the archive statistics, and those of the pipeline.
+        '''
+        with self.statsLock:
+            stats = dict(self.stats)
+        
+        if self.pipeline is not None:
+            stats['pipeline'] = self.pipeline.Stats()
+        
+        #Return the statistics
+        return(stats)
+    
+    def Close(self):
+        '''
+        Write the last frame, sort the index of the open segment and close the
+        pipeline.
+        '''
+        with self.lock:
+            self._QueueFrame()
+            
+        #Stop the writer thread once it has written every frame
+        self.frames.put(None)
+        self.writer.join()
+        
+        if self.segmentFile is not None:
+            self._CloseSegment()
+            
+        #Add info to log
+        logger.info('Raw Archive Statistics: %s' % self.Stats())
+        
+        if self.pipeline is not None:
+            self.pipeline.Close()
+    
+    def _QueueFrame(self):
+        #Hand the frame being filled to the writer thread, called holding the lock
+        if self.frame:
+            self.frames.put((self.frame, self.frameKeys))
+            self.frame, self.frameKeys, self.frameSize = [], [], 0
+            
+    def _Write(self):
+        #Write queued frames, and queue frames that have waited longer than frameAge
+        while True:
+            try:
+                item = self.frames.get(timeout = self.frameAge / 2)
+                
+            except queue.Empty:
+                with self.lock:
+                    if self.frame and time.monotonic() - self.frameStarted >= self.frameAge:
+                        self._QueueFrame()
+                continue
+                
+            try:
+                if item is None:
+                    return
+                    
+                self._WriteFrame(*item)
+                
+            except Exception:
+                logger.error('Error Writing Archive Frame', exc_info = True)
+                
+            finally:
+                self.frames.task_done()
+    
+    def _Compress(self, data):
+        if self.compression == 'zstd':
+            return(zstandard.ZstdCompressor(level = self.level or 3).compress(data))
+        
+        #A complete gzip member so the segment is a valid multi-member gzip file
+        compressor = zlib.compressobj(self.level or 6, zlib.DEFLATED, 31)
+        return(compressor.compress(data) + compressor.flush())
+    
+    def _WriteFrame(self, frame, frameKeys):
+        raw = b'\n'.join(frame) + b'\n'
+        compressed = self._Compress(raw)
+        
+        if self.segmentFile is None:
+            self._OpenSegment()
+        
+        #Append the frame then its index entries
+        frameOffset = self.segmentFile.tell()
+        self.segmentFile.write(compressed)
+        self.segmentFile.flush()
+        os.fsync(self.segmentFile.fileno())
+        
+        self.indexFile.write(b''.join(INDEX_ENTRY.pack(tweetID, timestamp, frameOffset, len(compressed), lineOffset)
+                                      for tweetID, timestamp, lineOffset in frameKeys))
+        self.indexFile.flush()
+        os.fsync(self.indexFile.fileno())
+        
+        with self.statsLock:
+            self.stats['frames'] += 1
+            self.stats['rawBytes'] += len(raw)
+            self.stats['compressedBytes'] += len(compressed)
+            
+        #Close the segment once it is full, the next frame starts a new one
+        if self.segmentFile.tell() >= self.segmentBytes:
+            self._CloseSegment()
+    
+    def _OpenSegment(self):
+        self.segment += 1
+        
+        basePath = os.path.join(self.directory, 'raw-%012d' % self.segment)
+        
+        self.segmentFile = open(basePath + EXTENSIONS[self.compression], 'ab')
+        self.indexFile = open(basePath + '.idx.tmp', 'ab')
+    
+    def _CloseSegment(self):
+        self.segmentFile.close()
+        self.indexFile.close()
+        self.segmentFile = None
+        
+        #Sort the index now the segment is complete
+        basePath = os.path.join(self.directory, 'raw-%012d' % self.segment)
+        _SortIndex(basePath + '.idx.tmp', basePath + '.idx')
+        
+        with self.statsLock:
+            self.stats['segments'] += 1
+
+
+#%% Archive Reader
+
+#Define a class for fetching tweets from a raw archive
+class RawArchiveReader():
+    '''
+    This class looks up raw payloads in the closed segments of a RawArchive
+    by tweet ID or timestamp.
+    
+    Arguments:
+        directory : directory holding the segments and indexes
+    '''
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.indexes = []
+        
+        #Last frame decompressed, reused by consecutive reads
+        self.lastFrame = (None, None, None)
+        
+        for segment, compression in sorted(_Segments(directory).items()):
+            basePath = os.path.join(directory, 'raw-%012d' % segment)
+            
+            #Skip segments that are still open
+            if not os.path.exists(basePath + '.idx') or os.path.getsize(basePath + '.idx') == 0:
+                continue
+            
+            with open(basePath + '.idx', 'rb') as infile:
+                index = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+            
+            count = len(index) // INDEX_ENTRY.size
+            
+            if os.path.exists(basePath + '.tidx'):
+                with open(basePath + '.tidx', 'rb') as infile:
+                    timeIndex = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+            else:
+                #Sort the entries by timestamp for segments without a .tidx
+                timeIndex = b''.join(INDEX_ENTRY.pack(*entry) for entry in
+                                     sorted(INDEX_ENTRY.iter_unpack(index[:count * INDEX_ENTRY.size]),
+                                            key = lambda entry: entry[1]))
+                                            
+            #Remember the range of tweet IDs and timestamps to skip segments quickly
+            first = INDEX_ENTRY.unpack_from(index, 0)[0]
+            last = INDEX_ENTRY.unpack_from(index, (count - 1) * INDEX_ENTRY.size)[0]
+            earliest = INDEX_ENTRY.unpack_from(timeIndex, 0)[1]
+            latest = INDEX_ENTRY.unpack_from(timeIndex, (count - 1) * INDEX_ENTRY.size)[1]
+            
+            self.indexes.append((first, last, earliest, latest, count, index, timeIndex,
+                                 basePath + EXTENSIONS[compression], compression))
+                                 
+    def Get(self, tweetID):
+        '''
+        Return the raw payload of a tweet, or None if it is not archived.
+        '''
+        for first, last, _, _, count, index, _, segmentPath, compression in self.indexes:
+            if not first <= tweetID <= last:
+                continue
+                
+            #Binary search the entries sorted by tweet ID
+            low = _Search(index, count, 0, tweetID)
+            
+            if low < count:
+                entry = INDEX_ENTRY.unpack_from(index, low * INDEX_ENTRY.size)
+                
+                if entry[0] == tweetID:
+                    return(self._ReadLine(segmentPath, compression, entry))
+        
+        #Return None if not found
+        return(None)
+    
+    def Between(self, startMs, endMs):
+        '''
+        Yield the raw payloads with a timestamp_ms from startMs up to endMs,
+        in timestamp order within each segment.
+        '''
+        for _, _, earliest, latest, count, _, timeIndex, segmentPath, compression in self.indexes:
+            if latest < startMs or earliest >= endMs:
+                continue
+                
+            #Binary search the first entry at or after startMs by timestamp
+            for position in range(_Search(timeIndex, count, 1, startMs), count):
+                entry = INDEX_ENTRY.unpack_from(timeIndex, position * INDEX_ENTRY.size)
+                
+                if entry[1] >= endMs:
+                    break
+                    
+                yield(self._ReadLine(segmentPath, compression, entry))
+                
+    def Close(self):
+        '''
+        Unmap the indexes.
+        '''
+        for index in self.indexes:
+            index[5].close()
+            
+            if isinstance(index[6], mmap.mmap):
+                index[6].close()
+                
+        self.indexes = []
+    
+    def _ReadLine(self, segmentPath, compression, entry):
+        _, _, frameOffset, frameLength, lineOffset = entry
+        
+        if self.lastFrame[:2] == (segmentPath, frameOffset):
+            frame = self.lastFrame[2]
+        
+        else:
+            #Read and decompress only the frame holding the tweet
+            with open(segmentPath, 'rb') as infile:
+                infile.seek(frameOffset)
+                compressed = infile.read(frameLength)
+            
+            if compression == 'zstd':
+                frame = zstandard.ZstdDecompressor().decompress(compressed)
+            else:
+                frame = zlib.decompress(compressed, 31)
+            
+            self.lastFrame = (segmentPath, frameOffset, frame)
+        
+        #Return the line as a string
+        return(frame[lineOffset:frame.index(b'\n', lineOffset)].decode('utf-8'))
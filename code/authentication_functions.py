@@ -19,6 +19,10 @@
 
 # 1. Note that the logger will be defined in the main script.
 
+# 2. Each Read...Credentials function accepts either the filepath of the
+#    credentials file or the config returned by LoadConfig, so the file is
+#    only read and parsed once per run.
+
 
 #%% Requried Libraries
 
@@ -34,16 +38,50 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+#%% Config
+
+#Configs already read, keyed by filepath
+_CONFIGS = {}
+
+#Define a function to read the credentials file once
+def LoadConfig(credJSON = 'credentials.json'):
+    '''
+    This function returns the parsed credentials file as a dictionary,
+    reusing the result of an earlier call for the same filepath. A config
+    that has already been loaded is returned unchanged.
+    '''
+    
+    #Return configs that are already loaded
+    if isinstance(credJSON, dict):
+        return(credJSON)
+    
+    if credJSON not in _CONFIGS:
+        try:
+            #Read the credentials file as a dictionary
+            with open(credJSON) as creds:    
+                _CONFIGS[credJSON] = json.load(creds)
+                
+        except Exception as e:
+            #Add error to log and raise
+            logger.error("Could Not Read Credentials File", exc_info = True)
+            raise e
+            
+        #Add success to log
+        logger.info('Successfully Accessed Credentials File')
+        
+    #Return the config
+    return(_CONFIGS[credJSON])
+
+
 #%% Database
 
 #Define a function to read the DB credentials
 def ReadDBCredentials(credJSON = 'credentials.json'):
     
+    #Read the credentials file as a dictionary
+    credentials = LoadConfig(credJSON)
+    
     try:
-        #Read the credentials file as a dictionary
-        with open(credJSON) as creds:    
-            credentials = json.load(creds)
-        
         #Set the authentication details in credentials.json as variables
         dbHost     = credentials['host']
         dbUsername = credentials['dbUsername']
@@ -55,9 +93,6 @@ def ReadDBCredentials(credJSON = 'credentials.json'):
         #Add error to log and raise
         logger.error("Could Not Read Credentials File", exc_info = True)
         raise e
-  
-    #Add success to log
-    logger.info('Successfully Accessed Credentials File')
 
     #Create DB Credentials Object
     credentialsDB = (dbHost, dbUsername, dbPassword, db, dbTable)   
@@ -73,11 +108,10 @@ def ReadDBCredentials(credJSON = 'credentials.json'):
 #Define a function for reading the Twitter API Credentials
 def ReadTwitterCredentials(credJSON = 'credentials.json'):
     
+    #Read the credentials file as a dictionary
+    credentials = LoadConfig(credJSON)
+    
     try:
-        #Read the credentials file as a dictionary
-        with open(credJSON) as creds:    
-            credentials = json.load(creds)
-        
         #Set the authentication details in credentials.json as variables
         twitAppKey    = credentials['twitter_app_key']
         twitAppSecret = credentials['twitter_app_secret']
@@ -88,9 +122,6 @@ def ReadTwitterCredentials(credJSON = 'credentials.json'):
         #Add error to log and raise
         logger.error("Could Not Read Credentials File", exc_info = True)
         raise e
-        
-    #Add success to log
-    logger.info('Successfully Accessed Credentials File')
 
     #Create Twitter Credentials Object
     credentialsTwitter = (twitAppKey, twitAppSecret, twitKey, twitSecret)
@@ -107,11 +138,10 @@ def ReadTwitterCredentials(credJSON = 'credentials.json'):
 #Read credentials file for flickr
 def ReadFlickrCredentials(credJSON = 'credentials.json'):
     
+    #Read the credentials file as a dictionary
+    credentials = LoadConfig(credJSON)
+    
     try:
-        #Read the credentials file as a dictionary
-        with open(credJSON) as creds:    
-            credentials = json.load(creds)
-        
         #Set the authentication details in credentials.json as variables
         flickrKey    = credentials['flickr_key']
         flickrSecret = credentials['flickr_secret']
@@ -120,9 +150,6 @@ def ReadFlickrCredentials(credJSON = 'credentials.json'):
         #Add error to log and raise
         logger.error("Could Not Read Credentials File", exc_info = True)
         raise e
-        
-    #Add success to log
-    logger.info('Successfully Accessed Credentials File')
 
     #Return the credentials
     return(flickrKey, flickrSecret)
\ No newline at end of file
@@ -0,0 +1,945 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################ BENCHMARK FUNCTIONS ##############################
+###############################################################################
+
+#%% Notes
+
+# 1. Run the benchmarks from the command line, for example
+#    >> python benchmark_functions.py --benchmark timestamps
+#    or every benchmark, saving the results as a baseline
+#    >> python benchmark_functions.py --benchmark all --output baseline.json
+#    and later compare a run against it, failing on any regression
+#    >> python benchmark_functions.py --benchmark all --baseline baseline.json
+
+# 2. The tweets benchmarked are generated by GenerateTweets from a seed, so
+#    every run (and every commit) benchmarks the same payloads.
+
+
+#%% Required Libraries
+
+#random: Used to generate reproducible sample data
+import random
+
+#time: Used to time the benchmarks
+import time
+
+#datetime: Used to generate timestamps
+from datetime import datetime, timedelta, timezone
+
+#json: Used to report the results
+import json
+
+#argparse: For specifying arguments on CLI
+import argparse
+
+#re: Used by the reference trend writer
+import re
+
+#os, sys and subprocess: Used to time the start up of new interpreters
+import os
+import sys
+import subprocess
+
+#tempfile and shutil: Used for the databases and files written by benchmarks
+import tempfile
+import shutil
+
+#inspect: Used to pass each benchmark only the options it takes
+import inspect
+
+#platform: Used to describe the environment of the results
+import platform
+
+
+#%% Import Required Functions from Other Modules
+
+import processing_functions as wrangle
+import db_functions as dbf
+import storage_functions as stor
+import pipeline_functions as pipe
+import authentication_functions as axf
+
+
+#%% Helper Functions
+
+#Define a function to time a function over a list of inputs
+def _TimeCalls(function, inputs, repeats = 3):
+    
+    best = None
+    
+    for _ in range(repeats):
+        start = time.perf_counter()
+        
+        for value in inputs:
+            function(value)
+            
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        
+    #Return the best time over the repeats
+    return(best)
+
+
+#%% Timestamps
+
+#Define a function to generate Twitter created_at timestamps
+def GenerateTimestamps(numSamples = 100000, seed = 0):
+    '''
+    This function generates random timestamps in the Twitter created_at
+    format between 2006 and 2030 with a mix of UTC offsets.
+    '''
+    
+    rng = random.Random(seed)
+    
+    #Mostly UTC, as Twitter sends, with some other offsets
+    offsets = [timezone.utc] * 8 + [timezone(timedelta(hours = 5, minutes = 30)),
+                                    timezone(timedelta(hours = -8))]
+    
+    start = datetime(2006, 3, 21)
+    span = int((datetime(2030, 1, 1) - start).total_seconds())
+    
+    timestamps = []
+    
+    for _ in range(numSamples):
+        moment = start + timedelta(seconds = rng.randrange(span))
+        moment = moment.replace(tzinfo = rng.choice(offsets))
+        timestamps.append(moment.strftime(wrangle.TWITTER_TIME_FORMAT))
+        
+    #Return the timestamps
+    return(timestamps)
+
+
+#Define a function to check and benchmark the timestamp parser
+def BenchmarkTimestamps(numSamples = 100000, seed = 0):
+    '''
+    This function checks that ParseTwitterTimestamp agrees with strptime on a
+    generated corpus of timestamps and then times both parsers, along with the
+    memoised user timestamp parser on a corpus with repeated values.
+    '''
+    
+    timestamps = GenerateTimestamps(numSamples, seed)
+    
+    #Check every timestamp parses to the same value and offset
+    for timestamp in timestamps:
+        expected = datetime.strptime(timestamp, wrangle.TWITTER_TIME_FORMAT)
+        parsed = wrangle.ParseTwitterTimestamp(timestamp)
+        
+        if parsed != expected or parsed.utcoffset() != expected.utcoffset():
+            raise AssertionError('%s parsed as %s, expected %s' % (timestamp, parsed, expected))
+    
+    #Users post repeatedly so draw user timestamps from a smaller set
+    rng = random.Random(seed)
+    userTimestamps = [rng.choice(timestamps[:numSamples // 20 or 1]) for _ in timestamps]
+    wrangle.ParseUserTimestamp.cache_clear()
+    
+    strptimeTime = _TimeCalls(lambda x: datetime.strptime(x, wrangle.TWITTER_TIME_FORMAT), timestamps)
+    parserTime = _TimeCalls(wrangle.ParseTwitterTimestamp, timestamps)
+    cachedTime = _TimeCalls(wrangle.ParseUserTimestamp, userTimestamps)
+    
+    results = {'benchmark'       : 'timestamps',
+               'samples'         : numSamples,
+               'verified'        : True,
+               'strptime_per_s'  : numSamples / strptimeTime,
+               'parser_per_s'    : numSamples / parserTime,
+               'cached_per_s'    : numSamples / cachedTime,
+               'speedup'         : strptimeTime / parserTime,
+               'cached_speedup'  : strptimeTime / cachedTime}
+    
+    #Return the results
+    return(results)
+
+
+#%% Synthetic Tweets
+
+#Words used to build the text of the generated tweets
+_WORDS = ('the', 'traffic', 'on', 'bridge', 'is', 'terrible', 'today', 'love', 'this', 'city', 'rain',
+          'again', 'match', 'tonight', 'anyone', 'know', 'what', 'happened', 'near', 'station', 'café',
+          'naïve', 'straße', '東京', 'مرحبا', '😂', '🔥', '⚽', 'great', 'news', 'breaking', 'update')
+
+#Languages, sources and place types in rough proportion to a live stream
+_LANGS = ('en',) * 12 + ('es', 'fr', 'de', 'ja', 'ar', 'pt', 'und')
+_SOURCES = ('<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',) * 5 + \
+           ('<a href="http://twitter.com/download/android" rel="nofollow">Twitter for Android</a>',) * 4 + \
+           ('<a href="https://mobile.twitter.com" rel="nofollow">Twitter Web App</a>',
+            '<a href="https://www.instagram.com" rel="nofollow">Instagram</a>')
+_PLACE_TYPES = ('city',) * 6 + ('admin', 'neighborhood', 'poi', 'country')
+
+#Define a function to generate a user object
+def _GenerateUser(rng, userID):
+    
+    description = ' '.join(rng.choice(_WORDS) for _ in range(rng.randrange(0, 30)))
+    
+    user = {'id' : userID,
+            'id_str' : str(userID),
+            'name' : 'User %s %s' % (userID, rng.choice(_WORDS)),
+            'screen_name' : 'user_%s' % userID,
+            'location' : rng.choice([None, 'London, England', 'Manchester', 'Earth', 'somewhere 🌍']),
+            'url' : rng.choice([None, 'https://example.com/%s' % userID]),
+            'description' : description or None,
+            'translator_type' : rng.choice(['none'] * 9 + ['regular']),
+            'protected' : False,
+            'verified' : rng.random() < 0.02,
+            'followers_count' : int(rng.paretovariate(1.2) * 50),
+            'friends_count' : rng.randrange(5000),
+            'listed_count' : rng.randrange(100),
+            'favourites_count' : rng.randrange(50000),
+            'statuses_count' : rng.randrange(200000),
+            'created_at' : (datetime(2007, 1, 1, tzinfo = timezone.utc)
+                            + timedelta(seconds = rng.randrange(12 * 365 * 86400))).strftime(wrangle.TWITTER_TIME_FORMAT),
+            'utc_offset' : None,
+            'time_zone' : None,
+            'geo_enabled' : rng.random() < 0.4,
+            'lang' : None,
+            'contributors_enabled' : False,
+            'is_translator' : False,
+            'profile_background_color' : '%06X' % rng.randrange(16 ** 6),
+            'profile_background_image_url' : 'http://abs.twimg.com/images/themes/theme1/bg.png',
+            'profile_background_image_url_https' : 'https://abs.twimg.com/images/themes/theme1/bg.png',
+            'profile_background_tile' : False,
+            'profile_link_color' : '%06X' % rng.randrange(16 ** 6),
+            'profile_sidebar_border_color' : 'C0DEED',
+            'profile_sidebar_fill_color' : 'DDEEF6',
+            'profile_text_color' : '333333',
+            'profile_use_background_image' : True,
+            'profile_image_url' : 'http://pbs.twimg.com/profile_images/%s/photo_normal.jpg' % userID,
+            'profile_image_url_https' : 'https://pbs.twimg.com/profile_images/%s/photo_normal.jpg' % userID,
+            'default_profile' : rng.random() < 0.5,
+            'default_profile_image' : False,
+            'following' : None,
+            'follow_request_sent' : None,
+            'notifications' : None}
+    
+    if rng.random() < 0.6:
+        user['profile_banner_url'] = 'https://pbs.twimg.com/profile_banners/%s/1500000000' % userID
+    
+    #Return the user
+    return(user)
+
+
+#Define a function to generate a place object
+def _GeneratePlace(rng, placeIndex):
+    
+    #Bounding box somewhere in Great Britain
+    west, south = rng.uniform(-5.5, 1.5), rng.uniform(50.0, 58.0)
+    east, north = west + rng.uniform(0.01, 0.5), south + rng.uniform(0.01, 0.5)
+    
+    place = {'id' : '%016x' % rng.getrandbits(64),
+             'url' : 'https://api.twitter.com/1.1/geo/id/%s.json' % placeIndex,
+             'place_type' : rng.choice(_PLACE_TYPES),
+             'name' : 'Place %s' % placeIndex,
+             'full_name' : 'Place %s, England' % placeIndex,
+             'country_code' : 'GB',
+             'country' : 'United Kingdom',
+             'bounding_box' : {'type' : 'Polygon',
+                               'coordinates' : [[[west, south], [west, north], [east, north], [east, south]]]},
+             'attributes' : {}}
+    
+    #Return the place
+    return(place)
+
+
+#Define a function to generate raw stream payloads
+def GenerateTweets(numTweets = 10000, seed = 0, numUsers = None, numPlaces = 200):
+    '''
+    This function generates numTweets raw payloads of the v1.1 filter stream
+    as JSON strings. The same seed always gives the same payloads. Tweets are
+    posted by a pool of numUsers users (numTweets / 10 by default) from
+    numPlaces places, with a varied number of hashtags, urls, symbols and
+    mentions, media in extended_entities for about a fifth of the tweets,
+    exact geo coordinates for about a tenth and replies for about a quarter.
+    created_at and timestamp_ms increase through the stream.
+    '''
+    
+    rng = random.Random(seed)
+    
+    users = [_GenerateUser(rng, 10 ** 8 + index) for index in range(numUsers or numTweets // 10 + 1)]
+    places = [_GeneratePlace(rng, index) for index in range(numPlaces)]
+    hashtags = ['tag%s' % index for index in range(500)]
+    
+    moment = datetime(2019, 11, 18, 10, 0, tzinfo = timezone.utc)
+    tweetID = 1196000000000000000
+    
+    tweets = []
+    
+    for _ in range(numTweets):
+        #Tweets arrive at around 50 per second
+        moment += timedelta(microseconds = int(rng.expovariate(50) * 10 ** 6))
+        tweetID += rng.randrange(1, 10 ** 6)
+        
+        user = rng.choice(users)
+        place = rng.choice(places)
+        
+        #Build the entities and the text that contains them
+        words = [rng.choice(_WORDS) for _ in range(rng.randrange(3, 25))]
+        entities = {'hashtags' : [], 'urls' : [], 'user_mentions' : [], 'symbols' : []}
+        
+        for tag in rng.sample(hashtags, min(int(rng.expovariate(1.0)), 4)):
+            entities['hashtags'].append({'text' : tag, 'indices' : [0, len(tag) + 1]})
+            words.append('#' + tag)
+        
+        for mentioned in rng.sample(users, min(int(rng.expovariate(1.2)), 3, len(users))):
+            entities['user_mentions'].append({'screen_name' : mentioned['screen_name'], 'name' : mentioned['name'],
+                                              'id' : mentioned['id'], 'id_str' : mentioned['id_str'],
+                                              'indices' : [0, len(mentioned['screen_name']) + 1]})
+            words.insert(0, '@' + mentioned['screen_name'])
+        
+        for index in range(min(int(rng.expovariate(2.0)), 2)):
+            expanded = 'https://example.com/article/%s' % rng.randrange(10 ** 6)
+            entities['urls'].append({'url' : 'https://t.co/%08d' % rng.randrange(10 ** 8),
+                                     'expanded_url' : expanded, 'display_url' : expanded[8:30],
+                                     'indices' : [0, 23]})
+            words.append(entities['urls'][-1]['url'])
+        
+        if rng.random() < 0.02:
+            entities['symbols'].append({'text' : 'FTSE', 'indices' : [0, 5]})
+            words.append('$FTSE')
+        
+        tweet = {'created_at' : moment.strftime(wrangle.TWITTER_TIME_FORMAT),
+                 'id' : tweetID,
+                 'id_str' : str(tweetID),
+                 'text' : ' '.join(words)[:280],
+                 'source' : rng.choice(_SOURCES),
+                 'truncated' : rng.random() < 0.05,
+                 'in_reply_to_status_id' : None,
+                 'in_reply_to_status_id_str' : None,
+                 'in_reply_to_user_id' : None,
+                 'in_reply_to_user_id_str' : None,
+                 'in_reply_to_screen_name' : None,
+                 'user' : user,
+                 'geo' : None,
+                 'coordinates' : None,
+                 'place' : place,
+                 'contributors' : None,
+                 'is_quote_status' : rng.random() < 0.1,
+                 'quote_count' : 0,
+                 'reply_count' : 0,
+                 'retweet_count' : 0,
+                 'favorite_count' : 0,
+                 'entities' : entities,
+                 'favorited' : False,
+                 'retweeted' : False,
+                 'filter_level' : 'low',
+                 'lang' : rng.choice(_LANGS),
+                 'timestamp_ms' : str(int(moment.timestamp() * 1000))}
+        
+        if rng.random() < 0.25:
+            #Reply to another user
+            repliedTo = rng.choice(users)
+            tweet['in_reply_to_status_id'] = tweetID - rng.randrange(1, 10 ** 12)
+            tweet['in_reply_to_status_id_str'] = str(tweet['in_reply_to_status_id'])
+            tweet['in_reply_to_user_id'] = repliedTo['id']
+            tweet['in_reply_to_user_id_str'] = repliedTo['id_str']
+            tweet['in_reply_to_screen_name'] = repliedTo['screen_name']
+        
+        if rng.random() < 0.1:
+            #Exact location within the place
+            box = place['bounding_box']['coordinates'][0]
+            longitude, latitude = rng.uniform(box[0][0], box[2][0]), rng.uniform(box[0][1], box[2][1])
+            tweet['geo'] = {'type' : 'Point', 'coordinates' : [latitude, longitude]}
+            tweet['coordinates'] = {'type' : 'Point', 'coordinates' : [longitude, latitude]}
+        
+        if rng.random() < 0.2:
+            #Photos, or a single video, with the first also in entities
+            mediaType = rng.choice(['photo'] * 4 + ['video', 'animated_gif'])
+            media = []
+            
+            for _ in range(rng.randrange(1, 5) if mediaType == 'photo' else 1):
+                mediaID = tweetID + rng.randrange(10 ** 6)
+                item = {'id' : mediaID,
+                        'id_str' : str(mediaID),
+                        'media_url' : 'http://pbs.twimg.com/media/%s.jpg' % mediaID,
+                        'media_url_https' : 'https://pbs.twimg.com/media/%s.jpg' % mediaID,
+                        'url' : 'https://t.co/%08d' % rng.randrange(10 ** 8),
+                        'display_url' : 'pic.twitter.com/%s' % mediaID,
+                        'expanded_url' : 'https://twitter.com/%s/status/%s/photo/1' % (user['screen_name'], tweetID),
+                        'type' : mediaType,
+                        'indices' : [0, 23],
+                        'sizes' : {'large' : {'w' : 2048, 'h' : 1536, 'resize' : 'fit'},
+                                   'thumb' : {'w' : 150, 'h' : 150, 'resize' : 'crop'}}}
+                
+                if rng.random() < 0.1:
+                    item['source_status_id'] = tweetID - rng.randrange(1, 10 ** 12)
+                
+                media.append(item)
+            
+            tweet['entities']['media'] = media[:1]
+            tweet['extended_entities'] = {'media' : media}
+        
+        tweets.append(json.dumps(tweet, ensure_ascii = False, separators = (',', ':')))
+    
+    #Return the payloads
+    return(tweets)
+
+
+#%% Parsing
+
+#Define a function to benchmark reading and processing tweets
+def BenchmarkParse(numSamples = 20000, seed = 0):
+    '''
+    This function times reading numSamples generated payloads with the JSON
+    backend alone (parse) and with ProcessTwitterData (parse and field
+    extraction, including the timestamps), and reports the throughput of
+    each and of the field extraction on its own.
+    '''
+    
+    tweets = GenerateTweets(numSamples, seed)
+    megabytes = sum(len(tweet.encode('utf-8')) for tweet in tweets) / 10 ** 6
+    
+    parseTime = _TimeCalls(wrangle.LoadJSON, tweets)
+    processTime = _TimeCalls(lambda x: wrangle.ProcessTwitterData(x, 44418), tweets)
+    
+    results = {'benchmark'      : 'parse',
+               'samples'        : numSamples,
+               'json_backend'   : wrangle.JSON_BACKEND,
+               'megabytes'      : megabytes,
+               'parse_per_s'    : numSamples / parseTime,
+               'parse_mb_per_s' : megabytes / parseTime,
+               'process_per_s'  : numSamples / processTime,
+               'extract_per_s'  : numSamples / max(processTime - parseTime, 1e-9)}
+    
+    #Return the results
+    return(results)
+
+
+#%% Writers
+
+#Define the original per tweet stream writer as a reference
+def _ReferenceWriteStreamData(cnx, cursor, addStreamData, dataOutput, dataRelations):
+    
+    #Unpack dataOutput tuple
+    dataTweet, dataUser, dataPlace, dataEntities, dataUserMentions, dataMedia = dataOutput
+    
+    #Unpack sql command tuple
+    addPlaceData, addUserData, addTweetData, addUserMentionData, addEntityData, addMediaData, addTweetEntityRelation, addTweetMentionRelation, addTweetMediaRelation, addTweetLocationRelation = addStreamData
+    
+    #Unpack dataRelations tuple
+    dataTweetMentions, dataTweetEntities, dataTweetMedia, dataTweetLocations = dataRelations
+    
+    #Insert the place, user and tweet, committing after each
+    cursor.execute(addPlaceData, dataPlace)
+    cnx.commit()
+    cursor.execute(addUserData, dataUser)
+    cnx.commit()
+    cursor.execute(addTweetData, dataTweet)
+    cnx.commit()
+    
+    #Insert the meta-data and relationships, committing after each
+    for statement, rows in ((addUserMentionData, dataUserMentions),
+                            (addEntityData, dataEntities),
+                            (addMediaData, dataMedia),
+                            (addTweetMentionRelation, dataTweetMentions),
+                            (addTweetEntityRelation, dataTweetEntities),
+                            (addTweetMediaRelation, dataTweetMedia),
+                            (addTweetLocationRelation, dataTweetLocations)):
+        cursor.executemany(statement, rows)
+        cnx.commit()
+        
+    #Return Null
+    
+    
+#Define a function to benchmark writing tweets with every backend
+def BenchmarkWriters(numSamples = 5000, seed = 0, batchSize = 500, credJSON = None):
+    '''
+    This function processes numSamples generated tweets and times writing
+    them in batches of batchSize with each storage backend: SQLite and
+    Parquet (if pyarrow is installed) in a temporary directory, and MySQL and
+    PostgreSQL when a credentials file for a scratch database is given (a
+    backend that cannot connect is reported as an error). The
+    statements the MySQL writers send are also counted, per tweet with the
+    original writer and in batches with WriteStreamBatch2DB, using a cursor
+    that only counts them.
+    '''
+    
+    batch = wrangle.ProcessTwitterDataBatch(GenerateTweets(numSamples, seed), 44418)
+    batches = [batch[index:index + batchSize] for index in range(0, len(batch), batchSize)]
+    addStreamData = dbf.GenerateSQLInsert('stream')
+    
+    results = {'benchmark' : 'writers', 'samples' : numSamples, 'batch_size' : batchSize}
+    
+    #Count the statements sent to MySQL per tweet and in batches
+    referenceCursor = _CountingCursor()
+    cursor = _CountingCursor()
+    
+    for dataOutput, dataRelations in batch:
+        _ReferenceWriteStreamData(referenceCursor, referenceCursor, addStreamData, dataOutput, dataRelations)
+    
+    for rows in batches:
+        dbf.WriteStreamBatch2DB(cursor, cursor, addStreamData, rows)
+    
+    results['mysql_reference_statements'] = referenceCursor.statements
+    results['mysql_batch_statements'] = cursor.statements
+    
+    directory = tempfile.mkdtemp(prefix = 'benchmark-')
+    
+    try:
+        #Open each backend that can be benchmarked here
+        backends = {'sqlite' : lambda: stor.SQLiteBackend(os.path.join(directory, 'benchmark.db'))}
+        
+        if credJSON is not None:
+            credentialsDB = axf.ReadDBCredentials(credJSON)
+            backends['mysql'] = lambda: stor.MySQLBackend(dbf.DBConnectionPool(credentialsDB, poolSize = 1))
+            backends['postgres'] = lambda: stor.PostgresBackend(credentialsDB)
+        
+        for name, Open in backends.items():
+            try:
+                #Connect before timing anything
+                backend = Open()
+                
+                with backend.Connect():
+                    pass
+                
+            except Exception as e:
+                #The scratch database may only be on one of the servers
+                results['%s_error' % name] = str(e)
+                continue
+            
+            try:
+                start = time.perf_counter()
+                
+                for rows in batches:
+                    backend.WriteStreamBatch(rows)
+                
+                results['%s_per_s' % name] = numSamples / (time.perf_counter() - start)
+            
+            finally:
+                backend.Close()
+        
+        try:
+            import parquet_functions as columnar
+        
+        except ImportError:
+            columnar = None
+        
+        if columnar is not None and columnar.pyarrow is not None:
+            sink = columnar.ParquetSink(os.path.join(directory, 'parquet'), addStreamData)
+            start = time.perf_counter()
+            
+            for dataOutput, dataRelations in batch:
+                sink.Add(dataOutput, dataRelations)
+            
+            sink.Close()
+            results['parquet_per_s'] = numSamples / (time.perf_counter() - start)
+    
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    
+    #Return the results
+    return(results)
+
+
+#%% Pipeline
+
+#Define a function to benchmark the stream pipeline end to end
+def BenchmarkPipeline(numSamples = 20000, seed = 0, workers = 2, batchSize = 500):
+    '''
+    This function feeds numSamples generated payloads through a StreamPipeline
+    with workers threads and a StreamBatchWriter into a temporary SQLite
+    database, as main.py does for a stream, and reports the tweets per second
+    from the first payload to the last write.
+    '''
+    
+    tweets = GenerateTweets(numSamples, seed)
+    directory = tempfile.mkdtemp(prefix = 'benchmark-')
+    
+    try:
+        backend = stor.SQLiteBackend(os.path.join(directory, 'benchmark.db'))
+        writer = dbf.StreamBatchWriter(backend, batchSize)
+        pipeline = pipe.StreamPipeline(44418, writer, workers, numSamples)
+        
+        start = time.perf_counter()
+        
+        for tweet in tweets:
+            pipeline.Put(tweet)
+        
+        pipeline.Close()
+        writer.Close()
+        
+        elapsed = time.perf_counter() - start
+        stats = pipeline.Stats()
+        backend.Close()
+    
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    
+    results = {'benchmark'    : 'pipeline',
+               'samples'      : numSamples,
+               'workers'      : workers,
+               'batch_size'   : batchSize,
+               'errors'       : stats['errors'],
+               'elapsed_s'    : elapsed,
+               'tweets_per_s' : numSamples / elapsed}
+    
+    #Return the results
+    return(results)
+
+
+#%% Trends
+
+#Define a cursor that counts the statements and rows it is sent
+class _CountingCursor():
+    
+    def __init__(self, record = False):
+        self.statements = 0
+        self.values = 0
+        
+        #Every value sent, in order, when recording
+        self.record = record
+        self.params = []
+        
+    def execute(self, statement, params = ()):
+        self.statements += 1
+        self.values += len(params)
+        
+        if self.record:
+            self.params.extend(params)
+            
+    def executemany(self, statement, rows):
+        #MySQL sends the rows of an INSERT as one statement, and none if empty
+        for params in rows:
+            self.values += len(params)
+            
+        if rows:
+            self.statements += 1
+            
+    def Rows(self, width):
+        #Split the recorded values into rows, with datetimes as strings
+        values = [x.isoformat(' ') if isinstance(x, datetime) else x for x in self.params]
+        
+        #Return the rows
+        return([tuple(values[index:index + width]) for index in range(0, len(values), width)])
+        
+    def commit(self):
+        pass
+        
+
+#Define a function to generate the responses of the trends API
+def GenerateTrends(numLocations = 500, numTrends = 50, seed = 0):
+    '''
+    This function generates trend dictionaries in the form returned by
+    GetTrends for a number of locations.
+    '''
+    
+    rng = random.Random(seed)
+    
+    trends = []
+    
+    for woeid in range(numLocations):
+        #Create the trends of the location
+        locationTrends = [{'name' : '#trend%s' % rng.randrange(10 ** 6),
+                           'url' : 'http://twitter.com/search?q=trend',
+                           'promoted_content' : None,
+                           'query' : 'trend',
+                           'tweet_volume' : rng.choice([None, rng.randrange(10 ** 6)])}
+                          for _ in range(numTrends)]
+        
+        trends.append({'trends' : locationTrends,
+                       'as_of' : '2019-11-18T10:21:13Z',
+                       'created_at' : '2019-11-18T10:18:05Z',
+                       'locations' : [{'name' : 'Location %s' % woeid, 'woeid' : woeid}]})
+        
+    #Return the trends
+    return(trends)
+
+
+#Define the original trend writer as a reference
+def _ReferenceWriteTrends(cnx, cursor, addTrendData, trends):
+    
+    for locationTrends in trends:
+        trend_asof = re.sub(r"[a-zA-Z]", " ", locationTrends['as_of']).strip()
+        trend_created = re.sub(r"[a-zA-Z]", " ", locationTrends['created_at']).strip()
+        
+        #Rank the trends by position, list.index() gives duplicates the rank
+        #of the first copy
+        for trend_rank, trend in enumerate(locationTrends['trends'], 1):
+            
+            cursor.execute(addTrendData, (locationTrends['locations'][0]['woeid'],
+                                          locationTrends['locations'][0]['name'],
+                                          trend_asof, trend_created, trend_rank,
+                                          trend['name'], trend['url'], trend['promoted_content'],
+                                          trend['query'], trend['tweet_volume']))
+            
+    cnx.commit()
+    
+
+#Define a function to benchmark writing trends
+def BenchmarkTrends(numSamples = 500, seed = 0):
+    '''
+    This function times WriteTrendData2DB against the original row by row
+    writer on the trends of numSamples locations with 50 trends each, using a
+    cursor that only counts what it is sent so the database is not timed.
+    '''
+    
+    trends = GenerateTrends(numSamples, 50, seed)
+    addTrendData = dbf.GenerateSQLInsert('trends')
+    
+    #Record the statements and rows sent by each writer
+    referenceCursor = _CountingCursor(record = True)
+    cursor = _CountingCursor(record = True)
+    
+    _ReferenceWriteTrends(referenceCursor, referenceCursor, addTrendData, trends)
+    dbf.WriteTrendData2DB(cursor, cursor, addTrendData, trends)
+    
+    #Check every row matches the original writer, value for value
+    width = addTrendData.count('%s')
+    referenceRows = referenceCursor.Rows(width)
+    rows = cursor.Rows(width)
+    
+    if rows != referenceRows:
+        mismatch = next((i for i, (x, y) in enumerate(zip(rows, referenceRows)) if x != y),
+                        min(len(rows), len(referenceRows)))
+        raise AssertionError('Wrote %s rows, expected %s, first difference at row %s: %s != %s'
+                             % (len(rows), len(referenceRows), mismatch,
+                                rows[mismatch:mismatch + 1], referenceRows[mismatch:mismatch + 1]))
+    
+    referenceTime = _TimeCalls(lambda x: _ReferenceWriteTrends(x, x, addTrendData, trends), [_CountingCursor()])
+    writerTime = _TimeCalls(lambda x: dbf.WriteTrendData2DB(x, x, addTrendData, trends), [_CountingCursor()])
+    
+    results = {'benchmark'            : 'trends',
+               'locations'            : numSamples,
+               'rows'                 : numSamples * 50,
+               'verified'             : True,
+               'reference_statements' : referenceCursor.statements,
+               'writer_statements'    : cursor.statements,
+               'reference_s'          : referenceTime,
+               'writer_s'             : writerTime,
+               'speedup'              : referenceTime / writerTime}
+    
+    #Return the results
+    return(results)
+
+
+#%% Start Up
+
+#Define a function to time importing a module in a new interpreter
+def _ImportTime(module):
+    
+    start = time.perf_counter()
+    
+    #Import the module with the import profiler enabled
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                             cwd = os.path.dirname(os.path.abspath(__file__)),
+                             stderr = subprocess.PIPE, universal_newlines = True)
+    
+    elapsed = time.perf_counter() - start
+    
+    if process.returncode != 0:
+        raise RuntimeError('Could not import %s:\n%s' % (module, process.stderr))
+    
+    #Parse the lines of "import time: self [us] | cumulative | package"
+    imports = []
+    
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            selfTime, cumulativeTime, name = line[len('import time:'):].split('|')
+            imports.append((name.strip(), int(selfTime), int(cumulativeTime)))
+            
+    #Return the wall clock time and the imports
+    return(elapsed, imports)
+
+
+#Define a function to benchmark the start up time of the scripts
+def BenchmarkStartup(numSamples = 5, module = 'main'):
+    '''
+    This function imports a module (main.py by default) in numSamples new
+    interpreters with -X importtime and reports the first (cold) and best
+    wall clock times, the cumulative import time of the module and the
+    modules that are slowest to import.
+    '''
+    
+    runs = [_ImportTime(module) for _ in range(numSamples)]
+    
+    #Use the imports of the fastest run
+    elapsed, imports = min(runs, key = lambda x: x[0])
+    
+    #Find the cumulative import time of the module itself
+    cumulative = [x[2] for x in imports if x[0] == module][-1]
+    
+    results = {'benchmark'      : 'startup',
+               'module'         : module,
+               'samples'        : numSamples,
+               'cold_s'         : runs[0][0],
+               'best_s'         : elapsed,
+               'import_s'       : cumulative / 10 ** 6,
+               'slowest_imports': {x[0] : x[1] / 10 ** 6 for x in sorted(imports, key = lambda x: -x[1])[:10]}}
+    
+    #Return the results
+    return(results)
+
+
+#%% Regressions
+
+#Fraction a metric may worsen before it is a regression, start up and the
+#writers depend more on the machine than the parsers do
+TOLERANCES = {'startup' : 0.5, 'writers' : 0.25, 'pipeline' : 0.25}
+
+#Define a function to compare results with a baseline
+def CompareResults(results, baseline, tolerance = None):
+    '''
+    This function compares the results of RunBenchmarks with a baseline run
+    (e.g. of the previous commit) and returns the metrics that regressed by
+    more than the tolerance (TOLERANCES or 0.1 if not given). Throughputs
+    ("_per_s") and speedups regress when they fall and times ("_s") when
+    they rise. Metrics missing from either run are ignored.
+    '''
+    
+    regressions = []
+    
+    for name, current in results['results'].items():
+        previous = baseline['results'].get(name, {})
+        allowed = tolerance if tolerance is not None else TOLERANCES.get(name, 0.1)
+        
+        for metric, value in current.items():
+            reference = previous.get(metric)
+            
+            if not isinstance(value, (int, float)) or not isinstance(reference, (int, float)) or reference <= 0:
+                continue
+            
+            if metric.endswith('_per_s') or metric.endswith('speedup'):
+                #Higher is better
+                change = value / reference - 1
+                regressed = change < -allowed
+            elif metric.endswith('_s'):
+                #Lower is better
+                change = value / reference - 1
+                regressed = change > allowed
+            else:
+                continue
+            
+            if regressed:
+                regressions.append({'benchmark' : name, 'metric' : metric, 'baseline' : reference,
+                                    'current' : value, 'change' : change, 'tolerance' : allowed})
+                
+    #Return the regressions
+    return(regressions)
+
+
+#%% Run the Benchmarks
+
+#Benchmarks available from the command line, in the order they are run
+BENCHMARKS = {'timestamps' : BenchmarkTimestamps,
+              'parse'      : BenchmarkParse,
+              'writers'    : BenchmarkWriters,
+              'pipeline'   : BenchmarkPipeline,
+              'trends'     : BenchmarkTrends,
+              'startup'    : BenchmarkStartup}
+
+#Define a function to describe the environment the benchmarks ran in
+def _Environment():
+    
+    try:
+        #Find the commit being benchmarked
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout = subprocess.PIPE,
+                                stderr = subprocess.DEVNULL, universal_newlines = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+        
+    #Return the environment
+    return({'commit'       : commit,
+            'python'       : platform.python_version(),
+            'platform'     : platform.platform(),
+            'json_backend' : wrangle.JSON_BACKEND,
+            'time'         : datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')})
+
+
+#Define a function to run a set of benchmarks
+def RunBenchmarks(names, **options):
+    '''
+    This function runs the named benchmarks and returns their results with
+    the environment they ran in. Each benchmark is passed only the options
+    (e.g. numSamples, seed or credJSON) it takes.
+    '''
+    
+    results = {}
+    
+    for name in names:
+        function = BENCHMARKS[name]
+        parameters = inspect.signature(function).parameters
+        
+        results[name] = function(**{key : value for key, value in options.items()
+                                    if key in parameters and value is not None})
+        
+    #Return the results
+    return({'environment' : _Environment(), 'results' : results})
+
+
+#If in CL environment
+if __name__ == '__main__':
+    #Create ArgumentParser object
+    parser = argparse.ArgumentParser()
+    
+    #Add arguments
+    parser.add_argument('--benchmark',
+                        type = str,
+                        nargs = '+',
+                        default = ['timestamps'],
+                        choices = list(BENCHMARKS) + ['all'],
+                        help = 'names of the benchmarks to run, or "all"')
+    parser.add_argument('--numSamples',
+                        type = int,
+                        help = 'number of samples to benchmark over (timestamps,\
+                                tweets, locations of 50 trends or interpreters\
+                                started)')
+    parser.add_argument('--seed',
+                        type = int,
+                        default = 0,
+                        help = 'seed of the generated data')
+    parser.add_argument('--credJSON',
+                        type = str,
+                        default = None,
+                        help = 'credentials of a scratch MySQL/PostgreSQL\
+                                database to benchmark the writers against')
+    parser.add_argument('--output',
+                        type = str,
+                        default = None,
+                        help = 'filepath to save the results to, e.g. as a\
+                                baseline')
+    parser.add_argument('--baseline',
+                        type = str,
+                        default = None,
+                        help = 'filepath of earlier results to check for\
+                                regressions against')
+    parser.add_argument('--tolerance',
+                        type = float,
+                        default = None,
+                        help = 'fraction a metric may worsen before it is a\
+                                regression (defaults per benchmark)')
+    
+    #Parse arguments
+    args = parser.parse_args()
+    
+    names = list(BENCHMARKS) if 'all' in args.benchmark else args.benchmark
+    
+    #Run the benchmarks and print the results
+    results = RunBenchmarks(names, numSamples = args.numSamples, seed = args.seed, credJSON = args.credJSON)
+    
+    print(json.dumps(results, indent = 2))
+    
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent = 2)
+    
+    if args.baseline is not None:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        
+        #Report any regressions and fail
+        regressions = CompareResults(results, baseline, args.tolerance)
+        
+        print(json.dumps({'regressions' : regressions}, indent = 2))
+        
+        if regressions:
+            sys.exit(1)
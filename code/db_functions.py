@@ -18,15 +18,28 @@
 
 #%% Requried Libraries
 
-#mySQL Connector: Used to interact with SQL database
-import mysql.connector
-
-#re: for regular expressions on strings
-import re
+#mySQL Connector is only imported when connecting (see Connect2DB) so that
+#runs which never touch the database start faster
 
 #logging: Used to create logs
 import logging
 
+#threading: Used to make the connection pool thread safe
+import threading
+
+#collections: Used for the least recently used upsert cache
+import collections
+
+#datetime: Used to format datetimes for bulk loading
+from datetime import datetime
+
+#os and tempfile: Used to write the bulk loading files
+import os
+import tempfile
+
+#time: Used to track connection idle times
+import time
+
 
 #%% Configure logger
 
@@ -36,14 +49,18 @@ logger = logging.getLogger(__name__)
 #%% Interaction Functions
 
 #Define a function to connect to the database
-def Connect2DB(credentialsDB):
+def Connect2DB(credentialsDB, allowLocalInfile = False):
 
+    #mySQL Connector: Used to interact with SQL database
+    import mysql.connector
+    
     try:
         #Connect to the DB
         cnx = mysql.connector.connect(host   = credentialsDB[0],
                                       user   = credentialsDB[1],
                                       passwd = credentialsDB[2],
-                                      db     = credentialsDB[3])
+                                      db     = credentialsDB[3],
+                                      allow_local_infile = allowLocalInfile)
             
     except Exception as e:
         #Add error to log and raise
@@ -77,7 +94,280 @@ def CloseDBConnection(cnx, cursor):
     #Return Null  
     
 
+#%% Connection Pool
+
+#Define a class that keeps a set of long-lived connections to the database
+class DBConnectionPool():
+    '''
+    This class lends out long-lived connections to the database so that the
+    connection handshake is only paid once per connection rather than once
+    per write.
+    
+    Arguments:
+        credentialsDB : DB credentials object from ReadDBCredentials
+        poolSize      : Maximum number of connections held open at once
+        pingInterval  : Seconds a connection may sit idle before it is
+                        health checked on being borrowed
+        timeout       : Seconds to wait for a free connection (None = forever)
+        allowLocalInfile : Allow LOAD DATA LOCAL INFILE on the connections
+    '''
+    
+    def __init__(self, credentialsDB, poolSize = 4, pingInterval = 30, timeout = None,
+                 allowLocalInfile = False):
+        self.credentialsDB = credentialsDB
+        self.allowLocalInfile = allowLocalInfile
+        self.poolSize = poolSize
+        self.pingInterval = pingInterval
+        self.timeout = timeout
+        
+        #Idle connections stored as [cnx, lastUsed]
+        self.idle = []
+        
+        #Number of connections currently open (idle and borrowed)
+        self.numOpen = 0
+        
+        #Condition used to wait for a connection to be returned
+        self.condition = threading.Condition()
+        
+        #Pool statistics
+        self.stats = {'created'    : 0,
+                      'borrowed'   : 0,
+                      'returned'   : 0,
+                      'reconnects' : 0,
+                      'discarded'  : 0,
+                      'waits'      : 0}
+        
+    def Acquire(self):
+        '''
+        Borrow a connection from the pool, returning a (cnx, cursor) pair.
+        '''
+        with self.condition:
+            #Wait until there is an idle connection or room for a new one
+            if not self.idle and self.numOpen >= self.poolSize:
+                self.stats['waits'] += 1
+                
+                if not self.condition.wait_for(lambda: self.idle or self.numOpen < self.poolSize,
+                                               timeout = self.timeout):
+                    #Add error to log and raise
+                    logger.error('Timed Out Waiting for a Database Connection')
+                    raise TimeoutError('No database connection available after %s seconds' % self.timeout)
+                    
+            if self.idle:
+                #Take the most recently used connection
+                cnx, lastUsed = self.idle.pop()
+            else:
+                #Reserve a slot for a new connection
+                cnx, lastUsed = None, None
+                self.numOpen += 1
+                
+            self.stats['borrowed'] += 1
+        
+        try:
+            if cnx is None:
+                #Open a new connection
+                cnx, cursor = Connect2DB(self.credentialsDB, self.allowLocalInfile)
+                self._Count('created')
+                
+            else:
+                #Health check connections that have been idle for a while
+                if time.monotonic() - lastUsed > self.pingInterval:
+                    cnx = self._CheckConnection(cnx)
+                
+                #Create a cursor object
+                cursor = cnx.cursor()
+        
+        except Exception as e:
+            #Give the slot back to the pool and raise
+            self._Forget()
+            raise e
+        
+        #Return the cnx and cursor
+        return(cnx, cursor)
+    
+    def Release(self, cnx, cursor, broken = False):
+        '''
+        Return a borrowed connection to the pool. Connections that raised an
+        error should be returned with broken = True so that they are replaced.
+        '''
+        try:
+            #Close the cursor
+            _ = cursor.close()
+        except Exception:
+            broken = True
+        
+        if not broken:
+            try:
+                #Discard any uncommitted work left on the connection
+                if cnx.in_transaction:
+                    cnx.rollback()
+            except Exception:
+                broken = True
+        
+        if broken:
+            #Close the connection and free its slot
+            self._Discard(cnx)
+            return
+        
+        with self.condition:
+            self.idle.append([cnx, time.monotonic()])
+            self.stats['returned'] += 1
+            self.condition.notify()
+            
+    def Connection(self):
+        '''
+        Context manager that borrows a connection and returns it to the pool,
+        discarding it if the block raises.
+        '''
+        return(_PooledConnection(self))
+        
+    def Stats(self):
+        '''
+        Return a snapshot of the pool statistics.
+        '''
+        with self.condition:
+            stats = dict(self.stats)
+            stats['open'] = self.numOpen
+            stats['idle'] = len(self.idle)
+            stats['inUse'] = self.numOpen - len(self.idle)
+            
+        #Return the statistics
+        return(stats)
+    
+    def CloseAll(self):
+        '''
+        Close all idle connections held by the pool.
+        '''
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.numOpen -= len(idle)
+            
+        for cnx, _ in idle:
+            try:
+                cnx.close()
+            except Exception:
+                pass
+            
+        #Add info to log
+        logger.info('Closed %s Pooled Database Connections' % len(idle))
+        
+    def _CheckConnection(self, cnx):
+        #Ping the server, reconnecting if the connection has gone stale
+        try:
+            cnx.ping(reconnect = False)
+            return(cnx)
+        except Exception:
+            logger.warning('Pooled Database Connection Failed Health Check - Reconnecting')
+            
+        try:
+            cnx.close()
+        except Exception:
+            pass
+        
+        #Replace with a fresh connection
+        cnx, cursor = Connect2DB(self.credentialsDB, self.allowLocalInfile)
+        _ = cursor.close()
+        self._Count('reconnects')
+        
+        #Return the healthy connection
+        return(cnx)
+    
+    def _Discard(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+        
+        self._Count('discarded')
+        self._Forget()
+        
+    def _Forget(self):
+        with self.condition:
+            self.numOpen -= 1
+            self.condition.notify()
+        
+    def _Count(self, key):
+        with self.condition:
+            self.stats[key] += 1
+            
+            
+#Define a helper class so that pooled connections can be used in a with block
+class _PooledConnection():
+    def __init__(self, pool):
+        self.pool = pool
+        
+    def __enter__(self):
+        self.cnx, self.cursor = self.pool.Acquire()
+        return(self.cnx, self.cursor)
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.pool.Release(self.cnx, self.cursor, broken = excType is not None)
+        
+        #Do not suppress exceptions
+        return(False)
+    
+
 #%% Query Generation Functions
+
+#Table definitions shipped alongside the code
+SQL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'twitterGeoStream.sql')
+
+#Define a function to read the table definitions
+def ReadTableDefinitions(sqlFile = SQL_FILE):
+    '''
+    This function reads the CREATE TABLE statements of twitterGeoStream.sql
+    and returns, for every table, its columns as (name, type, declaration)
+    tuples, e.g. ('trend_name', 'VARCHAR', 'VARCHAR(128)'), its primary key
+    columns, its indexes and any AUTO_INCREMENT column. It is used to create
+    the same tables in other storage formats.
+    '''
+    
+    try:
+        #Read the table definitions
+        with open(sqlFile) as infile:
+            lines = infile.read().splitlines()
+            
+    except Exception as e:
+        #Add error to log and raise
+        logger.error("Error Reading Table Definitions", exc_info = True)
+        raise e
+    
+    definitions = {}
+    table = None
+    
+    for line in lines:
+        line = line.strip().rstrip(',')
+        
+        if line.upper().startswith('CREATE TABLE'):
+            #Start a new table
+            table = {'columns' : [], 'primaryKey' : [], 'indexes' : [], 'autoIncrement' : None}
+            definitions[line.split()[2]] = table
+            
+        elif table is None or not line or line.startswith(('#', '/*')):
+            continue
+            
+        elif line.startswith(')'):
+            #End of the table
+            table = None
+            
+        elif line.upper().startswith('PRIMARY KEY'):
+            table['primaryKey'] = [x.strip() for x in line[line.index('(') + 1:line.index(')')].split(',')]
+            
+        elif line.upper().startswith('INDEX'):
+            table['indexes'].append([x.strip() for x in line[line.index('(') + 1:line.index(')')].split(',')])
+            
+        elif not line.upper().startswith(('FOREIGN KEY', 'REFERENCES')):
+            #Column name followed by its declaration
+            name, declaration = line.split(None, 1)
+            columnType = declaration.split()[0]
+            
+            if 'AUTO_INCREMENT' in declaration.upper():
+                table['autoIncrement'] = name
+                
+            table['columns'].append((name, columnType.split('(')[0].upper(), columnType))
+            
+    #Return the definitions
+    return(definitions)
+
     
 #Define a function to generate the SQL Insert Statements
 def GenerateSQLInsert(request):
@@ -106,7 +396,7 @@ def GenerateSQLInsert(request):
     elif request.lower() == 'stream':
               
         #Define mySQL insert statements for streaming data
-        addPlaceData = ("INSERT IGNORE INTO places "
+        addPlaceData = ("INSERT INTO places "
                         "(place_id, \
                         place_url, \
                         place_type, \
@@ -119,7 +409,7 @@ def GenerateSQLInsert(request):
                         place_attributes) "
                         "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
                         
-        addUserData = ("INSERT IGNORE INTO users "
+        addUserData = ("INSERT INTO users "
                        "(user_id, \
                         user_name, \
                         user_screenname, \
@@ -224,6 +514,15 @@ def GenerateSQLInsert(request):
                                   media_id) "
                                  "VALUES (%s, %s)")
         
+        addTweetLocationRelation = ("INSERT IGNORE INTO tweet_streamlocations "
+                                    "(tweet_id, \
+                                     streamlocation_woeid) "
+                                    "VALUES (%s, %s)")
+        
+        #Update places and users that already exist so they do not go stale
+        addPlaceData = addPlaceData + GenerateUpsertClause(addPlaceData)
+        addUserData = addUserData + GenerateUpsertClause(addUserData)
+        
         #Combine into one tuple
         addStreamData = (addPlaceData,
                          addUserData,
@@ -233,7 +532,8 @@ def GenerateSQLInsert(request):
                          addMediaData,
                          addTweetEntityRelation,
                          addTweetMentionRelation,
-                         addTweetMediaRelation)
+                         addTweetMediaRelation,
+                         addTweetLocationRelation)
         
         #Add logger info
         logger.info('Successfully Generated SQL Insert Statements')
@@ -241,42 +541,282 @@ def GenerateSQLInsert(request):
         #Return output
         return(addStreamData)
         
+    elif request.lower() == 'limits':
+        #Define a mySQL insert statement for stream limit notices
+        addLimitData = ("INSERT INTO stream_limits "
+                        "(limit_woeid, \
+                        limit_window_start, \
+                        limit_window_end, \
+                        limit_notices, \
+                        limit_undelivered) "
+                        "VALUES (%s, %s, %s, %s, %s)")
+        
+        #Add success to log
+        logger.info('Successfully Generated SQL Insert Statement')
+        
+        #Return output
+        return(addLimitData)
+    
+    elif request.lower() == 'trendchanges':
+        #Define a mySQL insert statement for changes between trend snapshots
+        addTrendChange = ("INSERT INTO trend_changes "
+                          "(change_woeid, \
+                          change_woeid_name, \
+                          change_datetime_asof, \
+                          change_datetime_createdat, \
+                          change_type, \
+                          change_rank, \
+                          change_name, \
+                          change_url, \
+                          change_promotedcontent, \
+                          change_query, \
+                          change_tweetvolume) "
+                          "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        
+        #Define mySQL statements to maintain the latest snapshot of each location
+        addTrendState = ("INSERT INTO trend_state "
+                         "(state_woeid, \
+                         state_name, \
+                         state_rank, \
+                         state_url, \
+                         state_promotedcontent, \
+                         state_query, \
+                         state_tweetvolume) "
+                         "VALUES (%s, %s, %s, %s, %s, %s, %s)")
+        addTrendState += GenerateUpsertClause(addTrendState)
+        
+        deleteTrendState = ("DELETE FROM trend_state "
+                            "WHERE state_woeid = %s AND state_name = %s")
+        
+        #Add success to log
+        logger.info('Successfully Generated SQL Insert Statement')
+        
+        #Return output
+        return(addTrendChange, addTrendState, deleteTrendState)
+        
     else:
         #Add error to log and raise
         logger.error("Incorrect Request Entered", exc_info = True)
-        raise AttributeError('Expected "trends" or "stream" but got %s' % request)
+        raise AttributeError('Expected "trends", "stream", "limits" or "trendchanges" but got %s' % request)
   
     
+#Define a function to extract the table and columns of an insert statement
+def StatementColumns(statement):
+    '''
+    This function returns the table name and the list of column names of an
+    INSERT or REPLACE statement.
+    '''
+    
+    #The table name comes just before the first bracket
+    table = statement[:statement.index('(')].split()[-1]
+    
+    #Extract the column names between the first pair of brackets
+    columns = statement[statement.index('(') + 1:statement.index(')')]
+    columns = [column.strip(' \\\n') for column in columns.split(',')]
+    
+    #Return the table and columns
+    return(table, columns)
+    
+    
+#Define a function to generate the update clause of an upsert statement
+def GenerateUpsertClause(statement):
+    '''
+    This function returns an ON DUPLICATE KEY UPDATE clause that overwrites
+    every column of an insert statement except the first (the primary key).
+    '''
+    
+    #Extract the column names
+    _, columns = StatementColumns(statement)
+    
+    #Build the update clause
+    updates = ', '.join(['%s = VALUES(%s)' % (column, column) for column in columns[1:]])
+    
+    #Return the clause
+    return(' ON DUPLICATE KEY UPDATE ' + updates)
+  
+    
+#%% Upsert Cache
+
+#Positions of the fields that change with almost every tweet and so do not
+#trigger a rewrite: user_numfollowers, user_numfriends, user_numlisted,
+#user_numfavourites and user_numstatus
+UPSERT_IGNORED_FIELDS = {'users' : (9, 10, 11, 12, 13)}
+
+#Define a class that remembers the places and users already written
+class UpsertCache():
+    '''
+    This class is a bounded least recently used cache of the rows last written
+    to the places and users tables, keyed by their ID. Rows that have not
+    changed since they were last written are filtered out of a batch so the
+    write is skipped entirely. Fields in ignoredFields are left out of the
+    comparison, so a row is also written again once it was last written more
+    than maxAge seconds ago, which keeps the user counts of an active user
+    up to date.
+    
+    Arguments:
+        maxSize       : maximum number of rows remembered per table
+        maxAge        : seconds before a remembered row is written again
+        ignoredFields : positions of the fields of each table to ignore
+    '''
+    
+    def __init__(self, maxSize = 100000, maxAge = 3600, ignoredFields = UPSERT_IGNORED_FIELDS):
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.ignoredFields = ignoredFields
+        self.tables = {}
+        self.lock = threading.Lock()
+        
+        #Cache statistics per table
+        self.stats = {}
+        
+    def Filter(self, table, rows):
+        '''
+        Return the rows of a table that are new, have changed or are older
+        than maxAge since they were last written, keeping only the latest row
+        for each ID.
+        '''
+        
+        #Keep the last row seen for each ID
+        latest = {}
+        
+        for row in rows:
+            latest[row[0]] = row
+        
+        with self.lock:
+            cache = self.tables.setdefault(table, collections.OrderedDict())
+            stats = self.stats.setdefault(table, {'hits' : 0, 'misses' : 0})
+            
+            changed = []
+            now = time.monotonic()
+            
+            for key, row in latest.items():
+                digest, written = cache.get(key, (None, None))
+                
+                if digest == self._Digest(table, row) and now - written < self.maxAge:
+                    #Mark as recently used
+                    cache.move_to_end(key)
+                    stats['hits'] += 1
+                else:
+                    changed.append(row)
+                    stats['misses'] += 1
+                    
+            #Count duplicates within the batch as hits
+            stats['hits'] += len(rows) - len(latest)
+                    
+        #Return the rows to write
+        return(changed)
+    
+    def Update(self, table, rows):
+        '''
+        Remember rows of a table that have been committed to the database.
+        '''
+        with self.lock:
+            cache = self.tables.setdefault(table, collections.OrderedDict())
+            now = time.monotonic()
+            
+            for row in rows:
+                cache[row[0]] = (self._Digest(table, row), now)
+                cache.move_to_end(row[0])
+                
+            #Evict the least recently used rows
+            while len(cache) > self.maxSize:
+                cache.popitem(last = False)
+                
+    def Stats(self):
+        '''
+        Return the hit and miss counts and hit rate of each table.
+        '''
+        with self.lock:
+            stats = {}
+            
+            for table, counts in self.stats.items():
+                total = counts['hits'] + counts['misses']
+                stats[table] = dict(counts,
+                                    size = len(self.tables[table]),
+                                    hitRate = counts['hits'] / total if total else 0.0)
+                
+        #Return the statistics
+        return(stats)
+    
+    def _Digest(self, table, row):
+        #Hash the fields that trigger a rewrite
+        ignored = self.ignoredFields.get(table)
+        
+        if ignored:
+            row = tuple(value for i, value in enumerate(row) if i not in ignored)
+            
+        #Return the digest
+        return(hash(row))
+    
+    
 #%% Writing Functions
         
 #Define a function to write the trend data to the database
-def WriteTrendData2DB(cnx, cursor, addTrendData, trends):
+def WriteTrendData2DB(cnx, cursor, addTrendData, trends, maxRowsPerStatement = 500):
     ''' This function appends an entry to a mySQL database.
+    
+    trends is either the trends dictionary of one location or a list of them,
+    in which case the trends of every location are written with multi-row
+    INSERTs in a single transaction.
     '''
+    
     try:
-        #Extract the as of timestamp
-        trend_asof = re.sub(r"[a-zA-Z]", " ", trends['as_of'])
-        #Remove trailing spaces
-        trend_asof = trend_asof.strip()
+        #Build the rows of every location
+        rows = GenerateTrendRows(trends)
+        
+        #Insert the new observations to the database
+        _ExecuteMultiRow(cursor, addTrendData, rows, maxRowsPerStatement)
+            
+    except Exception as e:
+        #Add error to log and raise
+        logger.error('Error Parsing /or Executing Trend Data to DB', exc_info = True)
+        raise e
+                
+    try:
+        #Commit to the database
+        cnx.commit()
+        
+    except Exception as e:
+        #Add error to log and raise
+        logger.error('Error Committing Trend Data to the Database', exc_info = True)
+        raise e
+        
+    logger.info('Trend Data Successfully Written to the Database')
+        
+    #Return Null
+    
     
-        #Extract the created timestamp
-        trend_created = re.sub(r"[a-zA-Z]", " ", trends['created_at'])
-        #Remove trailing spaces
-        trend_created = trend_created.strip()
+#Define a function to build the rows of the trends table
+def GenerateTrendRows(trends):
+    '''
+    This function returns the rows of the trends table, in the column order
+    of GenerateSQLInsert('trends'), for the trends dictionary of one location
+    or a list of them.
+    '''
+    
+    #Treat a single location as a batch of one
+    if isinstance(trends, dict):
+        trends = [trends]
         
+    #Rows of every location
+    rows = []
+    
+    for locationTrends in trends:
+        #Extract the timestamps
+        trend_asof, trend_created = _TrendTimestamps(locationTrends)
+    
         #Extract the woeid data
-        trend_woeid = trends['locations'][0]['woeid']
-        trend_woeid_name = trends['locations'][0]['name']
-        
-        #For every trend in trends
-        for trend in trends['trends']:
-            trend_rank = trends['trends'].index(trend) + 1
+        trend_woeid = locationTrends['locations'][0]['woeid']
+        trend_woeid_name = locationTrends['locations'][0]['name']
+    
+        #For every trend in trends, ranked by position
+        for trend_rank, trend in enumerate(locationTrends['trends'], 1):
             trend_name = trend['name']
             trend_url = trend['url']
             trend_promcont = trend['promoted_content']
             trend_query = trend['query']
             trend_tweetvol = trend['tweet_volume']
-            
+        
             #Create tuple of data information
             data = (trend_woeid,
                     trend_woeid_name,
@@ -288,116 +828,664 @@ def WriteTrendData2DB(cnx, cursor, addTrendData, trends):
                     trend_promcont,
                     trend_query,
                     trend_tweetvol)
+        
+            #Add to the rows to insert
+            rows.append(data)
             
-            # Insert the new observation to the database
-            cursor.execute(addTrendData, data)
-            
-    except Exception as e:
-        #Add error to log and raise
-        logger.error('Error Parsing /or Executing Trend Data to DB', exc_info = True)
-        raise e
-                
+    #Return the rows
+    return(rows)
+    
+    
+#Define a function to extract the timestamps of a trend snapshot
+def _TrendTimestamps(locationTrends):
+    
+    #Parse the ISO 8601 timestamps (e.g. 2019-11-18T10:21:13Z) directly
+    trend_asof = ParseTrendTimestamp(locationTrends['as_of'])
+    trend_created = ParseTrendTimestamp(locationTrends['created_at'])
+    
+    #Return the timestamps
+    return(trend_asof, trend_created)
+    
+    
+#Define a function to parse a trend timestamp
+def ParseTrendTimestamp(timestamp):
+    '''
+    This function parses an as_of or created_at timestamp of the trends API
+    to a naive UTC datetime.
+    '''
+    
+    #Drop the UTC designator and any fractional seconds
+    return(datetime.fromisoformat(timestamp[:19]))
+    
+    
+#Define a function to write a batch of stream data to the database
+def WriteStreamBatch2DB(cnx, cursor, addStreamData, batch, maxRowsPerStatement = 500, upsertCache = None):
+    '''
+    This function appends a batch of tweets and their meta-data to a mySQL
+    database. Each table is written with multi-row INSERTs in dependency order
+    (places, users, tweets, dimensions, relations) and the whole batch is
+    committed as a single transaction.
+    
+    Arguments:
+        batch               : list of (dataOutput, dataRelations) tuples as
+                              returned by ProcessTwitterData
+        maxRowsPerStatement : maximum number of rows sent in one INSERT
+        upsertCache         : optional UpsertCache used to skip places and
+                              users that have not changed
+    '''
+    
+    #Order the rows of every tweet by destination table
+    tableRows = list(_GroupStreamRows(batch))
+    
+    if upsertCache is not None:
+        #Drop places and users that are unchanged since they were written
+        tableRows[0] = upsertCache.Filter('places', tableRows[0])
+        tableRows[1] = upsertCache.Filter('users', tableRows[1])
+    
     try:
-        #Commit to the database
+        #Insert the rows of each table in dependency order
+        for statement, rows in zip(addStreamData, tableRows):
+            _ExecuteMultiRow(cursor, statement, rows, maxRowsPerStatement)
+        
+        #Commit the whole batch to the database
         cnx.commit()
         
     except Exception as e:
-        #Add error to log and raise
-        logger.error('Error Committing Trend Data to the Database', exc_info = True)
+        #Add error to log
+        logger.error('Error Writing Stream Data to Database', exc_info = True)
+        
+        #Undo any part of the batch already sent
+        try:
+            cnx.rollback()
+        except Exception:
+            logger.error('Error Rolling Back Stream Data Batch', exc_info = True)
+        
+        #Raise the error
         raise e
+    
+    if upsertCache is not None:
+        #Remember the places and users now in the database
+        upsertCache.Update('places', tableRows[0])
+        upsertCache.Update('users', tableRows[1])
         
-    logger.info('Trend Data Successfully Written to the Database')
+    logger.info('Stream Data Batch of %s Tweets Successfully Written to the Database' % len(batch))
         
     #Return Null
     
-    
+
 #Define a function to write the stream data to the database
 def WriteStreamData2DB(cnx, cursor, addStreamData, dataOutput, dataRelations):
     '''
     This function appends a tweet and its meta-data to a mySQL database.
     '''
     
-    #Unpack dataOutput tuple
-    dataTweet, dataUser, dataPlace, dataEntities, dataUserMentions, dataMedia = dataOutput
+    #Write the tweet as a batch of one
+    WriteStreamBatch2DB(cnx, cursor, addStreamData, [(dataOutput, dataRelations)])
+        
+    #Return Null
+    
+    
+#Define a function to order a batch of tweets into rows per table
+def _GroupStreamRows(batch):
+    
+    #Rows in the same order as the statements from GenerateSQLInsert('stream')
+    places, users, tweets, mentions, entities, media = [], [], [], [], [], []
+    tweetEntities, tweetMentions, tweetMedia, tweetLocations = [], [], [], []
     
-    #Unpack sql command tuple
-    addPlaceData, addUserData, addTweetData, addUserMentionData, addEntityData, addMediaData, addTweetEntityRelation, addTweetMentionRelation, addTweetMediaRelation = addStreamData
+    for dataOutput, dataRelations in batch:
+        #Unpack dataOutput tuple
+        dataTweet, dataUser, dataPlace, dataEntities, dataUserMentions, dataMedia = dataOutput
         
-    #Unpack dataRelations tuple
-    dataTweetMentions, dataTweetEntities, dataTweetMedia = dataRelations
+        #Unpack dataRelations tuple
+        dataTweetMentions, dataTweetEntities, dataTweetMedia, dataTweetLocations = dataRelations
+        
+        places.append(dataPlace)
+        users.append(dataUser)
+        tweets.append(dataTweet)
+        mentions.extend(dataUserMentions)
+        entities.extend(dataEntities)
+        media.extend(dataMedia)
+        tweetEntities.extend(dataTweetEntities)
+        tweetMentions.extend(dataTweetMentions)
+        tweetMedia.extend(dataTweetMedia)
+        tweetLocations.extend(dataTweetLocations)
+        
+    #Return the rows per table
+    return(places, users, tweets, mentions, entities, media, tweetEntities, tweetMentions, tweetMedia, tweetLocations)
     
-    try:
-        #Insert any new places
-        cursor.execute(addPlaceData, dataPlace)
+
+#Define a function to execute an insert statement over many rows at once
+def _ExecuteMultiRow(cursor, statement, rows, maxRowsPerStatement = 500):
+    
+    #Send the rows in chunks to stay below the server packet size
+    for start in range(0, len(rows), maxRowsPerStatement):
+        chunk = rows[start:start + maxRowsPerStatement]
         
-        #Commit to the database
-        cnx.commit()
+        #Flatten the parameters of the chunk
+        params = [value for row in chunk for value in row]
         
-        #Insert any new users
-        cursor.execute(addUserData, dataUser)
-          
-        #Commit to the database
-        cnx.commit()
+        cursor.execute(GenerateMultiRowInsert(statement, len(chunk)), params)
         
-        #Insert the tweet
-        cursor.execute(addTweetData, dataTweet)
+    #Return Null
+    
+
+#Cache of multi-row statements keyed by (statement, numRows)
+_multiRowStatements = {}
+
+#Define a function to expand a single row INSERT into a multi-row INSERT
+def GenerateMultiRowInsert(statement, numRows):
+    '''
+    This function repeats the VALUES placeholder group of a single row insert
+    statement so that numRows rows can be sent in one statement.
+    '''
+    
+    key = (statement, numRows)
+    
+    if key not in _multiRowStatements:
+        #Locate the placeholder group following VALUES
+        start = statement.index('VALUES (') + len('VALUES ')
+        end = statement.index(')', start) + 1
         
-        #Commit to the database
-        cnx.commit()
+        #Repeat the placeholder group for every row
+        groups = ', '.join([statement[start:end]] * numRows)
+        
+        _multiRowStatements[key] = statement[:start] + groups + statement[end:]
         
-    # !! OLD CODE - CAN EXECUTE ALL AT ONCE !!
-    #    #Insert the user mentions
-    #    for mention in dataUserMentions:
-    #        cursor.execute(addUserMentionData, mention)
-    #
-    #    #Insert the entities
-    #    for entity in dataEntities:
-    #        cursor.execute(addEntityData, entity)  
+    #Return the multi-row statement
+    return(_multiRowStatements[key])
+    
+    
+#%% Trend Change Detection
+
+#Fields of a trend stored in the trend state, in column order
+TREND_FIELDS = ('rank', 'url', 'promoted_content', 'query', 'tweet_volume')
+
+#Define a class that writes only the changes between trend snapshots
+class TrendDeltaWriter():
+    '''
+    This class compares each trend snapshot of a location with the previous
+    one and writes only the differences to the trend_changes table:
+        enter  : a trend that was not in the previous snapshot
+        exit   : a trend that has left the snapshot
+        move   : a trend whose rank has changed
+        volume : a trend whose rank is unchanged but tweet volume (or other
+                 details) have changed
+    The latest snapshot of each location is kept in memory and in the
+    trend_state table, so runs started from a cronjob carry on from the
+    previous run. Full snapshots are rebuilt with ReadTrendSnapshots.
+    
+    Arguments:
+        addTrendChanges : statements returned by GenerateSQLInsert('trendchanges')
+    '''
+    
+    def __init__(self, addTrendChanges):
+        self.addTrendChange, self.addTrendState, self.deleteTrendState = addTrendChanges
+        
+        #Latest snapshot of every location, {woeid : {name : fields}}
+        self.snapshots = {}
+        
+        #Writer statistics
+        self.stats = {'snapshots' : 0, 'trends' : 0, 'changes' : 0}
+        
+    def Write(self, cnx, cursor, trends):
+        '''
+        Write the changes in the trends dictionary of one location, or a list
+        of them, in a single transaction.
+        '''
+        
+        #Treat a single location as a batch of one
+        if isinstance(trends, dict):
+            trends = [trends]
             
-        #Insert the user mentions
-        cursor.executemany(addUserMentionData, dataUserMentions)
+        changeRows = []
+        stateRows = []
+        exitRows = []
+        snapshots = {}
         
-        #Commit to the database
-        cnx.commit()
+        try:
+            for locationTrends in trends:
+                #Extract the timestamps
+                trend_asof, trend_created = _TrendTimestamps(locationTrends)
+                
+                #Extract the woeid data
+                trend_woeid = locationTrends['locations'][0]['woeid']
+                trend_woeid_name = locationTrends['locations'][0]['name']
+                
+                #Index the snapshot by trend name
+                current = {}
+                
+                for trend_rank, trend in enumerate(locationTrends['trends'], 1):
+                    if trend['name'] not in current:
+                        current[trend['name']] = (trend_rank,) + tuple(trend[x] for x in TREND_FIELDS[1:])
+                
+                #Compare with the previous snapshot
+                previous = snapshots.get(trend_woeid)
+                if previous is None:
+                    previous = self._Previous(cursor, trend_woeid)
+                
+                for changeType, name, fields in self._Diff(previous, current):
+                    changeRows.append((trend_woeid, trend_woeid_name, trend_asof, trend_created,
+                                       changeType, fields[0], name) + fields[1:])
+                    
+                    if changeType == 'exit':
+                        exitRows.append((trend_woeid, name))
+                    else:
+                        stateRows.append((trend_woeid, name) + fields)
+                        
+                snapshots[trend_woeid] = current
+                self.stats['trends'] += len(current)
+            
+            #Write the changes and the new state
+            _ExecuteMultiRow(cursor, self.addTrendChange, changeRows)
+            _ExecuteMultiRow(cursor, self.addTrendState, stateRows)
+            
+            if exitRows:
+                cursor.executemany(self.deleteTrendState, exitRows)
+                
+        except Exception as e:
+            #Add error to log and raise
+            logger.error('Error Parsing /or Executing Trend Changes to DB', exc_info = True)
+            raise e
+            
+        try:
+            #Commit to the database
+            cnx.commit()
+            
+        except Exception as e:
+            #Add error to log and raise
+            logger.error('Error Committing Trend Changes to the Database', exc_info = True)
+            raise e
+            
+        #Only remember snapshots once they are committed
+        self.snapshots.update(snapshots)
+        self.stats['snapshots'] += len(snapshots)
+        self.stats['changes'] += len(changeRows)
         
-        #Insert the entities
-        cursor.executemany(addEntityData, dataEntities)
-             
-        #Commit to the database
-        cnx.commit()
+        logger.info('%s Trend Changes Successfully Written to the Database' % len(changeRows))
         
-        #Insert the media included
-        cursor.executemany(addMediaData, dataMedia)
+        #Return the number of changes written
+        return(len(changeRows))
         
-        #Commit to the database
-        cnx.commit()
+    def _Previous(self, cursor, woeid):
+        #Use the snapshot in memory
+        if woeid in self.snapshots:
+            return(self.snapshots[woeid])
         
+        #Otherwise read the state left by an earlier run
+        cursor.execute("SELECT state_name, state_rank, state_url, state_promotedcontent, "
+                       "state_query, state_tweetvolume FROM trend_state WHERE state_woeid = %s",
+                       (woeid,))
         
-        #Add the tweet mention relationships
-        cursor.executemany(addTweetMentionRelation, dataTweetMentions)
+        #Return the snapshot
+        return({row[0] : tuple(row[1:]) for row in cursor.fetchall()})
+    
+    @staticmethod
+    def _Diff(previous, current):
+        #Find new and changed trends
+        for name, fields in current.items():
+            before = previous.get(name)
+            
+            if before is None:
+                yield('enter', name, fields)
+            elif before[0] != fields[0]:
+                yield('move', name, fields)
+            elif before != fields:
+                yield('volume', name, fields)
+                
+        #Find trends that have left
+        for name, fields in previous.items():
+            if name not in current:
+                yield('exit', name, fields)
+                
+    def Stats(self):
+        '''
+        Return the number of snapshots, trends and changes written.
+        '''
+        return(dict(self.stats))
+    
+    
+#Define a function to rebuild full trend snapshots from the trend changes
+def ReadTrendSnapshots(cursor, woeid, start = None, end = None):
+    '''
+    This generator replays the trend_changes of a location and yields each
+    snapshot in which something changed as (asof, trends), where trends is a
+    list of dictionaries ordered by rank in the same form as the API. The
+    snapshot at any other time is the last one yielded before it.
+    
+    Arguments:
+        start : optional datetime of the first snapshot yielded
+        end   : optional datetime of the last snapshot yielded
+    '''
+    
+    #Read the changes up to the end in the order they were written
+    query = ("SELECT change_datetime_asof, change_type, change_name, change_rank, change_url, "
+             "change_promotedcontent, change_query, change_tweetvolume "
+             "FROM trend_changes WHERE change_woeid = %s")
+    params = [woeid]
+    
+    if end is not None:
+        query += " AND change_datetime_asof <= %s"
+        params.append(end)
         
-        #Commit to the database
-        cnx.commit()
+    cursor.execute(query + " ORDER BY change_id", tuple(params))
+    
+    snapshot = {}
+    asof = None
+    
+    def Trends():
+        return([dict(zip(('name',) + TREND_FIELDS, (name,) + fields))
+                for name, fields in sorted(snapshot.items(), key = lambda x: x[1][0])])
+    
+    for row in cursor.fetchall():
+        if asof is not None and row[0] != asof and (start is None or asof >= start):
+            yield(asof, Trends())
+            
+        asof = row[0]
         
-        #Add the tweet entity relationships
-        cursor.executemany(addTweetEntityRelation, dataTweetEntities)
+        #Apply the change
+        if row[1] == 'exit':
+            snapshot.pop(row[2], None)
+        else:
+            snapshot[row[2]] = tuple(row[3:])
+            
+    if asof is not None and (start is None or asof >= start):
+        yield(asof, Trends())
         
-        #Commit to the database
-        cnx.commit()
         
-        #Add the tweet media relationships
-        cursor.executemany(addTweetMediaRelation, dataTweetMedia)
+#%% Bulk Loading Functions
+
+#Define a function to generate LOAD DATA statements from insert statements
+def GenerateSQLLoad(addStreamData):
+    '''
+    This function converts the stream insert statements into LOAD DATA LOCAL
+    INFILE statements for the same tables and columns. Tables written with
+    REPLACE are loaded with REPLACE and all others with IGNORE. LOAD DATA has
+    no equivalent of ON DUPLICATE KEY UPDATE, so upserted tables (places and
+    users) are given None and are left to the multi-row insert.
+    '''
+    
+    loadStreamData = []
+    
+    for statement in addStreamData:
+        if 'ON DUPLICATE KEY UPDATE' in statement.upper():
+            #Keep the upsert so existing rows are updated
+            loadStreamData.append(None)
+            continue
+            
+        #Extract the table name and columns
+        table, columns = StatementColumns(statement)
+        columns = ', '.join(columns)
         
-        #Commit to the database
-        cnx.commit()
+        mode = 'REPLACE' if statement.upper().startswith('REPLACE') else 'IGNORE'
         
-    except Exception as e:
-        #Add error to log and raise
-        logger.error('Error Writing Stream Data to Database', exc_info = True)
-        raise e
+        loadStreamData.append("LOAD DATA LOCAL INFILE %s " + mode + " INTO TABLE " + table + " "
+                              "CHARACTER SET utf8mb4 "
+                              "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                              "LINES TERMINATED BY '\\n' "
+                              "(" + columns + ")")
+        
+    #Return the statements in the same order
+    return(tuple(loadStreamData))
+
+
+#Characters escaped in the TSV files
+_TSV_ESCAPES = str.maketrans({'\\' : '\\\\', '\t' : '\\t', '\n' : '\\n', '\r' : '\\r', '\0' : '\\0'})
+
+#Define a function to format a value for a TSV file read by LOAD DATA
+def _FormatTSVValue(value):
+    if value is None:
+        return('\\N')
+    
+    if isinstance(value, bool):
+        return('1' if value else '0')
+    
+    if isinstance(value, datetime):
+        return(value.strftime('%Y-%m-%d %H:%M:%S'))
+    
+    #Return the escaped string
+    return(str(value).translate(_TSV_ESCAPES))
+
+
+#Define a function to bulk load a batch of stream data into the database
+def WriteStreamBulk2DB(cnx, cursor, addStreamData, batch, upsertCache = None, directory = None):
+    '''
+    This function loads a batch of tweets and their meta-data into a mySQL
+    database with LOAD DATA LOCAL INFILE. A TSV file is written for each table
+    and the tables are loaded in dependency order in a single transaction.
+    Upserted tables (places and users) are written with multi-row inserts so
+    existing rows are updated. The connection must be opened with
+    allowLocalInfile = True.
+    
+    Arguments:
+        batch       : list of (dataOutput, dataRelations) tuples as returned
+                      by ProcessTwitterData
+        upsertCache : optional UpsertCache used to skip places and users that
+                      have not changed
+        directory   : directory for the temporary TSV files
+    '''
+    
+    #Order the rows of every tweet by destination table
+    tableRows = list(_GroupStreamRows(batch))
+    
+    if upsertCache is not None:
+        #Drop places and users that are unchanged since they were written
+        tableRows[0] = upsertCache.Filter('places', tableRows[0])
+        tableRows[1] = upsertCache.Filter('users', tableRows[1])
+        
+    loadStreamData = GenerateSQLLoad(addStreamData)
+    
+    with tempfile.TemporaryDirectory(dir = directory) as temporaryDirectory:
+        try:
+            for i, (statement, rows) in enumerate(zip(loadStreamData, tableRows)):
+                if not rows:
+                    continue
+                    
+                if statement is None:
+                    #Upsert the rows with the insert statement
+                    _ExecuteMultiRow(cursor, addStreamData[i], rows)
+                    continue
+                    
+                #Write the rows of the table to a TSV file
+                path = os.path.join(temporaryDirectory, 'table%s.tsv' % i)
+                
+                with open(path, 'w', encoding = 'utf-8', newline = '\n') as tsv:
+                    for row in rows:
+                        tsv.write('\t'.join([_FormatTSVValue(value) for value in row]) + '\n')
+                        
+                #Load the file into the table
+                cursor.execute(statement, (path.replace('\\', '/'),))
+                
+            #Commit the whole batch to the database
+            cnx.commit()
+            
+        except Exception as e:
+            #Add error to log
+            logger.error('Error Bulk Loading Stream Data to Database', exc_info = True)
+            
+            #Undo any part of the batch already loaded
+            try:
+                cnx.rollback()
+            except Exception:
+                logger.error('Error Rolling Back Stream Data Batch', exc_info = True)
+                
+            #Raise the error
+            raise e
         
-    logger.info('Stream Data Successfully Written to the Database')
+    if upsertCache is not None:
+        #Remember the places and users now in the database
+        upsertCache.Update('places', tableRows[0])
+        upsertCache.Update('users', tableRows[1])
         
+    logger.info('Stream Data Batch of %s Tweets Successfully Bulk Loaded to the Database' % len(batch))
+    
     #Return Null
     
-    
\ No newline at end of file
+    
+#%% Batch Writer
+
+#Define the error raised when the batch writer hands tweets back
+class StreamWriteError(Exception):
+    '''
+    This error is raised by StreamBatchWriter when a batch cannot be written.
+    batch holds the (dataOutput, dataRelations) of any tweets the writer
+    could not keep buffered, which the caller is responsible for. When raised
+    by a WriterGroup, targets holds the index of the writer that handed back
+    each tweet, so only that writer is retried.
+    '''
+    
+    def __init__(self, message, batch = None, targets = None):
+        super().__init__(message)
+        self.batch = batch if batch is not None else []
+        self.targets = targets if targets is not None else [None] * len(self.batch)
+        
+        
+#Define a class that buffers processed tweets and writes them in batches
+class StreamBatchWriter():
+    '''
+    This class buffers processed tweets and writes them to a storage backend
+    (see storage_functions) once batchSize tweets are buffered or the oldest
+    buffered tweet is older than maxAge seconds. A batch that fails to write
+    is put back at the front of the buffer and retried with backoff. Once
+    more than maxBuffer tweets are waiting, the newest are handed back to the
+    caller in a StreamWriteError.
+    
+    Arguments:
+        backend   : StorageBackend the batches are written to
+        batchSize : number of tweets that triggers a flush
+        maxAge    : seconds a tweet may wait in the buffer (None to only
+                    flush when the batch is full or Flush is called)
+        maxBuffer : number of tweets kept while writes are failing (default
+                    20 batches)
+    '''
+    
+    def __init__(self, backend, batchSize = 500, maxAge = 0.25, maxBuffer = None):
+        self.backend = backend
+        self.batchSize = batchSize
+        self.maxAge = maxAge
+        self.maxBuffer = maxBuffer if maxBuffer is not None else batchSize * 20
+        
+        self.buffer = []
+        self.oldest = None
+        
+        #Consecutive failed flushes and when the next flush may be retried
+        self.failures = 0
+        self.retryAt = 0
+        
+        #Lock protecting the buffer and lock serialising flushes
+        self.bufferLock = threading.Lock()
+        self.flushLock = threading.Lock()
+        
+        #Writer statistics
+        self.stats = {'tweets' : 0, 'flushes' : 0, 'errors' : 0, 'returned' : 0}
+        
+        #Start a background thread that flushes aged batches
+        self.closed = threading.Event()
+        self.timer = None
+        
+        if maxAge is not None:
+            self.timer = threading.Thread(target = self._FlushAged, daemon = True)
+            self.timer.start()
+        
+    def Add(self, dataOutput, dataRelations):
+        '''
+        Add a processed tweet to the buffer, flushing if the batch is full.
+        A batch that fails to write stays buffered and is retried, so the
+        tweet is not lost. While writes are backing off the tweet is only
+        buffered, and tweets beyond maxBuffer are handed back in a
+        StreamWriteError.
+        '''
+        with self.bufferLock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            
+            self.buffer.append((dataOutput, dataRelations))
+            full = len(self.buffer) >= self.batchSize
+            
+            #Do not retry the write on every tweet while backing off
+            waiting = time.monotonic() < self.retryAt
+            rejected = self._Overflow() if waiting else []
+            
+        if rejected:
+            raise StreamWriteError('Stream data buffer full while writes are failing', rejected)
+            
+        if full and not waiting:
+            try:
+                self.Flush()
+                
+            except StreamWriteError:
+                #The batch is still buffered and is retried after backing off
+                logger.error('Error Flushing Full Stream Data Batch, Retrying in %.1f Seconds'
+                             % (self.retryAt - time.monotonic()), exc_info = True)
+                             
+    def Flush(self):
+        '''
+        Write everything currently buffered to the database.
+        '''
+        with self.flushLock:
+            with self.bufferLock:
+                batch, self.buffer = self.buffer, []
+                self.oldest = None
+                
+            if not batch:
+                return
+            
+            try:
+                #Write the batch in one transaction
+                self.backend.WriteStreamBatch(batch)
+                    
+            except Exception as e:
+                with self.bufferLock:
+                    #Put the batch back ahead of anything added since
+                    self.buffer = batch + self.buffer
+                    self.oldest = time.monotonic()
+                    
+                    #Back off before the next aged flush
+                    self.failures += 1
+                    self.retryAt = self.oldest + min((self.maxAge or 0.25) * 2 ** self.failures, 60)
+                    
+                self.stats['errors'] += 1
+                raise StreamWriteError('Error writing stream data batch: %s' % e) from e
+                
+            self.failures = 0
+            self.retryAt = 0
+            
+            self.stats['tweets'] += len(batch)
+            self.stats['flushes'] += 1
+            
+    def Close(self):
+        '''
+        Stop the background flusher and write any remaining tweets.
+        '''
+        self.closed.set()
+        
+        if self.timer is not None:
+            self.timer.join()
+            
+        self.Flush()
+        
+        #Add writer statistics to the log
+        logger.info('Stream Batch Writer Statistics: %s' % self.stats)
+        
+    def _Overflow(self):
+        #Remove and return the newest tweets beyond maxBuffer
+        rejected = self.buffer[self.maxBuffer:]
+        del self.buffer[self.maxBuffer:]
+        
+        self.stats['returned'] += len(rejected)
+        
+        #Return the tweets handed back
+        return(rejected)
+        
+    def _FlushAged(self):
+        #Periodically flush batches that have waited longer than maxAge
+        while not self.closed.wait(self.maxAge / 2):
+            with self.bufferLock:
+                now = time.monotonic()
+                aged = self.oldest is not None and now - self.oldest >= self.maxAge and now >= self.retryAt
+                
+            if aged:
+                try:
+                    self.Flush()
+                except Exception:
+                    logger.error('Error Flushing Aged Stream Data Batch, Retrying in %.1f Seconds'
+                                 % (self.retryAt - time.monotonic()), exc_info = True)
@@ -21,8 +21,9 @@
 #    to extract trends for a given area.
 #    >> woeidList = IdentifyWOEIDLocations(api)
 
-# 2. OpenSSL, although not used explicity, is included to aid in catching any
-#    any related errors.
+# 2. scraping_functions, and with it tweepy, is only imported by runs that
+#    use the Twitter API so that other runs start faster. The MySQL connector
+#    and requests are likewise imported when first used.
 
 
 #%% Required Libraries
@@ -30,9 +31,6 @@
 #logging: Used to create logs
 import logging
 
-#pyOpenSSL: Python wrapper for the OpenSSL library
-import OpenSSL
-
 #argparse: For specifying arguments on CLI
 import argparse
 
@@ -48,50 +46,228 @@ import sys
 import authentication_functions as axf
 import db_functions as dbf
 import woeid_functions as geo
-import scraping_functions as scrape
+import pipeline_functions as pipe
+import storage_functions as stor
+import spool_functions as spool
+import processing_functions as wrangle
+import scheduler_functions as schedule
 
 
 #%% Main Function
 # Define the main function that brings together the whole script
             
-def StartMining(locationID, request, credJSON = 'credentials.json'):
+def StartMining(locationID, request, credJSON = 'credentials.json', locationIDs = None, poolSize = 4,
+                batchSize = 500, batchAge = 0.25, workers = 2, queueSize = 10000,
+                backpressure = 'block', spillPath = 'spill.ndjson', parseProcesses = 0,
+                upsertCacheSize = 100000, upsertCacheTTL = 3600, spoolDir = None, writeMode = 'insert',
+                countryCode = None, placeType = None, woeidFile = 'woeidList.json', trendWorkers = 4,
+                daemon = False, interval = 300, bboxCache = 'bboxCache.json', bboxTTL = 30,
+                parentID = None, trendMode = 'full', sink = 'db', parquetDir = 'parquet',
+                archiveDir = None, archiveCompression = 'gzip', backend = 'mysql',
+                sqlitePath = 'twitterGeoStream.db', replayFiles = None,
+                replayCheckpoint = 'replay-checkpoint.json', replaySpeed = 0, replayWorkers = 2):
    
-    #Read the DB credentials
-    credentialsDB = axf.ReadDBCredentials(credJSON)
+    #Read the credentials file once for the whole run
+    config = axf.LoadConfig(credJSON)
+    
+    if countryCode is not None or placeType is not None or parentID is not None:
+        #Select the locations matching the filter from the WOEID catalog
+        locationIDs = (locationIDs or []) + geo.FilterWOEIDs(woeidFile, countryCode, placeType, parentID)
+        
+    #Open the cache of WOEID bounding boxes
+    cache = geo.BBoxCache(bboxCache, bboxTTL * 24 * 60 * 60)
+    
+    if request.lower() == 'prefetch':
+        #Select the WOEIDs to resolve
+        if locationIDs is None:
+            locationIDs = geo.FilterWOEIDs(woeidFile)
+        
+        #Resolve the bounding boxes into the cache and return
+        geo.PrefetchBBoxes(locationIDs, cache, config)
+        return
+    
+    #Remember written places and users so unchanged rows are skipped
+    upsertCache = dbf.UpsertCache(upsertCacheSize, upsertCacheTTL) if upsertCacheSize > 0 else None
+    
+    if request.lower() in ('stream', 'replay') and sink == 'parquet':
+        #Tweets are only written to Parquet so the database is not used
+        credentialsDB, dbPool, storage = None, None, None
+        
+    elif backend in ('sqlite', 'postgres'):
+        if trendMode == 'delta' or writeMode == 'bulk':
+            #Add error to log and raise
+            logger.error('Option Not Supported by the %s Backend' % backend)
+            raise AttributeError('--trendMode delta and --writeMode bulk require --backend mysql')
+        
+        if backend == 'sqlite':
+            #Write to a local database file, no DB credentials are needed
+            storage = stor.SQLiteBackend(sqlitePath, upsertCache)
+        else:
+            #Write to PostgreSQL with COPY
+            storage = stor.PostgresBackend(axf.ReadDBCredentials(config), upsertCache)
+        
+        #Stream limit notices are only recorded in MySQL
+        credentialsDB, dbPool = None, None
+        
+    else:
+        #Read the DB credentials
+        credentialsDB = axf.ReadDBCredentials(config)
+        
+        #Create a pool of long-lived DB connections
+        dbPool = dbf.DBConnectionPool(credentialsDB, poolSize = poolSize,
+                                      allowLocalInfile = writeMode == 'bulk')
+        storage = stor.MySQLBackend(dbPool, upsertCache, bulkLoad = writeMode == 'bulk')
 
-    #Create an API object
-    auth, api = scrape.StartAPI(credJSON = 'credentials.json')  
+    if request.lower() != 'replay':
+        #Import the Twitter API wrapper only when it is needed
+        import scraping_functions as scrape
+        
+        #Create an API object
+        auth, api = scrape.StartAPI(config)  
         
     if request.lower() == 'trends':
-        #Extract the location trends
-        trends = scrape.GetTrends(api, locationID)
+        if trendMode == 'delta':
+            #Only write the changes since the previous snapshot of each location
+            deltaWriter = dbf.TrendDeltaWriter(dbf.GenerateSQLInsert('trendchanges'))
         
-        #Generate SQL statement
-        addTrendData = dbf.GenerateSQLInsert(request)
+        #Share the trends/place rate limit between runs, starting from the
+        #requests already made in the current window
+        budget = scrape.RateBudget()
+        budget.Seed(api)
         
-        #Establish a connection to the DB
-        cnx, cursor = dbf.Connect2DB(credentialsDB)
+        def CollectTrends():
+            if locationIDs:
+                #Extract the trends of every location
+                trends = scrape.GetTrendsBatch(api, locationIDs, trendWorkers, budget)
+            else:
+                #Extract the location trends
+                budget.Acquire()
+                trends = scrape.GetTrends(api, locationID)
+            
+            if trendMode == 'delta':
+                #Borrow a connection from the pool and write the changes
+                with storage.Connect() as (cnx, cursor):
+                    deltaWriter.Write(cnx, cursor, trends)
+            else:
+                #Write the data to the database
+                storage.WriteTrends(trends)
+                
+        if daemon:
+            #Keep the API and DB connections open and collect on a schedule
+            scheduler = schedule.PeriodicScheduler(CollectTrends, interval)
+            
+            try:
+                scheduler.Run()
+            finally:
+                scheduler.Stop()
+        else:
+            CollectTrends()
         
-        #Write the data to the database
-        dbf.WriteTrendData2DB(cnx, cursor, addTrendData, trends)
+    elif request.lower() in ('stream', 'replay'):
+        if locationID is None and not locationIDs:
+            #Add error to log and raise
+            logger.error('No Stream Location Entered')
+            raise AttributeError('--locationID or --locationIDs is required for a %s' % request.lower())
+            
+        if locationIDs:
+            if len(locationIDs) > 25 and request.lower() == 'stream':
+                #Add error to log and raise
+                logger.error('Too Many Stream Locations Entered')
+                raise AttributeError('The stream accepts at most 25 locations but got %s' % len(locationIDs))
+            
+            #Get the bbox of every location and route tweets between them
+            regions = {woeid : geo.BBoxofWOEID(woeid, config, cache) for woeid in locationIDs}
+            locationID = geo.LocationRouter(regions)
+            bbox = locationID.Locations()
+            
+        elif request.lower() == 'stream':
+            #Get bbox from locationID
+            bbox = geo.BBoxofWOEID(locationID, config, cache)
         
-        #Close the cursor and connection
-        dbf.CloseDBConnection(cnx, cursor)
+        #Generate SQL statements
+        addStreamData = dbf.GenerateSQLInsert('stream')
         
-    elif request.lower() == 'stream':
-        #Get bbox from locationID
-        bbox = geo.BBoxofWOEID(locationID, credJSON = 'credentials.json')
+        #Optionally process tweets on several processes
+        parser = wrangle.ParallelParser(parseProcesses) if parseProcesses > 0 else None
         
-        #Generate SQL statements
-        addStreamData = dbf.GenerateSQLInsert(request)
+        if spoolDir is not None and request.lower() == 'stream':
+            if sink not in ('db', 'mysql'):
+                #Add error to log and raise
+                logger.error('The Spool Only Writes to the Database')
+                raise AttributeError('--spoolDir can only be used with --sink db')
+            
+            #Write every tweet to disk first and drain the spool to the DB
+            writer = None
+            pipeline = spool.StreamSpool(spoolDir, locationID, storage, batchSize = batchSize, parser = parser)
+        else:
+            writers = []
+            
+            if sink != 'parquet':
+                #Create a writer that batches tweets into one transaction, a
+                #replay only flushes when a batch is full or at a checkpoint
+                maxAge = batchAge if request.lower() == 'stream' else None
+                writers.append(dbf.StreamBatchWriter(storage, batchSize, maxAge))
+                
+            if sink in ('parquet', 'both'):
+                #Import pyarrow only when it is needed
+                import parquet_functions as columnar
+                
+                #Create a writer of partitioned Parquet files
+                writers.append(columnar.ParquetSink(parquetDir, addStreamData))
+                
+            writer = writers[0] if len(writers) == 1 else pipe.WriterGroup(writers)
+            
+            if request.lower() == 'stream':
+                #Create a pool of workers to process and write the tweets
+                pipeline = pipe.StreamPipeline(locationID, writer, workers, queueSize, backpressure, spillPath, parser)
         
-        #Start streaming
-        scrape.StreamTweets(api, auth, bbox, credentialsDB, locationID, addStreamData)
+        if request.lower() == 'replay':
+            #Import the replay only when it is needed
+            import replay_functions as replay
+            
+            #Checkpoints close the open Parquet files, so make them less often
+            if sink in ('parquet', 'both'):
+                checkpointEvery, checkpointInterval = 1000000, 600
+            else:
+                checkpointEvery, checkpointInterval = 10000, 5.0
+                
+            #Read the payloads from recorded files rather than the stream
+            pipeline = replay.StreamReplay(replayFiles, locationID, writer, replayCheckpoint, replaySpeed,
+                                           replayWorkers, batchSize, parser, checkpointEvery, checkpointInterval)
+            
+        elif archiveDir is not None:
+            #Import the archive only when it is needed
+            import archive_functions as archive
+            
+            #Keep every raw payload before passing it on
+            pipeline = archive.RawArchive(archiveDir, pipeline, archiveCompression)
+            
+        try:
+            if request.lower() == 'replay':
+                #Start replaying
+                pipeline.Run()
+            else:
+                #Start streaming
+                scrape.StreamTweets(api, auth, bbox, credentialsDB, locationID, addStreamData, dbPool, writer, pipeline)
+            
+        finally:
+            #Process any queued tweets and write any still buffered
+            pipeline.Close()
+            
+            if writer is not None:
+                writer.Close()
+            
+            if parser is not None:
+                parser.Close()
         
     else:
         #Add error to log and raise
         logger.error("Incorrect Request Entered", exc_info = True)
-        raise AttributeError('Expected "trends" or "stream" but got %s' % request)       
+        raise AttributeError('Expected "trends", "stream", "replay" or "prefetch" but got %s' % request)       
+    
+    if storage is not None:
+        #Close the database connections
+        storage.Close()
     
     #Return Null
                
@@ -111,13 +287,168 @@ if __name__ == '__main__':
     parser.add_argument('--locationID',
                         type = int,
                         help = 'a WOEID supplied as an integer')
+    parser.add_argument('--locationIDs',
+                        type = int,
+                        nargs = '+',
+                        help = 'several WOEIDs to obtain trends for, or up to 25\
+                                WOEIDs streamed over a single connection')
+    parser.add_argument('--countryCode',
+                        type = str,
+                        help = 'obtain trends for every WOEID in this country')
+    parser.add_argument('--placeType',
+                        type = str,
+                        help = 'obtain trends for every WOEID of this place type')
+    parser.add_argument('--parentID',
+                        type = int,
+                        help = 'obtain trends for every WOEID whose parent is this\
+                                WOEID (e.g. the towns of a country)')
+    parser.add_argument('--woeidFile',
+                        type = str,
+                        default = 'woeidList.json',
+                        help = 'filepath to the list of WOEIDs used by the filters')
+    parser.add_argument('--trendWorkers',
+                        type = int,
+                        default = 4,
+                        help = 'number of trend requests made at once')
+    parser.add_argument('--daemon',
+                        action = 'store_true',
+                        help = 'keep running and obtain trends every --interval\
+                                seconds instead of once')
+    parser.add_argument('--trendMode',
+                        type = str,
+                        default = 'full',
+                        choices = ('full', 'delta'),
+                        help = 'write every trend of each snapshot ("full") or\
+                                only the changes since the previous one ("delta")')
+    parser.add_argument('--interval',
+                        type = int,
+                        default = 300,
+                        help = 'seconds between trend collections in --daemon mode')
     parser.add_argument('--request',
                         type = str,
                         help = 'option of obtaining "trends" or "stream"ing\
-                                from a given WOEID')
+                                from a given WOEID, "replay"ing recorded stream\
+                                files, or "prefetch"ing the bounding boxes of\
+                                WOEIDs into the cache')
     parser.add_argument('--credJSON',
                         type = str,
+                        default = 'credentials.json',
                         help = 'filepath to JSON credentials file')
+    parser.add_argument('--poolSize',
+                        type = int,
+                        default = 4,
+                        help = 'maximum number of pooled database connections')
+    parser.add_argument('--batchSize',
+                        type = int,
+                        default = 500,
+                        help = 'number of tweets written to the database per batch')
+    parser.add_argument('--batchAge',
+                        type = float,
+                        default = 0.25,
+                        help = 'maximum seconds a tweet is buffered before being written')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 2,
+                        help = 'number of threads processing and writing tweets')
+    parser.add_argument('--queueSize',
+                        type = int,
+                        default = 10000,
+                        help = 'maximum number of raw tweets queued in memory')
+    parser.add_argument('--backpressure',
+                        type = str,
+                        default = 'block',
+                        choices = pipe.BACKPRESSURE_POLICIES,
+                        help = 'action when the queue is full: "block", "spill"\
+                                to disk or "drop"')
+    parser.add_argument('--spillPath',
+                        type = str,
+                        default = 'spill.ndjson',
+                        help = 'filepath used to spill tweets when the queue is full')
+    parser.add_argument('--parseProcesses',
+                        type = int,
+                        default = 0,
+                        help = 'number of processes parsing tweets (0 parses on\
+                                the worker threads)')
+    parser.add_argument('--upsertCacheSize',
+                        type = int,
+                        default = 100000,
+                        help = 'number of places and users remembered to skip\
+                                unchanged writes (0 disables)')
+    parser.add_argument('--upsertCacheTTL',
+                        type = int,
+                        default = 3600,
+                        help = 'seconds before a remembered place or user is\
+                                written again')
+    parser.add_argument('--spoolDir',
+                        type = str,
+                        default = None,
+                        help = 'directory of an on-disk spool that every tweet is\
+                                written to before the database')
+    parser.add_argument('--writeMode',
+                        type = str,
+                        default = 'insert',
+                        choices = ('insert', 'bulk'),
+                        help = 'write batches with multi-row "insert"s or "bulk"\
+                                load them with LOAD DATA LOCAL INFILE')
+    parser.add_argument('--backend',
+                        type = str,
+                        default = 'mysql',
+                        choices = stor.BACKENDS,
+                        help = 'database trends and tweets are written to, a\
+                                "mysql" or "postgres" server or a local\
+                                "sqlite" file')
+    parser.add_argument('--sqlitePath',
+                        type = str,
+                        default = 'twitterGeoStream.db',
+                        help = 'filepath of the SQLite database')
+    parser.add_argument('--sink',
+                        type = str,
+                        default = 'db',
+                        choices = ('db', 'mysql', 'parquet', 'both'),
+                        help = 'write streamed tweets to the --backend "db"\
+                                ("mysql" is kept as an alias), to Parquet\
+                                files in --parquetDir, or "both"')
+    parser.add_argument('--parquetDir',
+                        type = str,
+                        default = 'parquet',
+                        help = 'directory of the Parquet datasets')
+    parser.add_argument('--archiveDir',
+                        type = str,
+                        default = None,
+                        help = 'directory of a compressed archive of every raw\
+                                streamed payload')
+    parser.add_argument('--archiveCompression',
+                        type = str,
+                        default = 'gzip',
+                        choices = ('gzip', 'zstd'),
+                        help = 'compression of the raw archive')
+    parser.add_argument('--replayFiles',
+                        type = str,
+                        nargs = '+',
+                        help = 'NDJSON files (optionally .gz or .zst) or\
+                                directories of them to replay')
+    parser.add_argument('--replayCheckpoint',
+                        type = str,
+                        default = 'replay-checkpoint.json',
+                        help = 'filepath of the checkpoint an interrupted replay\
+                                resumes from')
+    parser.add_argument('--replaySpeed',
+                        type = float,
+                        default = 0,
+                        help = 'replay at this multiple of the rate tweets were\
+                                received (0 replays as fast as possible)')
+    parser.add_argument('--replayWorkers',
+                        type = int,
+                        default = 2,
+                        help = 'number of files replayed at once')
+    parser.add_argument('--bboxCache',
+                        type = str,
+                        default = 'bboxCache.json',
+                        help = 'filepath of the cache of WOEID bounding boxes')
+    parser.add_argument('--bboxTTL',
+                        type = int,
+                        default = 30,
+                        help = 'days before a cached bounding box is requested again')
     
     #Parse arguments
     args = parser.parse_args()
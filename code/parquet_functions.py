@@ -0,0 +1,315 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################## PARQUET FUNCTIONS ##############################
+###############################################################################
+
+#%% Notes
+
+# 1. The Parquet sink writes the same rows as WriteStreamBatch2DB, one dataset
+#    per table, laid out as
+#        <directory>/<table>/location=<woeid>/hour=<YYYY-MM-DD-HH>/part-*.parquet
+#    where the location and hour are the tweet_streamlocation and UTC hour of
+#    the tweet the row came from.
+
+# 2. Files are written under a hidden temporary name and renamed once closed,
+#    so readers (e.g. pyarrow.dataset or Spark) never see a partial file.
+
+# 3. The column types are read from the CREATE TABLE statements in
+#    twitterGeoStream.sql so the files match the MySQL tables.
+
+# 4. pyarrow is optional and only needed when the sink is used.
+
+
+#%% Required Libraries
+
+#os: Used to manage the partition directories and files
+import os
+
+#threading: Used to make the sink thread safe
+import threading
+
+#time: Used to roll files over by age
+import time
+
+#datetime: Used to find the hour of each tweet
+from datetime import datetime, timezone
+
+#logging: Used to create logs
+import logging
+
+#pyarrow: Used to write Parquet files
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+#%% Configure logger
+
+logger = logging.getLogger(__name__)
+
+
+#%% Import Required Functions from Other Modules
+
+import db_functions as dbf
+
+
+#%% Schemas
+
+#Columns with few distinct values that are dictionary encoded
+DICTIONARY_COLUMNS = {'tweet_lang', 'tweet_source', 'tweet_place_id', 'tweet_filterlevel',
+                      'user_lang', 'user_timezone', 'user_translator', 'place_id', 'place_type',
+                      'place_countrycode', 'place_country', 'entity_type', 'media_type'}
+
+#Define a function to convert a MySQL type to an Arrow type and converter
+def _ArrowType(columnType):
+    
+    if columnType in ('BIGINT', 'INT'):
+        #Twitter sends some integers (e.g. timestamp_ms) as strings
+        return(pyarrow.int64(), int)
+    elif columnType == 'TINYINT':
+        return(pyarrow.int8(), int)
+    elif columnType == 'BOOLEAN':
+        return(pyarrow.bool_(), bool)
+    elif columnType == 'DATETIME':
+        return(pyarrow.timestamp('us', tz = 'UTC'), None)
+    else:
+        return(pyarrow.string(), str)
+
+
+#%% Parquet Sink
+
+#Define a class for writing stream data to partitioned Parquet files
+class ParquetSink():
+    '''
+    This class writes processed tweets to Parquet files partitioned by stream
+    location and hour. It has the same Add/Flush/Close interface as
+    StreamBatchWriter so it can be used by a StreamPipeline on its own or
+    alongside the database with a pipe.WriterGroup.
+    
+    Rows are buffered per partition and written as a row group once
+    rowGroupSize rows are buffered. A file is closed and made visible once it
+    reaches maxFileBytes or has been open for maxFileAge seconds, and the next
+    rows of its partition start a new file.
+    
+    Arguments:
+        directory     : root directory of the datasets
+        addStreamData : SQL statements from GenerateSQLInsert('stream'), used
+                        for the table and column names
+        rowGroupSize  : rows per row group
+        maxFileAge    : seconds before a file is rolled over
+        maxFileBytes  : size in bytes at which a file is rolled over
+        compression   : Parquet compression codec
+    '''
+    
+    def __init__(self, directory, addStreamData, rowGroupSize = 10000, maxFileAge = 600,
+                 maxFileBytes = 128 * 1024 * 1024, compression = 'zstd', sqlFile = dbf.SQL_FILE):
+        if pyarrow is None:
+            #Add error to log and raise
+            logger.error('pyarrow Is Required to Write Parquet Files')
+            raise ImportError('pyarrow is required to write Parquet files')
+        
+        self.directory = directory
+        self.rowGroupSize = rowGroupSize
+        self.maxFileAge = maxFileAge
+        self.maxFileBytes = maxFileBytes
+        self.compression = compression
+        
+        #Build the schema of every table in the order of _GroupStreamRows
+        definitions = dbf.ReadTableDefinitions(sqlFile)
+        self.tables = []
+        
+        for statement in addStreamData:
+            table, columns = dbf.StatementColumns(statement)
+            tableTypes = {name : columnType for name, columnType, _ in definitions[table]['columns']}
+            arrowTypes = [_ArrowType(tableTypes[column]) for column in columns]
+            
+            schema = pyarrow.schema([(column, arrowType) for column, (arrowType, _) in zip(columns, arrowTypes)])
+            converters = [converter for _, converter in arrowTypes]
+            dictionary = [column for column in columns if column in DICTIONARY_COLUMNS]
+            
+            self.tables.append((table, schema, converters, dictionary))
+        
+        #Find the columns of the tweet used to partition its rows
+        _, tweetColumns = dbf.StatementColumns(addStreamData[2])
+        self.locationIndex = tweetColumns.index('tweet_streamlocation')
+        self.createdIndex = tweetColumns.index('tweet_created')
+        
+        #Buffered rows, open files and when each file was started, keyed by
+        #(table index, location, hour)
+        self.buffers = {}
+        self.files = {}
+        self.started = {}
+        self.sequence = 0
+        
+        self.lock = threading.Lock()
+        
+        #Sink statistics
+        self.stats = {'tweets' : 0, 'rows' : 0, 'rowGroups' : 0, 'files' : 0}
+        
+        #Start a background thread that rolls aged files over
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target = self._RollOverAged, daemon = True)
+        self.timer.start()
+    
+    def Add(self, dataOutput, dataRelations):
+        '''
+        Add a processed tweet, writing a row group once a partition is full.
+        '''
+        
+        #Find the partition of the tweet
+        dataTweet = dataOutput[0]
+        created = dataTweet[self.createdIndex]
+        
+        if created.tzinfo is not None:
+            created = created.astimezone(timezone.utc)
+        
+        partition = (dataTweet[self.locationIndex], created.strftime('%Y-%m-%d-%H'))
+        
+        with self.lock:
+            for tableIndex, rows in enumerate(dbf._GroupStreamRows([(dataOutput, dataRelations)])):
+                if not rows:
+                    continue
+                
+                key = (tableIndex,) + partition
+                self.started.setdefault(key, time.monotonic())
+                
+                buffer = self.buffers.setdefault(key, [])
+                buffer.extend(rows)
+                
+                if len(buffer) >= self.rowGroupSize:
+                    self._WriteRowGroup(key)
+            
+            self.stats['tweets'] += 1
+    
+    def Flush(self):
+        '''
+        Write everything buffered and close every open file so it is visible.
+        '''
+        with self.lock:
+            for key in list(self.buffers):
+                self._WriteRowGroup(key)
+            
+            for key in list(self.files):
+                self._CloseFile(key)
+            
+            self.started.clear()
+    
+    def Stats(self):
+        '''
+        Return a snapshot of the sink statistics.
+        '''
+        with self.lock:
+            return(dict(self.stats, openFiles = len(self.files)))
+    
+    def Close(self):
+        '''
+        Stop the roll over thread and write everything still buffered.
+        '''
+        self.closed.set()
+        self.timer.join()
+        
+        self.Flush()
+        
+        #Add info to log
+        logger.info('Parquet Sink Statistics: %s' % self.Stats())
+    
+    def _WriteRowGroup(self, key):
+        #Take the buffered rows of the partition
+        rows = self.buffers.pop(key, None)
+        
+        if not rows:
+            return
+        
+        table, schema, converters, dictionary = self.tables[key[0]]
+        
+        #Convert the rows to columns of the table types
+        columns = []
+        
+        for index, converter in enumerate(converters):
+            values = [row[index] for row in rows]
+            
+            if converter is not None:
+                values = [None if value is None or value == '' and converter is not str
+                          else converter(value) for value in values]
+            
+            columns.append(pyarrow.array(values, type = schema.field(index).type))
+        
+        if key not in self.files:
+            self._OpenFile(key)
+        
+        handle = self.files[key]
+        
+        #Write the rows as one row group
+        handle['writer'].write_table(pyarrow.Table.from_arrays(columns, schema = schema),
+                                     row_group_size = len(rows))
+        
+        self.stats['rows'] += len(rows)
+        self.stats['rowGroups'] += 1
+        
+        #Roll over once the file is large enough
+        if os.path.getsize(handle['temporaryPath']) >= self.maxFileBytes:
+            self._CloseFile(key)
+    
+    def _OpenFile(self, key):
+        table, schema, _, dictionary = self.tables[key[0]]
+        
+        #Create the partition directory
+        partitionDirectory = os.path.join(self.directory, table, 'location=%s' % key[1], 'hour=%s' % key[2])
+        os.makedirs(partitionDirectory, exist_ok = True)
+        
+        #Name files uniquely so restarts never overwrite earlier files
+        self.sequence += 1
+        fileName = 'part-%s-%06d.parquet' % (datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S'), self.sequence)
+        
+        finalPath = os.path.join(partitionDirectory, fileName)
+        temporaryPath = os.path.join(partitionDirectory, '.' + fileName + '.tmp')
+        
+        writer = pyarrow.parquet.ParquetWriter(temporaryPath, schema,
+                                               compression = self.compression,
+                                               use_dictionary = dictionary)
+        
+        self.files[key] = {'writer' : writer, 'temporaryPath' : temporaryPath, 'finalPath' : finalPath}
+    
+    def _CloseFile(self, key):
+        handle = self.files.pop(key)
+        self.started.pop(key, None)
+        
+        #Finish the file and make it visible in one step
+        handle['writer'].close()
+        os.replace(handle['temporaryPath'], handle['finalPath'])
+        
+        self.stats['files'] += 1
+    
+    def _RollOverAged(self):
+        while not self.closed.wait(min(self.maxFileAge, 5)):
+            try:
+                with self.lock:
+                    now = time.monotonic()
+                    
+                    #Write and close the files started maxFileAge ago
+                    for key in [key for key, started in self.started.items()
+                                if now - started >= self.maxFileAge]:
+                        self._WriteRowGroup(key)
+                        
+                        if key in self.files:
+                            self._CloseFile(key)
+                        else:
+                            self.started.pop(key, None)
+            
+            except Exception:
+                #Keep rolling over on the next tick
+                logger.error('Error Rolling Over Parquet Files', exc_info = True)
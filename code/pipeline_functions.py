@@ -0,0 +1,431 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################# PIPELINE FUNCTIONS ##############################
+###############################################################################
+
+#%% Notes
+
+# 1. The pipeline decouples reading the stream from processing and writing the
+#    tweets. The stream reader only places raw payloads onto a bounded queue,
+#    and a pool of worker threads processes and writes them.
+
+# 2. When the queue is full the backpressure policy decides what happens:
+#      block : the stream reader waits for space on the queue
+#      spill : the payload is appended to a file on disk and re-queued by the
+#              workers once the queue has drained
+#      drop  : the payload is discarded and counted
+
+# 3. Tweets the writer hands back because the database is unavailable (see
+#    StreamBatchWriter) are appended to the spill file whatever the policy,
+#    and re-queued once writes have had time to recover. A spill file left by
+#    an earlier run is re-queued when the pipeline is next idle.
+
+# 4. With a WriterGroup, a tweet handed back by one writer is spilled with the
+#    index of that writer in front of the payload ("1\t{...}") and is only
+#    given to that writer again, so the writers that succeeded do not write
+#    it twice.
+
+
+#%% Required Libraries
+
+#queue: Bounded queue shared between the reader and workers
+import queue
+
+#threading: Used to run the worker pool
+import threading
+
+#os: Used to manage the spill file
+import os
+
+#time: Used to delay re-queueing tweets the writer handed back
+import time
+
+#logging: Used to create logs
+import logging
+
+
+#%% Configure logger
+
+logger = logging.getLogger(__name__)
+
+
+#%% Import Required Functions from Other Modules
+
+import processing_functions as wrangle
+import db_functions as dbf
+
+
+#%% Pipeline
+
+#Available backpressure policies
+BACKPRESSURE_POLICIES = ('block', 'spill', 'drop')
+
+#Define a class that processes and writes raw stream payloads on worker threads
+class StreamPipeline():
+    '''
+    This class accepts raw stream payloads onto a bounded queue and processes
+    them with ProcessTwitterData on a pool of worker threads, passing the
+    results to a writer (e.g. StreamBatchWriter).
+    
+    Arguments:
+        locationID   : WOEID the stream is listening on
+        writer       : object with an Add(dataOutput, dataRelations) method
+        numWorkers   : number of worker threads
+        maxQueueSize : maximum number of payloads held in memory
+        backpressure : policy when the queue is full ('block', 'spill', 'drop')
+        spillPath    : file used to hold payloads when spilling
+        parser       : optional ParallelParser used to process payloads on
+                       several processes
+        parseBatch   : maximum number of payloads a worker takes off the
+                       queue at once when using a parser
+    '''
+    
+    def __init__(self, locationID, writer, numWorkers = 2, maxQueueSize = 10000,
+                 backpressure = 'block', spillPath = 'spill.ndjson',
+                 parser = None, parseBatch = 512):
+        
+        if backpressure not in BACKPRESSURE_POLICIES:
+            #Add error to log and raise
+            logger.error('Incorrect Backpressure Policy Entered')
+            raise AttributeError('Expected one of %s but got %s' % (BACKPRESSURE_POLICIES, backpressure))
+        
+        self.locationID = locationID
+        self.writer = writer
+        self.backpressure = backpressure
+        self.spillPath = spillPath
+        self.parser = parser
+        self.parseBatch = parseBatch if parser is not None else 1
+        
+        self.queue = queue.Queue(maxsize = maxQueueSize)
+        
+        #Locks protecting the statistics, the spill file and its draining
+        self.statsLock = threading.Lock()
+        self.spillLock = threading.Lock()
+        self.unspillLock = threading.Lock()
+        
+        #Pipeline statistics
+        self.stats = {'received'  : 0,
+                      'processed' : 0,
+                      'errors'    : 0,
+                      'dropped'   : 0,
+                      'spilled'   : 0,
+                      'unwritten' : 0,
+                      'highWater' : 0}
+        
+        #Seconds to wait before re-queueing tweets the writer handed back
+        self.retryDelay = 30
+        self.unspillAt = 0
+        
+        #Start the worker pool
+        self.workers = [threading.Thread(target = self._Work, daemon = True) for _ in range(numWorkers)]
+        
+        for worker in self.workers:
+            worker.start()
+            
+        #Add info to log
+        logger.info('Started Stream Pipeline with %s Workers' % numWorkers)
+        
+    def Put(self, data):
+        '''
+        Place a raw payload onto the queue, applying the backpressure policy
+        if the queue is full.
+        '''
+        self._Count('received')
+        
+        if self.backpressure == 'block':
+            self.queue.put(data)
+            
+        else:
+            try:
+                self.queue.put_nowait(data)
+                
+            except queue.Full:
+                if self.backpressure == 'spill':
+                    self._Spill(data)
+                    self._Count('spilled')
+                else:
+                    self._Count('dropped')
+                    
+                return
+            
+        #Track the queue depth
+        depth = self.queue.qsize()
+        
+        with self.statsLock:
+            if depth > self.stats['highWater']:
+                self.stats['highWater'] = depth
+                
+    def Stats(self):
+        '''
+        Return a snapshot of the pipeline statistics.
+        '''
+        with self.statsLock:
+            stats = dict(self.stats)
+            
+        stats['depth'] = self.queue.qsize()
+        
+        #Return the statistics
+        return(stats)
+    
+    def Close(self):
+        '''
+        Process everything still queued or spilled and stop the workers.
+        '''
+        #Re-queue anything spilled to disk
+        self._Unspill(block = True)
+        
+        #Signal each worker to stop once the queue is empty
+        for _ in self.workers:
+            self.queue.put(None)
+        
+        for worker in self.workers:
+            worker.join()
+            
+        #Add pipeline statistics to the log
+        logger.info('Stream Pipeline Statistics: %s' % self.Stats())
+        
+    def _Work(self):
+        #Process payloads until told to stop
+        stopping = False
+        
+        while not stopping:
+            try:
+                data = self.queue.get(timeout = 1)
+                
+            except queue.Empty:
+                #Use idle time to re-queue spilled payloads
+                self._Unspill()
+                continue
+            
+            batch = []
+            targets = []
+            
+            #Take any further payloads already waiting, up to the batch size
+            while True:
+                if data is None:
+                    #Finish this batch then stop
+                    stopping = True
+                    break
+                    
+                #Payloads re-queued for a single writer carry its index
+                if isinstance(data, tuple):
+                    data, target = data
+                else:
+                    target = None
+                    
+                batch.append(data)
+                targets.append(target)
+                
+                if len(batch) >= self.parseBatch:
+                    break
+                
+                try:
+                    data = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                
+            if self.parser is not None:
+                try:
+                    #Extract and process the data on the parsing processes
+                    results = self.parser.Parse(batch, self.locationID)
+                except Exception:
+                    logger.error('Error Processing Stream Payload Batch', exc_info = True)
+                    results = [None] * len(batch)
+            else:
+                results = [self._Process(data) for data in batch]
+            
+            for result, target in zip(results, targets):
+                if result is None:
+                    self._Count('errors')
+                    continue
+                    
+                try:
+                    #Pass to the writer, or only the writer that handed it back
+                    if target is None:
+                        self.writer.Add(*result)
+                    else:
+                        self.writer.AddTo(target, *result)
+                        
+                except dbf.StreamWriteError as e:
+                    #Keep any tweets the writer could not hold on disk
+                    logger.error('Error Writing Stream Data, %s Tweets Spilled' % len(e.batch), exc_info = True)
+                    self._SpillUnwritten(e.batch, e.targets)
+                    
+                except Exception:
+                    #Log the error and carry on with the next payload
+                    logger.error('Error Writing Stream Payload', exc_info = True)
+                    self._Count('errors')
+                    continue
+                
+                self._Count('processed')
+                
+    def _Process(self, data):
+        try:
+            #Extract and process the data received
+            return(wrangle.ProcessTwitterData(data, self.locationID))
+        
+        except Exception:
+            #Log the error
+            logger.error('Error Processing Stream Payload', exc_info = True)
+            return(None)
+            
+    def _SpillUnwritten(self, batch, targets):
+        #Spill the raw payload of each tweet so it is processed again later
+        for (dataOutput, _), target in zip(batch, targets):
+            self._Spill(dataOutput[0][-1], target)
+            
+        self._Count('unwritten', len(batch))
+        
+        #Give the writer time to recover before re-queueing them
+        self.unspillAt = time.monotonic() + self.retryDelay
+        
+    def _Spill(self, data, target = None):
+        #Append the payload to the spill file
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+            
+        #Tag payloads that only one writer of a group still has to write
+        if target is not None:
+            data = '%s\t%s' % (target, data.strip())
+            
+        with self.spillLock:
+            with open(self.spillPath, 'a', encoding = 'utf-8') as spill:
+                spill.write(data.strip() + '\n')
+                
+    def _Unspill(self, block = False):
+        #Move spilled payloads back onto the queue
+        if not block and time.monotonic() < self.unspillAt:
+            return
+        
+        #Only one worker drains the spill file at a time
+        if not self.unspillLock.acquire(blocking = block):
+            return
+        
+        try:
+            self._Requeue(block)
+        finally:
+            self.unspillLock.release()
+            
+    def _Requeue(self, block):
+        with self.spillLock:
+            if not os.path.exists(self.spillPath):
+                return
+            
+            drainPath = self.spillPath + '.draining'
+            
+            #Take ownership of the spill file so new spills start a fresh file
+            if not os.path.exists(drainPath):
+                os.replace(self.spillPath, drainPath)
+                
+        with open(drainPath, encoding = 'utf-8') as spill:
+            lines = [line for line in spill if line.strip()]
+            
+        remaining = []
+        
+        for i, line in enumerate(lines):
+            #Payloads start with "{", tagged payloads with a writer index
+            if line[0].isdigit():
+                target, _, payload = line.partition('\t')
+                item = (payload, int(target))
+            else:
+                item = line
+                
+            try:
+                self.queue.put(item, block = block)
+            except queue.Full:
+                remaining = lines[i:]
+                break
+            
+        with self.spillLock:
+            if remaining:
+                #Keep whatever did not fit for the next idle period
+                with open(drainPath, 'w', encoding = 'utf-8') as spill:
+                    spill.writelines(remaining)
+            else:
+                os.remove(drainPath)
+            
+    def _Count(self, key, amount = 1):
+        with self.statsLock:
+            self.stats[key] += amount
+            
+            
+#%% Writer Group
+
+#Define a class that passes processed tweets to several writers
+class WriterGroup():
+    '''
+    This class lets a StreamPipeline write each processed tweet to several
+    writers, e.g. a StreamBatchWriter for the database and a ParquetSink.
+    
+    Arguments:
+        writers : objects with Add(dataOutput, dataRelations), Flush() and
+                  Close() methods
+    '''
+    
+    def __init__(self, writers):
+        self.writers = list(writers)
+        
+    def Add(self, dataOutput, dataRelations):
+        '''
+        Add a processed tweet to every writer. Tweets handed back by a writer
+        are raised in one StreamWriteError once every writer has been given
+        the tweet, with targets naming the writer of each, otherwise the first
+        error is raised.
+        '''
+        self._Add(range(len(self.writers)), dataOutput, dataRelations)
+        
+    def AddTo(self, index, dataOutput, dataRelations):
+        '''
+        Add a processed tweet to the writer at index only, e.g. when it was
+        handed back by that writer and the others have already written it.
+        '''
+        self._Add([index], dataOutput, dataRelations)
+        
+    def _Add(self, indices, dataOutput, dataRelations):
+        error = None
+        batch, targets = [], []
+        
+        for index in indices:
+            try:
+                self.writers[index].Add(dataOutput, dataRelations)
+                
+            except dbf.StreamWriteError as e:
+                #Remember which writer handed back each tweet
+                batch.extend(e.batch)
+                targets.extend([index] * len(e.batch))
+                error = e if error is None else error
+                
+            except Exception as e:
+                error = e if error is None else error
+                
+        if batch:
+            raise dbf.StreamWriteError(str(error), batch, targets) from error
+            
+        if error is not None:
+            raise error
+            
+    def Flush(self):
+        '''
+        Flush every writer.
+        '''
+        for writer in self.writers:
+            writer.Flush()
+            
+    def Close(self):
+        '''
+        Close every writer.
+        '''
+        for writer in self.writers:
+            writer.Close()
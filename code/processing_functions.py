@@ -21,25 +21,150 @@
 import json
 
 #datetime: for extracting datetimes from strings
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+#functools: for caching repeated timestamps
+import functools
 
 #logging: Used to create logs
 import logging
 
+#multiprocessing: Used to parse tweets across several cores
+import multiprocessing
+
 
 #%% Configure logger
 
 logger = logging.getLogger(__name__)
 
 
+#%% JSON Backend
+
+#Define a function to select the library used to read and write JSON
+def SetJSONBackend(backend = None):
+    '''
+    This function selects the JSON library used by LoadJSON and DumpJSON. If
+    no backend is given the fastest installed library is used, trying orjson,
+    then ujson, then the standard library json module.
+    '''
+    global JSON_BACKEND, LoadJSON, DumpJSON
+    
+    for name in ([backend] if backend else ['orjson', 'ujson', 'json']):
+        if name == 'orjson':
+            try:
+                import orjson
+            except ImportError:
+                continue
+            
+            LoadJSON = orjson.loads
+            DumpJSON = lambda obj: orjson.dumps(obj).decode('utf-8')
+            
+        elif name == 'ujson':
+            try:
+                import ujson
+            except ImportError:
+                continue
+            
+            LoadJSON = ujson.loads
+            DumpJSON = lambda obj: ujson.dumps(obj, ensure_ascii = False)
+            
+        elif name == 'json':
+            LoadJSON = json.loads
+            DumpJSON = lambda obj: json.dumps(obj, ensure_ascii = False, separators = (',', ':'))
+            
+        else:
+            #Add error to log and raise
+            logger.error('Incorrect JSON Backend Entered')
+            raise AttributeError('Expected "orjson", "ujson" or "json" but got %s' % name)
+        
+        JSON_BACKEND = name
+        
+        #Add info to log
+        logger.info('Using %s to Read JSON' % name)
+        
+        #Return the name of the backend
+        return(JSON_BACKEND)
+    
+    #Add error to log and raise
+    logger.error('JSON Backend Not Installed')
+    raise ImportError('JSON backend %s is not installed' % backend)
+    
+    
+#Select the fastest installed backend on import
+SetJSONBackend()
+
+
+#%% Timestamps
+
+#Format of the created_at timestamps used by Twitter
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+
+#Month abbreviations used in the timestamps
+_MONTHS = {'Jan' : 1, 'Feb' : 2, 'Mar' : 3, 'Apr' : 4, 'May' : 5, 'Jun' : 6,
+           'Jul' : 7, 'Aug' : 8, 'Sep' : 9, 'Oct' : 10, 'Nov' : 11, 'Dec' : 12}
+
+#UTC offsets seen so far, Twitter always uses +0000
+_TIMEZONES = {'+0000' : timezone.utc}
+
+#Define a function to parse a Twitter created_at timestamp
+def ParseTwitterTimestamp(timestamp):
+    '''
+    This function parses a timestamp such as 'Wed Oct 10 20:19:24 +0000 2018'
+    by slicing its fixed-width fields directly, which is much faster than
+    datetime.strptime. Anything not in the expected layout falls back to
+    strptime so the result is always the same.
+    '''
+    
+    try:
+        #Check the field separators are where they are expected
+        if (len(timestamp) != 30 or timestamp[13] != ':' or timestamp[16] != ':'
+                or timestamp[3] != ' ' or timestamp[7] != ' ' or timestamp[10] != ' '
+                or timestamp[19] != ' ' or timestamp[25] != ' '):
+            raise ValueError(timestamp)
+        
+        offset = timestamp[20:25]
+        
+        if offset not in _TIMEZONES:
+            #Build and store the timezone of a new offset
+            sign = -1 if offset[0] == '-' else 1
+            
+            if offset[0] not in '+-' or not offset[1:].isdigit():
+                raise ValueError(timestamp)
+            
+            _TIMEZONES[offset] = timezone(sign * timedelta(hours = int(offset[1:3]), minutes = int(offset[3:5])))
+        
+        #Build the datetime from the fixed-width fields
+        return(datetime(int(timestamp[26:30]),
+                        _MONTHS[timestamp[4:7]],
+                        int(timestamp[8:10]),
+                        int(timestamp[11:13]),
+                        int(timestamp[14:16]),
+                        int(timestamp[17:19]),
+                        tzinfo = _TIMEZONES[offset]))
+        
+    except (KeyError, ValueError):
+        #Fall back to the general parser
+        return(datetime.strptime(timestamp, TWITTER_TIME_FORMAT))
+        
+        
+#Memoised parser for user created_at timestamps, which repeat constantly
+ParseUserTimestamp = functools.lru_cache(maxsize = 65536)(ParseTwitterTimestamp)
+
+
 #%% Functions
 
 #Define a function for processing raw twitter data
 def ProcessTwitterData(data, locationID):
+    '''
+    This function extracts the tweet, user, place, entity, mention and media
+    data objects from a raw tweet. locationID is either the WOEID the stream
+    is listening on or a LocationRouter for streams over several regions, in
+    which case the tweet is assigned to every region it falls in.
+    '''
     
     try:
         #Read data as JSON
-        dataJSON = json.loads(data)
+        dataJSON = LoadJSON(data)
     except Exception as e:
         #Write error to log
         logger.error('Could Not Read JSON Data File')
@@ -47,13 +172,23 @@ def ProcessTwitterData(data, locationID):
         raise e
     
     try:
-        #Convert to string for storage
-        tweet_full_json = str(dataJSON)
+        #Store the payload exactly as it was received
+        tweet_full_json = data.decode('utf-8') if isinstance(data, bytes) else data
+        tweet_full_json = tweet_full_json.strip()
         
         #Extract tweet data
-        tweet_streamlocation = locationID
+        if hasattr(locationID, 'Route'):
+            #Find the streamed regions the tweet belongs to
+            tweet_streamlocations = locationID.Route(dataJSON)
+        elif locationID is not None:
+            tweet_streamlocations = [locationID]
+        else:
+            #No location to relate the tweet to
+            tweet_streamlocations = []
+        
+        tweet_streamlocation = tweet_streamlocations[0] if tweet_streamlocations else None
         tweet_createdstring  = dataJSON['created_at']
-        tweet_created        = datetime.strptime(tweet_createdstring, '%a %b %d %H:%M:%S %z %Y')
+        tweet_created        = ParseTwitterTimestamp(tweet_createdstring)
         tweet_id             = dataJSON['id']
         tweet_content        = dataJSON['text']
         tweet_source         = dataJSON['source']
@@ -90,7 +225,7 @@ def ProcessTwitterData(data, locationID):
         tweet_filterlevel    = dataJSON['filter_level']
         tweet_lang           = dataJSON['lang']
         tweet_mstimestamp    = dataJSON['timestamp_ms']
-        tweet_entities       = str(dataJSON['entities'])
+        tweet_entities       = DumpJSON(dataJSON['entities'])
         
         #Create Tweet Data Object
         dataTweet = (tweet_id,
@@ -176,8 +311,8 @@ def ProcessTwitterData(data, locationID):
         place_countrycode       = dataJSON['place']['country_code']
         place_country           = dataJSON['place']['country']
         place_bbox_type         = dataJSON['place']['bounding_box']['type']
-        place_bbox_coordinates  = str(dataJSON['place']['bounding_box']['coordinates'])
-        place_attributes        = str(dataJSON['place']['attributes'])
+        place_bbox_coordinates  = DumpJSON(dataJSON['place']['bounding_box']['coordinates'])
+        place_attributes        = DumpJSON(dataJSON['place']['attributes'])
         
         #Create place data object
         dataPlace = (place_id,
@@ -207,7 +342,7 @@ def ProcessTwitterData(data, locationID):
         user_numfavourites              = dataJSON['user']['favourites_count']
         user_numstatus                  = dataJSON['user']['statuses_count']
         user_joinedstring               = dataJSON['user']['created_at']
-        user_joined                     = datetime.strptime(user_joinedstring, '%a %b %d %H:%M:%S %z %Y')
+        user_joined                     = ParseUserTimestamp(user_joinedstring)
         user_utcoffset                  = dataJSON['user']['utc_offset']
         user_timezone                   = dataJSON['user']['time_zone']
         user_geoenabled                 = 1 if dataJSON['user']['geo_enabled'] == True else 0
@@ -279,11 +414,13 @@ def ProcessTwitterData(data, locationID):
         dataTweetMentions = [(tweet_id, x[0]) for x in dataUserMentions]
         dataTweetEntities = [(tweet_id, x[0], x[1]) for x in dataEntities]
         dataTweetMedia = [(tweet_id, x[0]) for x in dataMedia]
+        dataTweetLocations = [(tweet_id, x) for x in tweet_streamlocations]
         
         #Compile relationships into tuple
         dataRelations = (dataTweetMentions,
                          dataTweetEntities,
-                         dataTweetMedia)
+                         dataTweetMedia,
+                         dataTweetLocations)
     
     except Exception as e:
         #Add error to log
@@ -295,4 +432,68 @@ def ProcessTwitterData(data, locationID):
     
     #Return data objects
     return(dataOutput, dataRelations)
-    
\ No newline at end of file
+
+
+#Define a function for processing a batch of raw twitter data
+def ProcessTwitterDataBatch(dataBatch, locationID):
+    '''
+    This function processes a list of raw tweets with ProcessTwitterData. The
+    output for any tweet that could not be processed is None so that the
+    results line up with the input.
+    '''
+    
+    results = []
+    
+    for data in dataBatch:
+        try:
+            results.append(ProcessTwitterData(data, locationID))
+        except Exception:
+            #Write error to log and continue with the next tweet
+            logger.error('Could Not Process Tweet in Batch', exc_info = True)
+            results.append(None)
+            
+    #Return data objects
+    return(results)
+    
+    
+#Define a class for processing raw twitter data on several processes
+class ParallelParser():
+    '''
+    This class processes batches of raw tweets on a pool of processes so that
+    parsing is not limited to a single core. Each batch is split into chunks
+    of chunkSize tweets which are sent to the processes in one message each.
+    
+    Arguments:
+        numProcesses : number of parsing processes (default: number of cores)
+        chunkSize    : number of tweets sent to a process at a time
+    '''
+    
+    def __init__(self, numProcesses = None, chunkSize = 64):
+        self.numProcesses = numProcesses or multiprocessing.cpu_count()
+        self.chunkSize = chunkSize
+        self.pool = multiprocessing.Pool(self.numProcesses)
+        
+        #Add info to log
+        logger.info('Started Parsing Pool with %s Processes' % self.numProcesses)
+        
+    def Parse(self, dataBatch, locationID):
+        '''
+        Process a list of raw tweets, returning a list of (dataOutput,
+        dataRelations) tuples with None for any tweet that failed.
+        '''
+        
+        #Split the batch into chunks
+        chunks = [dataBatch[i:i + self.chunkSize] for i in range(0, len(dataBatch), self.chunkSize)]
+        
+        #Process the chunks across the pool
+        results = self.pool.starmap(ProcessTwitterDataBatch, [(chunk, locationID) for chunk in chunks])
+        
+        #Return the flattened results
+        return([result for chunk in results for result in chunk])
+        
+    def Close(self):
+        '''
+        Stop the parsing processes.
+        '''
+        self.pool.close()
+        self.pool.join()
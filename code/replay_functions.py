@@ -0,0 +1,432 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################### REPLAY FUNCTIONS ##############################
+###############################################################################
+
+#%% Notes
+
+# 1. A replay reads recorded stream payloads, one per line, from NDJSON files
+#    (optionally gzip or zstd compressed) and writes them with the same
+#    processing and writers as a live stream. Raw archive segments
+#    (raw-*.ndjson.gz/.zst) and spool segments (segment-*.ndjson) can be
+#    replayed as they are.
+
+# 2. Files are read and processed on several threads but written by a single
+#    thread, which records in a checkpoint how far through each file has been
+#    written. An interrupted replay resumes from the checkpoint.
+
+# 3. When paced, payloads are released at the rate they were received
+#    according to their timestamp_ms, scaled by the replay speed. Files read
+#    in parallel share one clock, so they should cover the same period.
+
+# 4. Stream messages that are not tweets (limit notices, deletions, etc.) are
+#    skipped before processing and counted.
+
+# 5. A checkpoint is only saved once writer.Flush() has written everything
+#    added before it. The writer should not also flush on its own (e.g. a
+#    StreamBatchWriter with maxAge = None) so a failed write stops the replay
+#    rather than being logged in the background.
+
+
+#%% Required Libraries
+
+#os: Used to find the files to replay
+import os
+
+#re: Used to recognise stream messages that are not tweets
+import re
+
+#gzip and io: Used to read compressed files
+import gzip
+import io
+
+#json: Used to read and write the checkpoint
+import json
+
+#threading and queue: Used to read files in parallel
+import threading
+import queue
+
+#concurrent.futures: Used to run the file readers
+import concurrent.futures
+
+#time: Used to pace the replay
+import time
+
+#logging: Used to create logs
+import logging
+
+
+#%% Configure logger
+
+logger = logging.getLogger(__name__)
+
+
+#%% Import Required Functions from Other Modules
+
+import processing_functions as wrangle
+import archive_functions as archive
+
+
+#%% Replay Files
+
+#File names that hold payloads once any compression suffix is removed
+PAYLOAD_EXTENSIONS = ('.ndjson', '.jsonl', '.json')
+
+#Stream messages that are not tweets, e.g. {"limit":{"track":5,...}}
+NOT_TWEET = re.compile(rb'\s*\{\s*"(limit|delete|scrub_geo|status_withheld|user_withheld|disconnect|warning)"')
+
+#Define a function to list the files to replay
+def ListReplayFiles(paths):
+    '''
+    This function expands a list of files and directories into the files to
+    replay. Directories contribute every NDJSON file they hold (including
+    .gz and .zst files) in name order, which is the order raw archive and
+    spool segments were written in. Files are always included as given.
+    '''
+    
+    files = []
+    
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(os.path.abspath(path))
+            continue
+        
+        for name in sorted(os.listdir(path)):
+            base = name[:-len('.gz')] if name.endswith('.gz') else name[:-len('.zst')] if name.endswith('.zst') else name
+            
+            #Skip hidden files, indexes, checkpoints and spool dead letters
+            if (name.startswith('.') or 'checkpoint' in name or name.startswith('dead-letter')
+                or not base.endswith(PAYLOAD_EXTENSIONS)):
+                continue
+            
+            files.append(os.path.abspath(os.path.join(path, name)))
+    
+    #Return the files
+    return(files)
+
+
+#Define a function to open a file to replay
+def OpenReplayFile(path):
+    '''
+    This function opens a file to replay for reading bytes, decompressing
+    .gz and .zst files (including files of several concatenated frames).
+    '''
+    
+    if path.endswith('.gz'):
+        return(gzip.open(path, 'rb'))
+    
+    if path.endswith('.zst'):
+        if archive.zstandard is None:
+            #Add error to log and raise
+            logger.error('zstandard Is Required to Replay zstd Files')
+            raise ImportError('zstandard is required to replay zstd files')
+        
+        reader = archive.zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames = True,
+                                                                     closefd = True)
+        return(io.BufferedReader(reader))
+    
+    #Return the file
+    return(open(path, 'rb'))
+
+
+#%% Replay Clock
+
+#Define a class that paces payloads by their timestamp
+class ReplayClock():
+    '''
+    This class releases payloads at the rate they were received, speed times
+    faster. The first payload with a timestamp sets the start of the clock.
+    '''
+    
+    def __init__(self, speed):
+        self.speed = speed
+        self.origin = None
+        self.lock = threading.Lock()
+    
+    def Delay(self, timestampMs):
+        '''
+        Return the seconds to wait before releasing a payload.
+        '''
+        with self.lock:
+            if self.origin is None:
+                self.origin = (time.monotonic(), timestampMs)
+        
+        start, first = self.origin
+        
+        #Return the delay
+        return(start + (timestampMs - first) / 1000 / self.speed - time.monotonic())
+
+
+#%% Stream Replay
+
+#Define a class that replays recorded stream files through the writers
+class StreamReplay():
+    '''
+    This class replays recorded stream payloads into a writer (e.g. a
+    StreamBatchWriter, ParquetSink or WriterGroup), processing them with
+    ProcessTwitterData as a live stream does.
+    
+    Arguments:
+        paths              : files and directories to replay (see
+                             ListReplayFiles)
+        locationID         : WOEID or LocationRouter the tweets are stored
+                             against
+        writer             : writer the processed tweets are added to
+        checkpointPath     : filepath of the checkpoint
+        speed              : 0 to replay as fast as possible, otherwise the
+                             multiple of real time to replay at
+        numWorkers         : number of files read at once
+        batchSize          : number of payloads processed at once
+        parser             : optional ParallelParser used to process payloads
+        checkpointEvery    : payloads written between checkpoints
+        checkpointInterval : seconds between checkpoints
+    '''
+    
+    def __init__(self, paths, locationID, writer, checkpointPath = 'replay-checkpoint.json', speed = 0,
+                 numWorkers = 2, batchSize = 500, parser = None, checkpointEvery = 10000,
+                 checkpointInterval = 5.0):
+        self.files = ListReplayFiles(paths)
+        self.locationID = locationID
+        self.writer = writer
+        self.checkpointPath = checkpointPath
+        self.clock = ReplayClock(speed) if speed > 0 else None
+        self.numWorkers = numWorkers
+        self.batchSize = batchSize
+        self.parser = parser
+        self.checkpointEvery = checkpointEvery
+        self.checkpointInterval = checkpointInterval
+        
+        #Resume from the last checkpoint
+        self.positions = self._LoadCheckpoint()
+        
+        #Processed batches waiting to be written
+        self.queue = queue.Queue(maxsize = numWorkers * 4)
+        self.stopped = threading.Event()
+        
+        #Replay statistics
+        self.stats = {'files' : 0, 'payloads' : 0, 'written' : 0, 'errors' : 0, 'skipped' : 0, 'checkpoints' : 0}
+        self.statsLock = threading.Lock()
+    
+    def Run(self):
+        '''
+        Replay every file not finished in the checkpoint and return the
+        replay statistics.
+        '''
+        pending = [path for path in self.files if not self.positions.get(path, {}).get('done')]
+        
+        #Add info to log
+        logger.info('Replaying %s of %s Files' % (len(pending), len(self.files)))
+        
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.numWorkers)
+        
+        for path in pending:
+            executor.submit(self._Read, path, self.positions.get(path, {}).get('offset', 0))
+        
+        try:
+            remaining = len(pending)
+            unsaved = 0
+            lastCheckpoint = time.monotonic()
+            
+            while remaining:
+                path, offset, results, error = self.queue.get()
+                
+                if error is not None:
+                    #Add error to log and raise
+                    logger.error('Error Replaying %s' % path)
+                    raise error
+                
+                if offset is None:
+                    #The file has been read to the end
+                    self.positions[path] = dict(self.positions.get(path, {}), done = True)
+                    self.stats['files'] += 1
+                    remaining -= 1
+                    continue
+                
+                #Add the processed tweets to the writer
+                for result in results:
+                    if result is None:
+                        self.stats['errors'] += 1
+                    else:
+                        self.writer.Add(*result)
+                
+                self.positions[path] = {'offset' : offset, 'done' : False}
+                self.stats['payloads'] += len(results)
+                unsaved += len(results)
+                
+                #Periodically write what has been added and record it
+                if unsaved >= self.checkpointEvery or time.monotonic() - lastCheckpoint >= self.checkpointInterval:
+                    self._Checkpoint()
+                    unsaved = 0
+                    lastCheckpoint = time.monotonic()
+            
+            self._Checkpoint()
+        
+        finally:
+            #Stop the readers, unblocking any waiting for space
+            self.stopped.set()
+            
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            
+            executor.shutdown(wait = True)
+        
+        #Add replay statistics to the log
+        logger.info('Replay Statistics: %s' % self.stats)
+        
+        #Return the statistics
+        return(self.Stats())
+    
+    def Stats(self):
+        '''
+        Return a snapshot of the replay statistics.
+        '''
+        with self.statsLock:
+            return(dict(self.stats))
+    
+    def Close(self):
+        '''
+        Stop any files still being read. Tweets added since the last
+        checkpoint are written when the writer is closed and replayed again
+        if the replay is resumed.
+        '''
+        self.stopped.set()
+    
+    def _Read(self, path, offset):
+        #Read, pace and process the payloads of a file from an offset
+        try:
+            handle = OpenReplayFile(path)
+            
+            try:
+                self._Skip(handle, offset)
+                
+                lines = []
+                
+                while not self.stopped.is_set():
+                    try:
+                        line = handle.readline()
+                    except EOFError:
+                        #The file was cut short, e.g. by a crash while archiving
+                        logger.warning('Replay File %s Ended Unexpectedly' % path)
+                        break
+                    
+                    if not line:
+                        break
+                    
+                    if self.clock is not None and line.strip():
+                        _, timestampMs = archive.PayloadKeys(line)
+                        delay = self.clock.Delay(timestampMs) if timestampMs else 0
+                        
+                        if delay > 0:
+                            #Release what is waiting before pausing
+                            self._Dispatch(path, offset, lines)
+                            lines = []
+                            
+                            if self.stopped.wait(delay):
+                                break
+                    
+                    offset += len(line)
+                    
+                    if NOT_TWEET.match(line):
+                        #Skip limit notices, deletions and other messages
+                        with self.statsLock:
+                            self.stats['skipped'] += 1
+                            
+                    elif line.strip():
+                        lines.append(line)
+                    
+                    if len(lines) >= self.batchSize:
+                        self._Dispatch(path, offset, lines)
+                        lines = []
+                
+                self._Dispatch(path, offset, lines)
+            
+            finally:
+                handle.close()
+            
+            if not self.stopped.is_set():
+                #Mark the file finished
+                self._Put((path, None, [], None))
+        
+        except Exception as e:
+            self._Put((path, offset, [], e))
+    
+    def _Dispatch(self, path, offset, lines):
+        if not lines:
+            return
+        
+        #Process the payloads
+        if self.parser is not None:
+            results = self.parser.Parse(lines, self.locationID)
+        else:
+            results = wrangle.ProcessTwitterDataBatch(lines, self.locationID)
+        
+        self._Put((path, offset, results, None))
+    
+    def _Put(self, item):
+        #Wait for space unless the replay has stopped
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                continue
+    
+    @staticmethod
+    def _Skip(handle, offset):
+        #Move past what has already been replayed
+        if offset and handle.seekable():
+            handle.seek(offset)
+            return
+        
+        while offset > 0:
+            chunk = handle.read(min(offset, 1024 * 1024))
+            
+            if not chunk:
+                break
+            
+            offset -= len(chunk)
+    
+    def _Checkpoint(self):
+        #Write everything added before recording it as replayed
+        self.writer.Flush()
+        
+        self.stats['written'] = self.stats['payloads'] - self.stats['errors']
+        self._SaveCheckpoint()
+        self.stats['checkpoints'] += 1
+    
+    def _LoadCheckpoint(self):
+        if not os.path.exists(self.checkpointPath):
+            return({})
+        
+        with open(self.checkpointPath) as checkpoint:
+            positions = json.load(checkpoint)['files']
+        
+        #Add info to log
+        logger.info('Resuming Replay from Checkpoint %s' % self.checkpointPath)
+        
+        #Return the position in every file
+        return(positions)
+    
+    def _SaveCheckpoint(self):
+        #Write the checkpoint atomically
+        temporaryPath = self.checkpointPath + '.tmp'
+        
+        with open(temporaryPath, 'w') as checkpoint:
+            json.dump({'files' : self.positions}, checkpoint, indent = 1)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        
+        os.replace(temporaryPath, self.checkpointPath)
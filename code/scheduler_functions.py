@@ -0,0 +1,138 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################# SCHEDULER FUNCTIONS #############################
+###############################################################################
+
+#%% Notes
+
+# 1. The scheduler runs a job at a fixed interval inside a long running
+#    process, replacing a cronjob that starts a new process for every run.
+
+# 2. Run times are calculated from when the scheduler started rather than
+#    from when the last run finished, so the schedule does not drift. If a run
+#    is still going when the next one is due, the next run is skipped.
+
+
+#%% Required Libraries
+
+#threading: Used to run the job without blocking the schedule
+import threading
+
+#time: Used to time the schedule
+import time
+
+#logging: Used to create logs
+import logging
+
+
+#%% Configure logger
+
+logger = logging.getLogger(__name__)
+
+
+#%% Scheduler
+
+#Define a class for running a job at a fixed interval
+class PeriodicScheduler():
+    '''
+    This class runs a job every interval seconds on a background thread,
+    correcting for drift and skipping runs that would overlap a run still in
+    progress.
+    
+    Arguments:
+        job      : function called with no arguments on each run
+        interval : seconds between runs
+        align    : start runs on whole multiples of the interval in clock
+                   time (e.g. on the 5 minutes for an interval of 300)
+    '''
+    
+    def __init__(self, job, interval = 300, align = True):
+        self.job = job
+        self.interval = interval
+        self.align = align
+        
+        self.running = threading.Lock()
+        self.stopped = threading.Event()
+        
+        #Scheduler statistics
+        self.stats = {'runs'         : 0,
+                      'failures'     : 0,
+                      'skipped'      : 0,
+                      'lastDuration' : None,
+                      'maxLateness'  : 0.0}
+        
+    def Run(self, maxRuns = None):
+        '''
+        Run the schedule until Stop is called or maxRuns runs have started.
+        '''
+        start = time.monotonic()
+        
+        if self.align:
+            #Delay the first run to the next whole interval
+            start += -time.time() % self.interval
+            
+        tick = 0
+        started = 0
+        
+        while not self.stopped.is_set() and (maxRuns is None or started < maxRuns):
+            #Wait until the run is due
+            due = start + tick * self.interval
+            
+            if self.stopped.wait(max(0, due - time.monotonic())):
+                break
+            
+            lateness = time.monotonic() - due
+            self.stats['maxLateness'] = max(self.stats['maxLateness'], lateness)
+            
+            if self.running.acquire(blocking = False):
+                #Start the run in the background
+                threading.Thread(target = self._RunJob, daemon = True).start()
+                started += 1
+            else:
+                #Skip the run rather than overlap the previous one
+                self.stats['skipped'] += 1
+                logger.warning('Previous Scheduled Run Still in Progress - Skipping Run')
+                
+            #Move to the next due time, skipping any that have already passed
+            tick = int((time.monotonic() - start) // self.interval) + 1
+            
+        #Wait for the last run to finish
+        with self.running:
+            pass
+        
+        #Add scheduler statistics to the log
+        logger.info('Scheduler Statistics: %s' % self.stats)
+        
+    def Stop(self):
+        '''
+        Stop the schedule after the current run.
+        '''
+        self.stopped.set()
+        
+    def _RunJob(self):
+        began = time.monotonic()
+        
+        try:
+            self.job()
+            self.stats['runs'] += 1
+            
+        except Exception:
+            #Log the error and keep the schedule going
+            logger.error('Scheduled Run Failed', exc_info = True)
+            self.stats['failures'] += 1
+            
+        finally:
+            self.stats['lastDuration'] = time.monotonic() - began
+            self.running.release()
@@ -23,6 +23,24 @@ import tweepy
 #time: for initiating system delays
 import time
 
+#random: for adding jitter to reconnect delays
+import random
+
+#threading: for storing limit notices without blocking the stream
+import threading
+
+#datetime: for timestamping limit notices
+from datetime import datetime, timezone
+
+#collections: for tracking the requests in the rate limit window
+import collections
+
+#concurrent.futures: for requesting trends concurrently
+import concurrent.futures
+
+#urllib3: for catching dropped stream connections
+import urllib3
+
 #logging: Used to create logs
 import logging
 
@@ -35,8 +53,10 @@ logger = logging.getLogger(__name__)
 #%% Import Required Functions from Other Modules
 
 import authentication_functions as axf
-import processing_functions as wrangle
 import db_functions as dbf
+import pipeline_functions as pipe
+import storage_functions as stor
+import processing_functions as wrangle
 
 
 #%% API Activation
@@ -53,10 +73,9 @@ def StartAPI(credJSON = 'credentials.json'):
     auth = tweepy.OAuthHandler(twitAppKey, twitAppSecret)
     auth.set_access_token(twitKey, twitSecret)
     
-    #Create an API object
-    api = tweepy.API(auth,
-                     wait_on_rate_limit = True,
-                     wait_on_rate_limit_notify = False)
+    #Create an API object, trend requests are kept within the rate limit by a
+    #RateBudget rather than tweepy sleeping on the request threads
+    api = tweepy.API(auth)
     
     try:
         #Verify the API credentials
@@ -105,42 +124,352 @@ def GetTrends(api, locationID):
     return(trends)
 
 
+#Define a class for keeping API calls within a rate limit
+class RateBudget():
+    '''
+    This class spaces calls to an API endpoint so that no more than calls
+    requests are made in any window of period seconds. Acquire blocks until a
+    request can be made without exceeding the limit, so the API never needs
+    to wait on the rate limit itself. Seed takes the requests already made in
+    the current window, e.g. by an earlier run, from the API.
+    
+    Arguments:
+        calls  : number of requests allowed per window (trends/place allows 75)
+        period : length of the window in seconds (trends/place uses 15 minutes)
+    '''
+    
+    def __init__(self, calls = 75, period = 15 * 60):
+        self.calls = calls
+        self.period = period
+        
+        #Times of the requests made in the current window
+        self.history = collections.deque()
+        self.lock = threading.Lock()
+        
+    def Acquire(self):
+        '''
+        Wait until a request is within the budget and record it.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                
+                #Forget requests older than the window
+                while self.history and now - self.history[0] >= self.period:
+                    self.history.popleft()
+                    
+                if len(self.history) < self.calls:
+                    self.history.append(now)
+                    return
+                
+                #Wait until the oldest request leaves the window
+                delay = self.period - (now - self.history[0])
+                
+            logger.info('Trend Request Budget Used - Waiting %.0f Seconds' % delay)
+            time.sleep(delay)
+            
+    def Seed(self, api, resource = 'trends', endpoint = '/trends/place'):
+        '''
+        Set the budget from the remaining requests and reset time reported
+        by the API for an endpoint. If the status cannot be read, a warning
+        is logged and the budget is left as it is.
+        '''
+        try:
+            #Read the rate limit of the endpoint
+            status = api.rate_limit_status(resources = resource)
+            limit = status['resources'][resource][endpoint]
+            
+        except Exception:
+            logger.warning('Could Not Read the Rate Limit of %s' % endpoint, exc_info = True)
+            return
+            
+        with self.lock:
+            now = time.monotonic()
+            self.calls = limit['limit']
+            
+            #Record the requests already made so they leave the window at the reset
+            used = max(limit['limit'] - limit['remaining'], 0)
+            made = now - self.period + max(limit['reset'] - time.time(), 0)
+            
+            self.history = collections.deque([made] * used)
+            
+        logger.info('Trend Request Budget Seeded - %s of %s Requests Remaining' % (limit['remaining'], limit['limit']))
+            
+            
+#Define a function to get the trends of many locations at once
+def GetTrendsBatch(api, locationIDs, maxWorkers = 4, budget = None):
+    '''
+    This function obtains the trends of several locations concurrently on a
+    bounded pool of threads, scheduling the requests within the trends/place
+    rate limit.
+    
+    Arguments:
+        api         : Connection to Twitter API
+        locationIDs : list of WOEIDs
+        maxWorkers  : number of requests made at once
+        budget      : RateBudget shared between runs (default 75 per 15 min)
+        
+    Returns a list of trends dictionaries in the order of locationIDs. Any
+    location whose request fails is logged and left out.
+    '''
+    
+    budget = budget if budget is not None else RateBudget()
+    
+    def GetLocationTrends(locationID):
+        #Wait for the rate limit then request the trends
+        budget.Acquire()
+        
+        try:
+            return(GetTrends(api, locationID))
+        except Exception:
+            logger.error('Skipping Trends for WOEID %s' % locationID)
+            return(None)
+        
+    with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+        trends = list(executor.map(GetLocationTrends, locationIDs))
+        
+    #Add info to log
+    logger.info('Obtained Trends for %s of %s Locations' % (sum(x is not None for x in trends), len(locationIDs)))
+    
+    #Return the trends that were obtained
+    return([x for x in trends if x is not None])
+    
+
+#Define a class for recording the stream's limit notices
+class LimitMonitor():
+    '''
+    This class records limit notices, which report how many matching tweets
+    Twitter has withheld from the stream since it connected, as the number of
+    undelivered tweets per time window. Each closed window is written to the
+    stream_limits table on a background thread so the stream keeps reading.
+    Windows are closed by a timer once they end, so the last window of a
+    period of limiting is recorded without waiting for another notice.
+    
+    Arguments:
+        locationID     : WOEID the stream is listening on
+        dbPool         : DBConnectionPool used to store the windows (None to
+                         only log them)
+        windowSeconds  : length of each window
+        alertThreshold : undelivered tweets in a window that counts as limited
+        alertWindows   : consecutive limited windows that trigger the alert
+        alertHook      : function called as alertHook(locationID, windows)
+                         when limiting is sustained (default logs a warning)
+    '''
+    
+    def __init__(self, locationID, dbPool = None, windowSeconds = 60, alertThreshold = 100,
+                 alertWindows = 5, alertHook = None):
+        self.locationID = locationID
+        self.dbPool = dbPool
+        self.windowSeconds = windowSeconds
+        self.alertThreshold = alertThreshold
+        self.alertWindows = alertWindows
+        self.alertHook = alertHook if alertHook is not None else self._LogAlert
+        
+        self.addLimitData = dbf.GenerateSQLInsert('limits')
+        
+        #Undelivered count reported by the last notice on this connection
+        self.lastTrack = 0
+        
+        #Current window as [start, notices, undelivered]
+        self.window = None
+        
+        #Recent limited windows in the current streak
+        self.streak = []
+        
+        self.stats = {'notices' : 0, 'undelivered' : 0, 'alerts' : 0}
+        
+        #Lock protecting the window, shared with the timer
+        self.lock = threading.Lock()
+        
+        #Start a background thread that closes windows once they end
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target = self._CloseDue, daemon = True)
+        self.timer.start()
+        
+    def Record(self, track):
+        '''
+        Record a limit notice reporting track undelivered tweets.
+        '''
+        now = time.time()
+        
+        with self.lock:
+            #The count restarts from zero on each connection
+            undelivered = track - self.lastTrack if track >= self.lastTrack else track
+            self.lastTrack = track
+            
+            if self.window is not None and now >= self.window[0] + self.windowSeconds:
+                self._CloseWindow(now)
+                
+            if self.window is None:
+                #Start the window on a whole multiple of the window length
+                self.window = [now - now % self.windowSeconds, 0, 0]
+                
+            self.window[1] += 1
+            self.window[2] += undelivered
+            
+            self.stats['notices'] += 1
+            self.stats['undelivered'] += undelivered
+        
+    def Reset(self):
+        '''
+        Restart the undelivered count for a new connection.
+        '''
+        with self.lock:
+            self.lastTrack = 0
+            
+    def Close(self):
+        '''
+        Stop the timer and close the current window.
+        '''
+        self.closed.set()
+        self.timer.join()
+        
+        with self.lock:
+            if self.window is not None:
+                self._CloseWindow(time.time())
+                
+        #Add limit statistics to the log
+        logger.info('Stream Limit Statistics: %s' % self.stats)
+        
+    def _CloseDue(self):
+        #Close the current window once it has ended
+        while not self.closed.wait(min(self.windowSeconds / 4, 5)):
+            with self.lock:
+                if self.window is not None and time.time() >= self.window[0] + self.windowSeconds:
+                    self._CloseWindow(time.time())
+                    
+    def _CloseWindow(self, now):
+        start, notices, undelivered = self.window
+        end = start + self.windowSeconds
+        self.window = None
+        
+        #Add info to log
+        logger.info('Stream Limited: %s Tweets Undelivered in %s Notices' % (undelivered, notices))
+        
+        #Store the window bounds as naive UTC like the other datetime columns
+        row = (self.locationID,
+               datetime.fromtimestamp(start, timezone.utc).replace(tzinfo = None),
+               datetime.fromtimestamp(end, timezone.utc).replace(tzinfo = None),
+               notices,
+               undelivered)
+        
+        if self.dbPool is not None:
+            #Store the window without blocking the stream
+            threading.Thread(target = self._Write, args = (row,), daemon = True).start()
+            
+        #Track consecutive limited windows
+        if undelivered < self.alertThreshold:
+            self.streak.clear()
+            
+        elif self.streak and self.streak[-1][0] != start - self.windowSeconds:
+            #Not consecutive with the last limited window
+            self.streak.clear()
+            self.streak.append((start, notices, undelivered))
+            
+        else:
+            self.streak.append((start, notices, undelivered))
+            
+        #Alert once per streak when it reaches alertWindows
+        if len(self.streak) == self.alertWindows:
+            self.stats['alerts'] += 1
+            
+            try:
+                self.alertHook(self.locationID, list(self.streak))
+            except Exception:
+                logger.error('Error Calling Stream Limit Alert Hook', exc_info = True)
+                
+    def _Write(self, row):
+        try:
+            with self.dbPool.Connection() as (cnx, cursor):
+                cursor.execute(self.addLimitData, row)
+                cnx.commit()
+                
+        except Exception:
+            logger.error('Error Writing Stream Limit Data to the Database', exc_info = True)
+            
+    def _LogAlert(self, locationID, windows):
+        #Default alert hook
+        logger.warning('Stream for WOEID %s Limited for %s Consecutive Windows: %s Tweets Undelivered'
+                       % (locationID, len(windows), sum(window[2] for window in windows)))
+        
+
 #Define a class for streaming the tweets 
 class StreamListener(tweepy.StreamListener):
-    def __init__(self, api, credentialsDB, locationID, addStreamData):
+    def __init__(self, api, credentialsDB, locationID, addStreamData, dbPool = None, writer = None, pipeline = None,
+                 limitMonitor = None):
         self.api = api
         self.me = api.me()
         self.credentialsDB = credentialsDB
         self.locationID = locationID
         self.addStreamData = addStreamData
         
+        #Borrow connections from a long-lived pool rather than per tweet, no
+        #database is used when there are no credentials
+        if dbPool is None and credentialsDB is not None:
+            dbPool = dbf.DBConnectionPool(credentialsDB, poolSize = 1)
+            
+        self.dbPool = dbPool
+        
+        #Process and write tweets off the stream reading thread, either with
+        #a StreamPipeline or by spooling them to disk with a StreamSpool
+        if pipeline is None:
+            #Buffer tweets and write them to the DB in batches
+            writer = writer if writer is not None else dbf.StreamBatchWriter(stor.MySQLBackend(self.dbPool))
+            pipeline = pipe.StreamPipeline(locationID, writer)
+            
+        self.pipeline = pipeline
+        
+        #Record limit notices rather than pausing the stream, notices are not
+        #attributed to a single WOEID when streaming several regions
+        if limitMonitor is None:
+            limitMonitor = LimitMonitor(None if hasattr(locationID, 'Route') else locationID, self.dbPool)
+            
+        self.limitMonitor = limitMonitor
+        
+        #Connection statistics
+        self.stats = {'connects' : 0, 'disconnects' : 0, 'downtime' : 0.0}
+        self.connectedSince = None
+        self.disconnectedAt = None
+        self.lastStatus = None
+        
     def on_connect(self):
         logger.info('Connected to Twitter Stream')
         
-    def on_data(self, data):
-        #Extract and process the data received
-        dataOutput, dataRelations = wrangle.ProcessTwitterData(data, self.locationID)
+        self.stats['connects'] += 1
+        self.connectedSince = time.monotonic()
         
-        #Connect to the database
-        cnx, cursor = dbf.Connect2DB(self.credentialsDB)
+        #Limit notices count from zero on each connection
+        self.limitMonitor.Reset()
         
-        try:
-            #Write to DB
-            dbf.WriteStreamData2DB(cnx, cursor, self.addStreamData, dataOutput, dataRelations)
+        if self.disconnectedAt is not None:
+            #Add the gap since the last disconnect to the downtime
+            self.stats['downtime'] += self.connectedSince - self.disconnectedAt
+            self.disconnectedAt = None
             
-        except Exception as e:
-            #Close the connection
-            dbf.CloseDBConnection(cnx, cursor)
+    def Disconnected(self):
+        '''
+        Record that the stream has disconnected.
+        '''
+        if self.disconnectedAt is None:
+            self.stats['disconnects'] += 1
+            self.disconnectedAt = time.monotonic()
             
-            #Raise the error
-            raise(e)
-
-        #Close the connection
-        dbf.CloseDBConnection(cnx, cursor)
+            #Add info to log
+            logger.info('Stream Connection Statistics: %s' % self.stats)
+            
+        self.connectedSince = None
+        
+    def on_data(self, data):
+        #Limit notices are not tweets so handle them here
+        if data[:8] == '{"limit"':
+            return(self.on_limit(wrangle.LoadJSON(data)['limit']['track']))
+        
+        #Queue the raw data for the pipeline workers
+        self.pipeline.Put(data)
         
-    def on_limit(self, status):
-        #Sleep for 15 minutes
-        time.sleep(15 * 60)
+    def on_limit(self, track):
+        #Record the number of undelivered tweets
+        self.limitMonitor.Record(track)
         
         #Keep the stream open
         return(True)
@@ -149,52 +478,105 @@ class StreamListener(tweepy.StreamListener):
         #Write the status to the log
         logger.error(status)
         
+        #Keep the status to choose the reconnect backoff
+        self.lastStatus = status
+        
         #Close the stream
         return(False)
         
 
 #Define a function to listen for tweets at a given area
-def StreamTweets(api, auth, bbox, credentialsDB, locationID, addStreamData):
+def StreamTweets(api, auth, bbox, credentialsDB, locationID, addStreamData, dbPool = None, writer = None,
+                 pipeline = None, maxRetries = None):
     '''
-    This function listens for tweets that match a given criteria.
+    This function listens for tweets that match a given criteria, reconnecting
+    with exponential backoff and jitter whenever the stream disconnects. The
+    same listener, connections and buffers are used across reconnects.
     
     Arguments:
         api     : Connection to Twitter API
         auth    : Authentication details for the twitter API
         bbox    : Geographical coordinate bounding box as list of coordinates
-                  For example; [minLon, minLat, maxLon, maxLat]
+                  For example; [minLon, minLat, maxLon, maxLat], or several
+                  bounding boxes one after another
+        locationID : WOEID, or LocationRouter when streaming several regions
+        dbPool  : Database connection pool shared across reconnects
+        writer  : StreamBatchWriter shared across reconnects
+        pipeline: StreamPipeline or StreamSpool shared across reconnects
+        maxRetries : number of consecutive failed reconnects before giving up
+                     (None = never give up)
     
-    Note that this function is recurrsive and will return a runtime error when
-    the recursive depth limit has been reached.
+    The number of connects and disconnects and the cumulative seconds spent
+    disconnected are written to the log on every disconnect.
     '''
-
+    
+    #Instantiate Stream Listener once for all connections
+    streamListener = StreamListener(api, credentialsDB, locationID, addStreamData, dbPool, writer, pipeline)
+    twitterStream = tweepy.Stream(auth, streamListener)
+    
+    #Number of reconnect attempts since the stream was last connected
+    attempts = 0
+    
     try:
-        #Instantiate Stream Listener
-        streamListener = StreamListener(api, credentialsDB, locationID, addStreamData)
-        twitterStream = tweepy.Stream(auth, streamListener)
-        
-        #Run the stream filtering on location
-        twitterStream.filter(locations = bbox)
+        while True:
+            try:
+                #Run the stream filtering on location
+                logger.info('Stream Started')
+                twitterStream.filter(locations = bbox)
+                
+                #The stream was closed by on_error
+                error = 'HTTP Error %s' % streamListener.lastStatus
+                
+            except (tweepy.TweepError, OSError, urllib3.exceptions.HTTPError) as e:
+                #Log the error and reconnect
+                logger.error('Stream Disconnected', exc_info = True)
+                error = repr(e)
+                
+            if streamListener.connectedSince is not None:
+                #Connected since the last failure so start the backoff again
+                attempts = 0
+                
+            streamListener.Disconnected()
+            
+            if maxRetries is not None and attempts >= maxRetries:
+                #Add error to log and raise
+                logger.error('Stream Failed to Reconnect After %s Attempts' % attempts)
+                raise ConnectionError('Stream failed to reconnect after %s attempts: %s' % (attempts, error))
+            
+            #Wait before reconnecting
+            delay = ReconnectDelay(attempts, streamListener.lastStatus)
+            logger.info('Reconnecting to Twitter Stream in %.1f Seconds (%s)' % (delay, error))
+            time.sleep(delay)
+            
+            attempts += 1
+            streamListener.lastStatus = None
+            
+    finally:
+        #Close the current limit window
+        streamListener.limitMonitor.Close()
         
-        logger.info('Stream Started')
+        #Add the connection statistics to the log
+        logger.info('Stream Connection Statistics: %s' % streamListener.stats)
+
+
+#Define a function to calculate the delay before reconnecting to the stream
+def ReconnectDelay(attempts, status = None):
+    '''
+    This function returns the seconds to wait before the next reconnect,
+    following Twitter's guidance: back off exponentially from 1 minute after
+    rate limiting (HTTP 420/429), from 5 seconds after other HTTP errors and
+    from 0.25 seconds after network errors. Random jitter spreads reconnects
+    from several processes apart.
+    '''
+    
+    if status in (420, 429):
+        base, cap = 60, 960
+    elif status is not None:
+        base, cap = 5, 320
+    else:
+        base, cap = 0.25, 16
         
-    except Exception as e:
-        #If a stream error
-        if isinstance(e,tweepy.TweepError):
-            #Start streaming again
-            StreamTweets(api, auth, bbox, credentialsDB, locationID, addStreamData)
-       #If maximum recursion reached
-        elif isinstance(e, RuntimeError):
-            #Log the error
-            logger.error('Maximum Recursion Reached on Attempting to Restart Stream', exc_info = True)
-            #Raise the error
-            raise e
-       #Otherwise
-        else:
-            #Log the error
-            logger.error('Unknown Problem Restarting Stream on Failue', exc_info = True)
-            #Raise the error
-            raise e
-            
-    #Return true to maintain the stream
-    return(True)
\ No newline at end of file
+    delay = min(cap, base * 2 ** attempts)
+    
+    #Return the delay with jitter
+    return(delay * random.uniform(0.5, 1))
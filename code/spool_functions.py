@@ -0,0 +1,364 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################### SPOOL FUNCTIONS ###############################
+###############################################################################
+
+#%% Notes
+
+# 1. The spool is an append-only log of raw stream payloads kept on local disk.
+#    Every payload is written to the spool before anything else happens to it,
+#    so tweets are not lost if the database is slow or unavailable.
+
+# 2. The spool is split into numbered segment files. A drainer thread reads
+#    the segments in order, writes the tweets to the database and records how
+#    far it has got in a checkpoint file. Fully drained segments are deleted.
+
+# 3. On restart anything after the checkpoint is replayed, so a tweet may be
+#    written twice but never lost. The INSERT IGNORE/REPLACE/upsert statements
+#    make the replay harmless.
+
+# 4. Only transient write errors (lost connections, lock timeouts) are retried.
+#    A batch that fails for any other reason is split in half until the
+#    payloads that cannot be written are found, which are appended to
+#    dead-letter.ndjson so the drainer can move past them. Payloads that
+#    cannot be processed are appended there too.
+
+
+#%% Required Libraries
+
+#os: Used to manage the segment files
+import os
+
+#json: Used to store the checkpoint
+import json
+
+#threading: Used to run the drainer
+import threading
+
+#time: Used to schedule fsyncs and retries
+import time
+
+#logging: Used to create logs
+import logging
+
+
+#%% Configure logger
+
+logger = logging.getLogger(__name__)
+
+
+#%% Import Required Functions from Other Modules
+
+import processing_functions as wrangle
+
+
+#%% Spool
+
+#Define a class for spooling raw stream payloads to disk before writing them
+class StreamSpool():
+    '''
+    This class appends raw stream payloads to segment files on disk and drains
+    them into the database on a background thread.
+    
+    Arguments:
+        directory     : directory holding the segments and checkpoint
+        locationID    : WOEID the stream is listening on
+        backend       : StorageBackend the payloads are drained into
+        segmentBytes  : size at which a new segment is started
+        batchSize     : maximum number of payloads drained per transaction
+        fsyncInterval : seconds between forcing the segment to disk
+        parser        : optional ParallelParser used to process payloads
+    '''
+    
+    def __init__(self, directory, locationID, backend, segmentBytes = 64 * 1024 * 1024,
+                 batchSize = 500, fsyncInterval = 1.0, parser = None):
+        self.directory = directory
+        self.locationID = locationID
+        self.backend = backend
+        self.segmentBytes = segmentBytes
+        self.batchSize = batchSize
+        self.fsyncInterval = fsyncInterval
+        self.parser = parser
+        
+        os.makedirs(directory, exist_ok = True)
+        
+        #Resume from the last checkpoint
+        self.checkpointPath = os.path.join(directory, 'checkpoint.json')
+        self.deadLetterPath = os.path.join(directory, 'dead-letter.ndjson')
+        self.readSegment, self.readOffset = self._LoadCheckpoint()
+        
+        #Always append to a new segment after any existing ones
+        existing = self._Segments()
+        self.writeSegment = max(existing + [self.readSegment - 1]) + 1
+        self.writeFile = open(self._SegmentPath(self.writeSegment), 'ab')
+        self.lastSync = time.monotonic()
+        
+        if existing:
+            #Add info to log
+            logger.info('Replaying %s Spool Segments from Checkpoint' % len(existing))
+        
+        #Lock protecting the segment being written
+        self.lock = threading.Lock()
+        
+        #Spool statistics
+        self.stats = {'appended' : 0, 'drained' : 0, 'errors' : 0, 'writeFailures' : 0, 'deadLetters' : 0}
+        
+        #Start the drainer
+        self.closed = threading.Event()
+        self.drainer = threading.Thread(target = self._Drain, daemon = True)
+        self.drainer.start()
+        
+    def Put(self, data):
+        '''
+        Append a raw payload to the spool.
+        '''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+            
+        with self.lock:
+            self.writeFile.write(data.strip() + b'\n')
+            self.writeFile.flush()
+            
+            #Periodically force the segment to disk
+            if time.monotonic() - self.lastSync >= self.fsyncInterval:
+                os.fsync(self.writeFile.fileno())
+                self.lastSync = time.monotonic()
+            
+            #Start a new segment once this one is full
+            if self.writeFile.tell() >= self.segmentBytes:
+                self._Rotate()
+                
+            self.stats['appended'] += 1
+            
+    def Stats(self):
+        '''
+        Return a snapshot of the spool statistics.
+        '''
+        with self.lock:
+            stats = dict(self.stats)
+            stats['segments'] = self.writeSegment - self.readSegment + 1
+            
+        #Return the statistics
+        return(stats)
+            
+    def Close(self):
+        '''
+        Drain what can be written to the database and stop the drainer.
+        Anything left is replayed the next time the spool is opened.
+        '''
+        self.closed.set()
+        self.drainer.join()
+        
+        with self.lock:
+            os.fsync(self.writeFile.fileno())
+            self.writeFile.close()
+            
+        #Add spool statistics to the log
+        logger.info('Stream Spool Statistics: %s' % self.Stats())
+        
+    def _Drain(self):
+        #Write spooled payloads to the database until closed and caught up
+        readFile = None
+        
+        while True:
+            if readFile is None:
+                try:
+                    readFile = open(self._SegmentPath(self.readSegment), 'rb')
+                    readFile.seek(self.readOffset)
+                    
+                except FileNotFoundError:
+                    #Skip a missing segment
+                    logger.warning('Spool Segment %s Missing' % self.readSegment)
+                    self._SaveCheckpoint(self.readSegment + 1, 0)
+                    continue
+                
+            lines, offset = self._ReadLines(readFile)
+            
+            if not lines:
+                with self.lock:
+                    finished = self.readSegment < self.writeSegment
+                    
+                if finished:
+                    #Check nothing was appended before the segment was rotated
+                    lines, offset = self._ReadLines(readFile)
+                    
+                if not lines and finished:
+                    #Move on to the next segment and delete this one
+                    readFile.close()
+                    readFile = None
+                    
+                    os.remove(self._SegmentPath(self.readSegment))
+                    self._SaveCheckpoint(self.readSegment + 1, 0)
+                    continue
+                
+                if not lines:
+                    if self.closed.is_set():
+                        break
+                    
+                    #Wait for more payloads
+                    time.sleep(0.1)
+                    continue
+                
+            if not self._WriteLines(lines):
+                #Leave the payloads in the spool to be replayed later
+                break
+                
+            self._SaveCheckpoint(self.readSegment, offset)
+            
+        if readFile is not None:
+            readFile.close()
+            
+    def _ReadLines(self, readFile):
+        #Read up to batchSize complete lines from the current position
+        lines = []
+        
+        while len(lines) < self.batchSize:
+            position = readFile.tell()
+            line = readFile.readline()
+            
+            if not line.endswith(b'\n'):
+                #Incomplete line still being written
+                readFile.seek(position)
+                break
+            
+            if line.strip():
+                lines.append(line)
+                
+        #Return the lines and the offset after them
+        return(lines, readFile.tell())
+        
+    def _WriteLines(self, lines):
+        #Process the payloads
+        if self.parser is not None:
+            results = self.parser.Parse(lines, self.locationID)
+        else:
+            results = wrangle.ProcessTwitterDataBatch(lines, self.locationID)
+            
+        batch = [(line, result) for line, result in zip(lines, results) if result is not None]
+        
+        #Set aside the payloads that could not be processed
+        for line, result in zip(lines, results):
+            if result is None:
+                self._DeadLetter(line, 'Tweet could not be processed')
+                
+        with self.lock:
+            self.stats['errors'] += len(results) - len(batch)
+            self.stats['deadLetters'] += len(results) - len(batch)
+            
+        if not batch:
+            return(True)
+            
+        retryDelay = 1
+        
+        while True:
+            try:
+                #Write the batch, setting aside any payloads that cannot be written
+                deadLetters = self._WriteSplit(batch)
+                break
+            
+            except Exception:
+                logger.error('Error Draining Spool to the Database - Retrying', exc_info = True)
+                
+                with self.lock:
+                    self.stats['writeFailures'] += 1
+                
+                if self.closed.is_set():
+                    return(False)
+                
+                #Wait before retrying, backing off up to a minute
+                self.closed.wait(retryDelay)
+                retryDelay = min(retryDelay * 2, 60)
+                
+        with self.lock:
+            self.stats['drained'] += len(batch) - deadLetters
+            self.stats['deadLetters'] += deadLetters
+            
+        #Return success
+        return(True)
+    
+    def _WriteSplit(self, batch):
+        #Write the batch in one transaction, raising transient errors and
+        #returning the number of payloads set aside
+        try:
+            self.backend.WriteStreamBatch([result for _, result in batch])
+            return(0)
+        
+        except Exception as e:
+            if self.backend.IsTransient(e):
+                raise e
+            
+            if len(batch) == 1:
+                self._DeadLetter(batch[0][0], e)
+                return(1)
+            
+        #Add warning to log
+        logger.warning('Splitting Spool Batch of %s Tweets to Find Those That Cannot Be Written' % len(batch))
+        
+        #Write each half separately
+        middle = len(batch) // 2
+        
+        #Return the number of payloads set aside
+        return(self._WriteSplit(batch[:middle]) + self._WriteSplit(batch[middle:]))
+        
+    def _DeadLetter(self, line, error):
+        #Append a payload that cannot be processed or written to the dead letter file
+        logger.error('Spooled Tweet Moved to %s: %s' % (self.deadLetterPath, error))
+        
+        with open(self.deadLetterPath, 'ab') as deadLetter:
+            deadLetter.write(line.strip() + b'\n')
+            deadLetter.flush()
+            os.fsync(deadLetter.fileno())
+            
+    def _Rotate(self):
+        #Close the current segment and start the next
+        os.fsync(self.writeFile.fileno())
+        self.writeFile.close()
+        
+        self.writeSegment += 1
+        self.writeFile = open(self._SegmentPath(self.writeSegment), 'ab')
+        
+    def _SegmentPath(self, segment):
+        return(os.path.join(self.directory, 'segment-%012d.ndjson' % segment))
+    
+    def _Segments(self):
+        #List the numbers of the segments in the directory
+        return(sorted(int(name[8:20]) for name in os.listdir(self.directory)
+                      if name.startswith('segment-') and name.endswith('.ndjson')))
+    
+    def _LoadCheckpoint(self):
+        if not os.path.exists(self.checkpointPath):
+            #Start from the oldest segment present
+            segments = self._Segments()
+            return((segments[0] if segments else 1, 0))
+        
+        with open(self.checkpointPath) as checkpoint:
+            position = json.load(checkpoint)
+            
+        #Return the segment and offset
+        return(position['segment'], position['offset'])
+    
+    def _SaveCheckpoint(self, segment, offset):
+        #Write the checkpoint atomically
+        temporaryPath = self.checkpointPath + '.tmp'
+        
+        with open(temporaryPath, 'w') as checkpoint:
+            json.dump({'segment' : segment, 'offset' : offset}, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            
+        os.replace(temporaryPath, self.checkpointPath)
+        
+        with self.lock:
+            self.readSegment, self.readOffset = segment, offset
@@ -0,0 +1,753 @@
+## Twitter Geo-location Scraper
+
+## Created as part of the following research:
+## Horizon Scanning Through Computer-Automated Information Prioritisation
+
+## Daniel Hammocks - 2019-11-18
+## GH: dhammo2
+
+## This code utilises the twitter API to obtain information on a given
+## geographical zone. The code has two main functionalities for obtaining the
+## top 50 trends in a given region (single run) or for listening on the twitter
+## API for obtaining tweets as they are posted (continuous run).
+
+###############################################################################
+############################## STORAGE FUNCTIONS ##############################
+###############################################################################
+
+#%% Notes
+
+# 1. A storage backend is where trends and tweets are written. Every backend
+#    has the same methods (see StorageBackend) so the writers, spool and main
+#    script do not depend on the database used.
+
+# 2. The SQL statements of every backend are generated from the MySQL
+#    statements of GenerateSQLInsert by TranslateStatement, and the tables
+#    from the definitions in twitterGeoStream.sql, so there is still a single
+#    place where the columns are defined.
+
+# 3. psycopg2 is optional and only imported when the PostgreSQL backend
+#    connects.
+
+
+#%% Required Libraries
+
+#sqlite3: Used by the SQLite backend
+import sqlite3
+
+#threading: Used to serialise access to the SQLite connection
+import threading
+
+#contextlib: Used to lend out connections
+import contextlib
+
+#io: Used to build the COPY data in memory
+import io
+
+#datetime: Used to store datetimes in SQLite and COPY data
+from datetime import datetime
+
+#logging: Used to create logs
+import logging
+
+
+#%% Configure logger
+
+logger = logging.getLogger(__name__)
+
+
+#%% Import Required Functions from Other Modules
+
+import db_functions as dbf
+
+
+#%% Statement Translation
+
+#Available storage backends
+BACKENDS = ('mysql', 'sqlite', 'postgres')
+
+#Define a function to translate a MySQL insert statement to another dialect
+def TranslateStatement(statement, dialect, primaryKey):
+    '''
+    This function converts an INSERT, INSERT IGNORE, REPLACE or INSERT ... ON
+    DUPLICATE KEY UPDATE statement for MySQL into the equivalent statement for
+    another dialect ('sqlite' or 'postgres'), using INSERT ... ON CONFLICT.
+    
+    Arguments:
+        statement  : MySQL statement from GenerateSQLInsert
+        dialect    : 'mysql', 'sqlite' or 'postgres'
+        primaryKey : primary key columns of the table
+    '''
+    
+    if dialect == 'mysql':
+        return(statement)
+    
+    table, columns = dbf.StatementColumns(statement)
+    
+    #Split off any upsert clause
+    upsert = ' ON DUPLICATE KEY UPDATE ' in statement
+    statement = statement.split(' ON DUPLICATE KEY UPDATE ')[0]
+    
+    #Replace the MySQL specific verbs
+    ignore = statement.startswith('INSERT IGNORE INTO ')
+    replace = statement.startswith('REPLACE INTO ')
+    
+    statement = 'INSERT INTO ' + statement.split(' INTO ', 1)[1]
+    
+    if ignore:
+        statement += ' ON CONFLICT DO NOTHING'
+    
+    elif replace or upsert:
+        #Overwrite every column except the key
+        updates = ', '.join(['%s = excluded.%s' % (column, column) for column in columns if column not in primaryKey])
+        
+        if updates:
+            statement += ' ON CONFLICT (%s) DO UPDATE SET %s' % (', '.join(primaryKey), updates)
+        else:
+            statement += ' ON CONFLICT DO NOTHING'
+    
+    if dialect == 'sqlite':
+        #SQLite uses qmark parameters
+        statement = statement.replace('%s', '?')
+    
+    #Return the statement
+    return(statement)
+
+
+#Column types of the MySQL tables in PostgreSQL
+POSTGRES_TYPES = {'TINYINT' : 'SMALLINT', 'INT' : 'INTEGER', 'DATETIME' : 'TIMESTAMP', 'MEDIUMTEXT' : 'TEXT'}
+
+#Define a function to generate the tables in another dialect
+def GenerateSchema(definitions, dialect):
+    '''
+    This function returns the CREATE TABLE and CREATE INDEX statements of
+    every table in definitions (see dbf.ReadTableDefinitions) for 'sqlite'
+    or 'postgres'. Tables and indexes that already exist are left as they
+    are.
+    '''
+    
+    statements = []
+    
+    for table, definition in definitions.items():
+        columns = []
+        primaryKey = definition['primaryKey']
+        
+        for name, columnType, declaration in definition['columns']:
+            if dialect == 'postgres':
+                declaration = POSTGRES_TYPES.get(columnType, declaration)
+            
+            if name == definition['autoIncrement']:
+                if dialect == 'sqlite':
+                    #Only INTEGER PRIMARY KEY columns are assigned automatically
+                    declaration = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+                    primaryKey = []
+                else:
+                    declaration += ' GENERATED BY DEFAULT AS IDENTITY'
+            
+            columns.append('%s %s' % (name, declaration))
+        
+        if primaryKey:
+            columns.append('PRIMARY KEY (%s)' % ', '.join(primaryKey))
+        
+        statements.append('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, ', '.join(columns)))
+        
+        for index in definition['indexes']:
+            statements.append('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                              % (table, '_'.join(index), table, ', '.join(index)))
+    
+    #Return the statements
+    return(statements)
+
+
+#%% Backend Interface
+
+#Define the interface every storage backend implements
+class StorageBackend():
+    '''
+    This class defines the methods of a storage backend:
+        Connect()               : context manager lending a (cnx, cursor)
+        WriteTrends(trends)     : write the trends of one or more locations
+        WriteStreamBatch(batch) : write a list of (dataOutput, dataRelations)
+        Stats()                 : dictionary of backend statistics
+        Close()                 : close every connection
+        IsTransient(error)      : whether a failed write may succeed if
+                                  retried
+    Each write is a single transaction.
+    '''
+    
+    #Name of the SQL dialect
+    dialect = None
+    
+    def Connect(self):
+        raise NotImplementedError
+    
+    def WriteTrends(self, trends):
+        raise NotImplementedError
+    
+    def WriteStreamBatch(self, batch):
+        raise NotImplementedError
+    
+    def Stats(self):
+        return({})
+    
+    def Close(self):
+        pass
+    
+    def IsTransient(self, error):
+        '''
+        Return whether a failed write may succeed if it is retried, e.g.
+        after a lost connection or a lock timeout, rather than failing on the
+        data written.
+        '''
+        return(isinstance(error, (ConnectionError, TimeoutError)))
+    
+    def _StreamRows(self, batch):
+        #Order the rows of every tweet by destination table
+        tableRows = list(dbf._GroupStreamRows(batch))
+        
+        if self.upsertCache is not None:
+            #Drop places and users that are unchanged since they were written
+            tableRows[0] = self.upsertCache.Filter('places', tableRows[0])
+            tableRows[1] = self.upsertCache.Filter('users', tableRows[1])
+        
+        #Return the rows of every table
+        return(tableRows)
+    
+    def _Remember(self, tableRows):
+        if self.upsertCache is not None:
+            #Remember the places and users now in the database
+            self.upsertCache.Update('places', tableRows[0])
+            self.upsertCache.Update('users', tableRows[1])
+
+
+#%% MySQL Backend
+
+#MySQL error numbers of lost connections, lock wait timeouts and deadlocks
+MYSQL_TRANSIENT_ERRNOS = (1040, 1205, 1213, 2002, 2003, 2006, 2013, 2055)
+
+#Define the MySQL backend
+class MySQLBackend(StorageBackend):
+    '''
+    This class writes to MySQL through a DBConnectionPool with the existing
+    db_functions writers.
+    
+    Arguments:
+        dbPool      : DBConnectionPool to borrow connections from
+        upsertCache : optional UpsertCache used to skip unchanged places and
+                      users
+        bulkLoad    : write stream batches with WriteStreamBulk2DB rather
+                      than multi-row inserts
+    '''
+    
+    dialect = 'mysql'
+    
+    def __init__(self, dbPool, upsertCache = None, bulkLoad = False):
+        self.dbPool = dbPool
+        self.upsertCache = upsertCache
+        self.writeBatch = dbf.WriteStreamBulk2DB if bulkLoad else dbf.WriteStreamBatch2DB
+        
+        #Generate SQL statements
+        self.addTrendData = dbf.GenerateSQLInsert('trends')
+        self.addStreamData = dbf.GenerateSQLInsert('stream')
+    
+    def Connect(self):
+        '''
+        Borrow a connection from the pool.
+        '''
+        return(self.dbPool.Connection())
+    
+    def WriteTrends(self, trends):
+        '''
+        Write the trends of one or more locations.
+        '''
+        with self.Connect() as (cnx, cursor):
+            dbf.WriteTrendData2DB(cnx, cursor, self.addTrendData, trends)
+    
+    def WriteStreamBatch(self, batch):
+        '''
+        Write a batch of processed tweets.
+        '''
+        with self.Connect() as (cnx, cursor):
+            self.writeBatch(cnx, cursor, self.addStreamData, batch, upsertCache = self.upsertCache)
+    
+    def Stats(self):
+        '''
+        Return the pool and upsert cache statistics.
+        '''
+        stats = {'pool' : self.dbPool.Stats()}
+        
+        if self.upsertCache is not None:
+            stats['upsertCache'] = self.upsertCache.Stats()
+        
+        #Return the statistics
+        return(stats)
+    
+    def Close(self):
+        '''
+        Close the pooled connections.
+        '''
+        self.dbPool.CloseAll()
+        
+        #Add backend statistics to the log
+        logger.info('MySQL Backend Statistics: %s' % self.Stats())
+    
+    def IsTransient(self, error):
+        '''
+        Connection, pool and lock errors are transient.
+        '''
+        import mysql.connector
+        
+        errors = mysql.connector.errors
+        
+        #Return whether to retry
+        return(isinstance(error, (errors.OperationalError, errors.InterfaceError, errors.PoolError))
+               or getattr(error, 'errno', None) in MYSQL_TRANSIENT_ERRNOS
+               or StorageBackend.IsTransient(self, error))
+
+
+#%% SQLite Backend
+
+#Settings applied to every SQLite connection
+SQLITE_PRAGMAS = (('journal_mode', 'WAL'),
+                  ('synchronous', 'NORMAL'),
+                  ('temp_store', 'MEMORY'),
+                  ('cache_size', -64000),
+                  ('mmap_size', 268435456),
+                  ('busy_timeout', 5000))
+
+#Define the SQLite backend
+class SQLiteBackend(StorageBackend):
+    '''
+    This class writes to a local SQLite database file, so the collector can
+    run without a MySQL server. The database is opened in WAL mode with
+    synchronous=NORMAL, and each batch is written with executemany inside an
+    explicit transaction. The tables are created from twitterGeoStream.sql
+    if they do not exist.
+    
+    Arguments:
+        path        : filepath of the database
+        upsertCache : optional UpsertCache used to skip unchanged places and
+                      users
+        sqlFile     : filepath of the MySQL table definitions
+    '''
+    
+    dialect = 'sqlite'
+    
+    def __init__(self, path = 'twitterGeoStream.db', upsertCache = None, sqlFile = dbf.SQL_FILE):
+        self.path = path
+        self.upsertCache = upsertCache
+        
+        try:
+            #Open the database, transactions are started explicitly
+            self.cnx = sqlite3.connect(path, isolation_level = None, check_same_thread = False)
+            
+            for pragma, value in SQLITE_PRAGMAS:
+                self.cnx.execute('PRAGMA %s = %s' % (pragma, value))
+        
+        except Exception as e:
+            #Add error to log and raise
+            logger.error("Error Opening the SQLite Database", exc_info = True)
+            raise e
+        
+        #Create the tables
+        self.definitions = dbf.ReadTableDefinitions(sqlFile)
+        
+        for statement in GenerateSchema(self.definitions, self.dialect):
+            self.cnx.execute(statement)
+        
+        #Translate the SQL statements
+        self.addTrendData = self._Translate(dbf.GenerateSQLInsert('trends'))
+        self.addStreamData = [self._Translate(statement) for statement in dbf.GenerateSQLInsert('stream')]
+        
+        #Find the datetime columns of every table, which are stored as text
+        self.trendDatetimes = self._DatetimeColumns(dbf.GenerateSQLInsert('trends'))
+        self.streamDatetimes = [self._DatetimeColumns(statement) for statement in dbf.GenerateSQLInsert('stream')]
+        
+        #Only one thread may use the connection at a time
+        self.lock = threading.Lock()
+        
+        #Backend statistics
+        self.stats = {'transactions' : 0, 'rows' : 0, 'errors' : 0}
+        
+        #Add success to log
+        logger.info('Opened SQLite Database %s' % path)
+    
+    @contextlib.contextmanager
+    def Connect(self):
+        '''
+        Lend out the connection, rolling back any open transaction on error.
+        '''
+        with self.lock:
+            cursor = self.cnx.cursor()
+            
+            try:
+                yield(self.cnx, cursor)
+            
+            except Exception:
+                if self.cnx.in_transaction:
+                    self.cnx.rollback()
+                raise
+            
+            finally:
+                cursor.close()
+    
+    def WriteTrends(self, trends):
+        '''
+        Write the trends of one or more locations.
+        '''
+        rows = self._ConvertDatetimes(dbf.GenerateTrendRows(trends), self.trendDatetimes)
+        
+        self._Write([(self.addTrendData, rows)])
+        
+        logger.info('Trend Data Successfully Written to the Database')
+    
+    def WriteStreamBatch(self, batch):
+        '''
+        Write a batch of processed tweets.
+        '''
+        
+        tableRows = self._StreamRows(batch)
+        
+        self._Write([(statement, self._ConvertDatetimes(rows, datetimes)) for statement, rows, datetimes
+                     in zip(self.addStreamData, tableRows, self.streamDatetimes)])
+        
+        self._Remember(tableRows)
+        
+        logger.info('Stream Data Batch of %s Tweets Successfully Written to the Database' % len(batch))
+    
+    def Stats(self):
+        '''
+        Return the transaction and row counts and upsert cache statistics.
+        '''
+        stats = dict(self.stats)
+        
+        if self.upsertCache is not None:
+            stats['upsertCache'] = self.upsertCache.Stats()
+        
+        #Return the statistics
+        return(stats)
+    
+    def Close(self):
+        '''
+        Checkpoint the write-ahead log and close the database.
+        '''
+        with self.lock:
+            self.cnx.execute('PRAGMA optimize')
+            self.cnx.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.cnx.close()
+        
+        #Add backend statistics to the log
+        logger.info('SQLite Backend Statistics: %s' % self.Stats())
+    
+    def IsTransient(self, error):
+        '''
+        A database locked by another writer is transient.
+        '''
+        return(isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+               or StorageBackend.IsTransient(self, error))
+    
+    def _Write(self, statements):
+        try:
+            with self.Connect() as (cnx, cursor):
+                #Write every table in one transaction
+                cursor.execute('BEGIN IMMEDIATE')
+                
+                for statement, rows in statements:
+                    if rows:
+                        cursor.executemany(statement, rows)
+                
+                cursor.execute('COMMIT')
+        
+        except Exception as e:
+            #Add error to log and raise
+            self.stats['errors'] += 1
+            logger.error('Error Writing to the SQLite Database', exc_info = True)
+            raise e
+        
+        self.stats['transactions'] += 1
+        self.stats['rows'] += sum(len(rows) for _, rows in statements)
+    
+    def _Translate(self, statement):
+        table, _ = dbf.StatementColumns(statement)
+        
+        #Return the statement in the SQLite dialect
+        return(TranslateStatement(statement, self.dialect, self.definitions[table]['primaryKey']))
+    
+    def _DatetimeColumns(self, statement):
+        table, columns = dbf.StatementColumns(statement)
+        columnTypes = {name : columnType for name, columnType, _ in self.definitions[table]['columns']}
+        
+        #Return the positions of the DATETIME columns
+        return([index for index, column in enumerate(columns) if columnTypes[column] == 'DATETIME'])
+    
+    @staticmethod
+    def _ConvertDatetimes(rows, datetimes):
+        if not datetimes or not rows:
+            return(rows)
+        
+        converted = []
+        
+        for row in rows:
+            row = list(row)
+            
+            #Store datetimes as ISO 8601 text
+            for index in datetimes:
+                if isinstance(row[index], datetime):
+                    row[index] = row[index].isoformat(' ')
+            
+            converted.append(row)
+        
+        #Return the rows
+        return(converted)
+
+
+#%% PostgreSQL Backend
+
+#Column types that may hold empty strings
+TEXT_TYPES = ('VARCHAR', 'MEDIUMTEXT')
+
+#Characters escaped in the COPY data, PostgreSQL text cannot hold NUL
+_COPY_ESCAPES = str.maketrans({'\\' : '\\\\', '\t' : '\\t', '\n' : '\\n', '\r' : '\\r', '\0' : None})
+
+#Define a function to format a value for the text format of COPY
+def _FormatCopyValue(value, nullEmpty):
+    if value is None or nullEmpty and value == '':
+        return('\\N')
+    
+    if isinstance(value, bool):
+        return('1' if value else '0')
+    
+    if isinstance(value, datetime):
+        return(value.strftime('%Y-%m-%d %H:%M:%S'))
+    
+    #Return the escaped string
+    return(str(value).translate(_COPY_ESCAPES))
+
+
+#Define the PostgreSQL backend
+class PostgresBackend(StorageBackend):
+    '''
+    This class writes to PostgreSQL with COPY rather than per row inserts.
+    Tables written with a plain INSERT are copied into directly. For the
+    others, each batch is copied into a temporary staging table and merged
+    into the table with a single INSERT ... SELECT ... ON CONFLICT, which
+    keeps the IGNORE/REPLACE/upsert behaviour of the MySQL statements. Every
+    batch is one transaction and the staging tables are emptied on commit.
+    The tables are created from twitterGeoStream.sql if they do not exist.
+    
+    Arguments:
+        credentialsDB : DB credentials from ReadDBCredentials
+        upsertCache   : optional UpsertCache used to skip unchanged places
+                        and users
+        sqlFile       : filepath of the MySQL table definitions
+    '''
+    
+    dialect = 'postgres'
+    
+    def __init__(self, credentialsDB, upsertCache = None, sqlFile = dbf.SQL_FILE):
+        self.credentialsDB = credentialsDB
+        self.upsertCache = upsertCache
+        self.definitions = dbf.ReadTableDefinitions(sqlFile)
+        
+        #Generate the COPY and merge statements of every table
+        self.trendLoad = self._LoadStatements(dbf.GenerateSQLInsert('trends'))
+        self.streamLoads = [self._LoadStatements(statement) for statement in dbf.GenerateSQLInsert('stream')]
+        
+        #Only one thread may use the connection at a time
+        self.cnx = None
+        self.lock = threading.Lock()
+        
+        #Backend statistics
+        self.stats = {'transactions' : 0, 'rows' : 0, 'merged' : 0, 'connects' : 0, 'errors' : 0}
+        
+        #Connect and create the tables
+        with self.Connect():
+            pass
+    
+    @contextlib.contextmanager
+    def Connect(self):
+        '''
+        Lend out the connection, reconnecting if it was lost and rolling back
+        any open transaction on error.
+        '''
+        with self.lock:
+            if self.cnx is None or self.cnx.closed:
+                self._Open()
+            
+            cursor = self.cnx.cursor()
+            
+            try:
+                yield(self.cnx, cursor)
+            
+            except Exception:
+                if not self.cnx.closed:
+                    self.cnx.rollback()
+                raise
+            
+            finally:
+                if not cursor.closed:
+                    cursor.close()
+    
+    def WriteTrends(self, trends):
+        '''
+        Write the trends of one or more locations.
+        '''
+        self._Write([(self.trendLoad, dbf.GenerateTrendRows(trends))])
+        
+        logger.info('Trend Data Successfully Written to the Database')
+    
+    def WriteStreamBatch(self, batch):
+        '''
+        Write a batch of processed tweets.
+        '''
+        tableRows = self._StreamRows(batch)
+        
+        self._Write(list(zip(self.streamLoads, tableRows)))
+        
+        self._Remember(tableRows)
+        
+        logger.info('Stream Data Batch of %s Tweets Successfully Written to the Database' % len(batch))
+    
+    def Stats(self):
+        '''
+        Return the transaction and row counts and upsert cache statistics.
+        '''
+        stats = dict(self.stats)
+        
+        if self.upsertCache is not None:
+            stats['upsertCache'] = self.upsertCache.Stats()
+        
+        #Return the statistics
+        return(stats)
+    
+    def Close(self):
+        '''
+        Close the connection.
+        '''
+        with self.lock:
+            if self.cnx is not None and not self.cnx.closed:
+                self.cnx.close()
+        
+        #Add backend statistics to the log
+        logger.info('PostgreSQL Backend Statistics: %s' % self.Stats())
+    
+    def IsTransient(self, error):
+        '''
+        Connection errors, lock timeouts, deadlocks and serialisation
+        failures are transient.
+        '''
+        import psycopg2
+        
+        #Return whether to retry
+        return(isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+               or StorageBackend.IsTransient(self, error))
+    
+    def _Open(self):
+        #psycopg2 is only needed by this backend
+        import psycopg2
+        
+        try:
+            #Connect to the database
+            self.cnx = psycopg2.connect(host     = self.credentialsDB[0],
+                                        user     = self.credentialsDB[1],
+                                        password = self.credentialsDB[2],
+                                        dbname   = self.credentialsDB[3])
+            
+            cursor = self.cnx.cursor()
+            
+            #Create the tables, then the staging tables of this session
+            for statement in GenerateSchema(self.definitions, self.dialect):
+                cursor.execute(statement)
+            
+            for load in [self.trendLoad] + self.streamLoads:
+                if load['stage'] is not None:
+                    cursor.execute(load['stage'])
+            
+            self.cnx.commit()
+            cursor.close()
+        
+        except Exception as e:
+            #Add error to log and raise
+            logger.error("Error Connecting to the PostgreSQL Database", exc_info = True)
+            raise e
+        
+        self.stats['connects'] += 1
+        
+        #Add success to log
+        logger.info('Connected to the PostgreSQL Database')
+    
+    def _Write(self, loads):
+        try:
+            with self.Connect() as (cnx, cursor):
+                #Load every table in one transaction
+                for load, rows in loads:
+                    if not rows:
+                        continue
+                    
+                    if load['key'] is not None:
+                        #A row may only be updated once per merge, keep the last
+                        rows = list({tuple(row[index] for index in load['key']) : row for row in rows}.values())
+                    
+                    cursor.copy_expert(load['copy'], self._CopyData(rows, load['nullEmpty']))
+                    
+                    if load['merge'] is not None:
+                        cursor.execute(load['merge'])
+                        self.stats['merged'] += cursor.rowcount
+                    
+                    self.stats['rows'] += len(rows)
+                
+                cnx.commit()
+        
+        except Exception as e:
+            #Add error to log and raise
+            self.stats['errors'] += 1
+            logger.error('Error Writing to the PostgreSQL Database', exc_info = True)
+            raise e
+        
+        self.stats['transactions'] += 1
+    
+    def _LoadStatements(self, statement):
+        table, columns = dbf.StatementColumns(statement)
+        definition = self.definitions[table]
+        columnTypes = {name : columnType for name, columnType, _ in definition['columns']}
+        
+        #Statement with the ON CONFLICT clause of the MySQL statement
+        translated = TranslateStatement(statement, self.dialect, definition['primaryKey'])
+        
+        load = {'nullEmpty' : [columnTypes[column] not in TEXT_TYPES for column in columns],
+                'stage' : None, 'merge' : None, 'key' : None}
+        
+        if ' ON CONFLICT ' not in translated:
+            #Plain inserts are copied straight into the table
+            load['copy'] = 'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns))
+        
+        else:
+            #Copy into a staging table and merge it into the table
+            stage = 'stage_' + table
+            insert = translated[:translated.index(' VALUES ')]
+            conflict = translated[translated.index(' ON CONFLICT '):]
+            
+            load['stage'] = ('CREATE TEMPORARY TABLE IF NOT EXISTS %s ON COMMIT DELETE ROWS AS SELECT %s FROM %s WITH NO DATA'
+                             % (stage, ', '.join(columns), table))
+            load['copy'] = 'COPY %s (%s) FROM STDIN' % (stage, ', '.join(columns))
+            load['merge'] = '%s SELECT %s FROM %s%s' % (insert, ', '.join(columns), stage, conflict)
+            
+            if ' DO UPDATE ' in conflict:
+                load['key'] = [columns.index(column) for column in definition['primaryKey']]
+        
+        #Return the statements
+        return(load)
+    
+    @staticmethod
+    def _CopyData(rows, nullEmpty):
+        #Write the rows in the text format of COPY
+        data = io.StringIO()
+        
+        for row in rows:
+            data.write('\t'.join([_FormatCopyValue(value, empty) for value, empty in zip(row, nullEmpty)]))
+            data.write('\n')
+        
+        data.seek(0)
+        
+        #Return the data
+        return(data)
@@ -0,0 +1,14 @@
+## Twitter Geo-location Scraper - Tests
+
+###############################################################################
+############################### TEST CONFIGURATION ############################
+###############################################################################
+
+#%% Import Path
+
+#os and sys: Used to import the modules from the code directory
+import os
+import sys
+
+#Import the *_functions modules as main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
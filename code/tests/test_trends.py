@@ -0,0 +1,61 @@
+## Twitter Geo-location Scraper - Tests
+
+###############################################################################
+################################# TREND TESTS #################################
+###############################################################################
+
+#%% Required Libraries
+
+#pytest: Test runner
+import pytest
+
+#copy: Used to duplicate trends
+import copy
+
+
+#%% Import Required Functions from Other Modules
+
+pytest.importorskip('mysql.connector')
+
+import benchmark_functions as bench
+import db_functions as dbf
+
+
+#%% Tests
+
+#Define trends of one location where the same trend appears twice
+def _DuplicateTrends():
+    trends = bench.GenerateTrends(2, 5, seed = 0)
+
+    for locationTrends in trends:
+        locationTrends['trends'].append(copy.deepcopy(locationTrends['trends'][1]))
+
+    #Return the trends
+    return(trends)
+
+
+def test_duplicate_trends_ranked_by_position():
+    trends = _DuplicateTrends()
+    addTrendData = dbf.GenerateSQLInsert('trends')
+    width = addTrendData.count('%s')
+
+    cursor = bench._CountingCursor(record = True)
+    dbf.WriteTrendData2DB(cursor, cursor, addTrendData, trends)
+
+    #Ranks are 1 to 6 for each location, the duplicate included
+    ranks = [row[4] for row in cursor.Rows(width)]
+    assert ranks == [1, 2, 3, 4, 5, 6] * 2
+
+
+def test_duplicate_trends_match_reference():
+    trends = _DuplicateTrends()
+    addTrendData = dbf.GenerateSQLInsert('trends')
+    width = addTrendData.count('%s')
+
+    referenceCursor = bench._CountingCursor(record = True)
+    cursor = bench._CountingCursor(record = True)
+
+    bench._ReferenceWriteTrends(referenceCursor, referenceCursor, addTrendData, trends)
+    dbf.WriteTrendData2DB(cursor, cursor, addTrendData, trends)
+
+    assert cursor.Rows(width) == referenceCursor.Rows(width)
@@ -20,6 +20,35 @@ CREATE TABLE trends (
 	PRIMARY KEY (trend_id)
 );
 
+########## CREATE TREND CHANGE TABLES ##########
+CREATE TABLE trend_changes (
+	change_id INT NOT NULL AUTO_INCREMENT,
+    change_woeid INT,
+	change_woeid_name VARCHAR(128),
+    change_datetime_asof DATETIME,
+	change_datetime_createdat DATETIME,
+    change_type VARCHAR(8),
+    change_rank TINYINT,
+    change_name VARCHAR(128),
+    change_url VARCHAR(1024),
+    change_promotedcontent VARCHAR(512),
+    change_query VARCHAR(128),
+    change_tweetvolume INT,
+	PRIMARY KEY (change_id),
+    INDEX (change_woeid, change_datetime_asof)
+);
+
+CREATE TABLE trend_state (
+    state_woeid INT NOT NULL,
+    state_name VARCHAR(128) NOT NULL,
+    state_rank TINYINT,
+    state_url VARCHAR(1024),
+    state_promotedcontent VARCHAR(512),
+    state_query VARCHAR(128),
+    state_tweetvolume INT,
+	PRIMARY KEY (state_woeid, state_name)
+);
+
 
 /* TABLE CREATION FOR TWITTER STREAMING */
 
@@ -170,4 +199,23 @@ CREATE TABLE tweet_media (
 		REFERENCES media_included (media_id)
 );
 
+CREATE TABLE tweet_streamlocations (
+	tweet_id BIGINT NOT NULL,
+    streamlocation_woeid INT NOT NULL,
+    PRIMARY KEY (tweet_id, streamlocation_woeid),
+    FOREIGN KEY (tweet_id)
+		REFERENCES tweets (tweet_id)
+);
+
+########## CREATE STREAM MONITORING TABLES ##########
+CREATE TABLE stream_limits (
+	limit_id INT NOT NULL AUTO_INCREMENT,
+    limit_woeid INT,
+    limit_window_start DATETIME,
+    limit_window_end DATETIME,
+    limit_notices INT,
+    limit_undelivered INT,
+    PRIMARY KEY (limit_id)
+);
+
 COMMIT;
\ No newline at end of file
@@ -17,8 +17,8 @@
 
 #%% Load Required Libraries
 
-#requests: for sending http requests
-import requests
+#requests is only imported when the Flickr API is called so that runs which
+#only use the WOEID catalog or cached bounding boxes start faster
 
 #re: for regular expressions on strings
 import re
@@ -29,6 +29,21 @@ import json
 #logging: Used to create logs
 import logging
 
+#math: Used to index the spatial grid
+import math
+
+#os, time and threading: Used to manage the bounding box cache
+import os
+import time
+import threading
+
+#concurrent.futures: Used to resolve bounding boxes concurrently
+import concurrent.futures
+
+#pickle and bisect: Used to compile and search the WOEID catalog
+import pickle
+import bisect
+
 
 #%% Configure logger
 
@@ -63,6 +78,10 @@ def IdentifyWOEIDLocations(api):
         logger.error("Error Writing Data to JSON File", exc_info=True)
         raise e
         
+    #Forget any catalog of the old list
+    with _CATALOGS_LOCK:
+        _CATALOGS.pop('woeidList.json', None)
+        
     #Add success to log
     logger.info('Successfully Written WOEID Data to File')
         
@@ -70,21 +89,172 @@ def IdentifyWOEIDLocations(api):
     return(woeidList)
     
     
+# Function to select WOEIDs from the list of available locations
+def FilterWOEIDs(woeidFile = 'woeidList.json', countryCode = None, placeType = None, parentID = None):
+    '''
+    This function returns the WOEIDs in the file written by
+    IdentifyWOEIDLocations that match a country code (e.g. 'GB'), a place
+    type (e.g. 'Town' or 'Country') and/or a parent WOEID.
+    '''
+    
+    #Look the locations up in the catalog of the file
+    woeids = LoadWoeidCatalog(woeidFile).Filter(countryCode, placeType, parentID)
+    
+    #Add success to log
+    logger.info('Selected %s WOEIDs' % len(woeids))
+    
+    #Return the WOEIDs
+    return(woeids)
+    
+    
+# Function to return a shared catalog of a WOEID file
+def LoadWoeidCatalog(woeidFile = 'woeidList.json'):
+    '''
+    This function returns a WoeidCatalog of the file, reusing the catalog
+    created by an earlier call.
+    '''
+    
+    with _CATALOGS_LOCK:
+        if woeidFile not in _CATALOGS:
+            _CATALOGS[woeidFile] = WoeidCatalog(woeidFile)
+            
+        #Return the catalog
+        return(_CATALOGS[woeidFile])
+    
+
+#Catalogs created by LoadWoeidCatalog
+_CATALOGS = {}
+_CATALOGS_LOCK = threading.Lock()
+
+
 # Function to convert a WOEID location to a bounding box of coordinates  
-def BBoxofWOEID(locationID, credJSON = 'credentials.json'):
+def BBoxofWOEID(locationID, credJSON = 'credentials.json', cache = None, session = None):
+    '''
+    This function returns the bounding box [minLon, minLat, maxLon, maxLat]
+    of a WOEID from the Flickr API. If a BBoxCache is given, a cached bounding
+    box is returned without any network call and new results are cached. An
+    expired cached bounding box is used if the Flickr API cannot be reached.
+    '''
+    
+    #Expired bounding box to fall back on
+    stale = None
+    
+    if cache is not None:
+        #Use the cached bounding box if there is one
+        entry = cache.Get(locationID)
+        
+        if entry is not None:
+            logger.info('Found the Bounding Box of the WOEID in the Cache')
+            return(entry['bbox'])
+        
+        stale = cache.Get(locationID, allowExpired = True)
+    
+    try:
+        #Extract Credentials
+        flickrKey, _ = axf.ReadFlickrCredentials(credJSON)
+        
+        #Query the Flickr API
+        shape = _RequestShape(locationID, flickrKey, session)
+        
+    except Exception as e:
+        if stale is None:
+            #Raise the error
+            raise e
+        
+        #Add warning to log and use the expired bounding box
+        logger.warning('Could Not Refresh the Bounding Box of WOEID %s - Using the Expired Cached Bounding Box'
+                       % locationID)
+        return(stale['bbox'])
+    
+    try:
+        #Find the bbox of the shape
+        bbox = _ShapeBBox(shape)
+        
+    except Exception as e:
+        #Log the error
+        logger.error('Error Parsing the Response from the Flickr API')
+        
+        #Raise the error
+        raise e
+        
+    logger.info('Successfuly Identified the Bounding Box of the WOEID')
+    
+    if cache is not None:
+        #Store the result for next time
+        cache.Set(locationID, bbox, shape)
+        cache.Save()
+    
+    #Return bbox
+    return(bbox)
+    
+    
+# Function to resolve the bounding boxes of many WOEIDs into the cache
+def PrefetchBBoxes(locationIDs, cache, credJSON = 'credentials.json', maxWorkers = 8, refresh = False):
+    '''
+    This function resolves the bounding boxes of a list of WOEIDs concurrently
+    over a shared keep-alive HTTP session and stores them in the cache, so
+    that streams can later start without calling the Flickr API. WOEIDs
+    already cached are skipped unless refresh is True.
+    
+    Returns the number of WOEIDs resolved.
+    '''
     
     #Extract Credentials
     flickrKey, _ = axf.ReadFlickrCredentials(credJSON)
     
+    #Only request WOEIDs that are not already cached
+    if not refresh:
+        locationIDs = [x for x in locationIDs if cache.Get(x) is None]
+        
+    #requests: for sending http requests
+    import requests
+    
+    #Share one connection pool between the threads
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = maxWorkers)
+    session.mount('https://', adapter)
+    
+    def Resolve(locationID):
+        try:
+            shape = _RequestShape(locationID, flickrKey, session)
+            cache.Set(locationID, _ShapeBBox(shape), shape)
+            return(True)
+        
+        except Exception:
+            #Some WOEIDs (e.g. Worldwide) have no shape so skip them
+            logger.warning('Could Not Resolve the Bounding Box of WOEID %s' % locationID)
+            return(False)
+        
+    with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+        resolved = sum(executor.map(Resolve, locationIDs))
+        
+    session.close()
+    
+    #Write the cache to disk once
+    cache.Save()
+    
+    #Add success to log
+    logger.info('Resolved the Bounding Boxes of %s of %s WOEIDs' % (resolved, len(locationIDs)))
+    
+    #Return the number resolved
+    return(resolved)
+    
+    
+# Function to request the shape of a WOEID from the Flickr API
+def _RequestShape(locationID, flickrKey, session = None):
+    
     #Base URL
     urlBase = 'https://www.flickr.com/services/rest/?method=flickr.places.getInfo'
      
     #Create the URL
     urlQuery = urlBase + '&api_key=' + str(flickrKey) + '&format=json&woe_id=' + str(locationID)
 
+    #requests: for sending http requests
+    import requests
+    
     try:
         #Query the flickr API
-        response = requests.get(urlQuery).text
+        response = (session or requests).get(urlQuery, timeout = 30).text
         
     except Exception as e:
         #Log the error
@@ -105,19 +275,6 @@ def BBoxofWOEID(locationID, credJSON = 'credentials.json'):
         
         #Extract Coordinate Data
         shape = responseJSON['place']['shapedata']['polylines']['polyline'][0]['_content']
-    
-        #Process coordinates
-        coordinates = shape.split(' ')
-        coordinates = [x.split(',') for x in coordinates]
-        
-        #Find the bbox values
-        minLat = min([float(x) for x, y in coordinates])
-        minLon = min([float(y) for x, y in coordinates])
-        maxLat = max([float(x) for x, y in coordinates])
-        maxLon = max([float(y) for x, y in coordinates])
-        
-        #Create bbox object
-        bbox = [minLon, minLat, maxLon, maxLat]
         
     except Exception as e:
         #Log the error
@@ -126,8 +283,408 @@ def BBoxofWOEID(locationID, credJSON = 'credentials.json'):
         #Raise the error
         raise e
         
-    logger.info('Successfuly Identified the Bounding Box of the WOEID')
+    #Return the shape
+    return(shape)
+
+
+# Function to find the bounding box of a Flickr shape
+def _ShapeBBox(shape):
+    
+    #Process coordinates
+    coordinates = shape.split(' ')
+    coordinates = [x.split(',') for x in coordinates]
+    
+    #Find the bbox values
+    minLat = min([float(x) for x, y in coordinates])
+    minLon = min([float(y) for x, y in coordinates])
+    maxLat = max([float(x) for x, y in coordinates])
+    maxLon = max([float(y) for x, y in coordinates])
+    
+    #Create bbox object
+    bbox = [minLon, minLat, maxLon, maxLat]
     
     #Return bbox
     return(bbox)
-        
\ No newline at end of file
+
+
+#%% WOEID Catalog
+
+#Define a class for looking up locations in the list of WOEIDs
+class WoeidCatalog():
+    '''
+    This class indexes the list of locations written by IdentifyWOEIDLocations
+    by WOEID, country code, place type, parent WOEID and name. The indexes are
+    compiled once into a pickle file in a .cache directory next to the list
+    and are only loaded when first used. The pickle is compiled again
+    whenever the list is newer.
+    
+    Arguments:
+        woeidFile : filepath of the list of WOEIDs
+        cachePath : filepath of the compiled indexes (default
+                    .cache/<woeidFile>.pickle)
+    '''
+    
+    def __init__(self, woeidFile = 'woeidList.json', cachePath = None):
+        self.woeidFile = woeidFile
+        self.cachePath = cachePath or os.path.join(os.path.dirname(woeidFile), '.cache',
+                                                   os.path.basename(woeidFile) + '.pickle')
+        self.indexes = None
+        self.lock = threading.Lock()
+        
+    def _Indexes(self):
+        #Load the indexes on first use
+        if self.indexes is None:
+            with self.lock:
+                if self.indexes is None:
+                    self.indexes = self._Load()
+                    
+        #Return the indexes
+        return(self.indexes)
+                    
+    def _Load(self):
+        try:
+            #Use the compiled indexes if they are up to date
+            if os.path.getmtime(self.cachePath) >= os.path.getmtime(self.woeidFile):
+                with open(self.cachePath, 'rb') as infile:
+                    return(pickle.load(infile))
+                
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        
+        try:
+            #Read the list of locations
+            with open(self.woeidFile) as infile:
+                woeidList = json.load(infile)
+                
+        except Exception as e:
+            #Add error to log and raise
+            logger.error("Error Reading WOEID List", exc_info=True)
+            raise e
+            
+        #Compile the indexes
+        indexes = self._Compile(woeidList)
+        
+        try:
+            #Write atomically so a crash cannot corrupt the compiled indexes
+            os.makedirs(os.path.dirname(self.cachePath) or '.', exist_ok = True)
+            temporaryPath = self.cachePath + '.tmp'
+            
+            with open(temporaryPath, 'wb') as outfile:
+                pickle.dump(indexes, outfile, protocol = pickle.HIGHEST_PROTOCOL)
+                
+            os.replace(temporaryPath, self.cachePath)
+            
+        except OSError:
+            #The catalog still works without the compiled file
+            logger.warning('Could Not Write the WOEID Catalog to %s' % self.cachePath)
+            
+        #Add success to log
+        logger.info('Compiled the WOEID Catalog of %s Locations' % len(woeidList))
+        
+        #Return the indexes
+        return(indexes)
+    
+    @staticmethod
+    def _Compile(woeidList):
+        #Index every location
+        byWoeid = {}
+        byCountry = {}
+        byPlaceType = {}
+        byParent = {}
+        
+        for location in woeidList:
+            woeid = location['woeid']
+            
+            #Keep only the fields that are looked up
+            byWoeid[woeid] = {'woeid' : woeid,
+                              'name' : location['name'],
+                              'placeType' : location['placeType']['name'],
+                              'parentid' : location['parentid'],
+                              'country' : location['country'],
+                              'countryCode' : location['countryCode']}
+            
+            if location['countryCode']:
+                byCountry.setdefault(location['countryCode'].upper(), []).append(woeid)
+                
+            byPlaceType.setdefault(location['placeType']['name'].lower(), []).append(woeid)
+            byParent.setdefault(location['parentid'], []).append(woeid)
+            
+        #Sort the names for prefix searches
+        names = sorted((location['name'].lower(), location['woeid']) for location in woeidList)
+            
+        #Store the WOEIDs as sets for fast intersections
+        indexes = {'woeid' : byWoeid,
+                   'countryCode' : {x : frozenset(y) for x, y in byCountry.items()},
+                   'placeType' : {x : frozenset(y) for x, y in byPlaceType.items()},
+                   'parentid' : {x : frozenset(y) for x, y in byParent.items()},
+                   'names' : [x for x, _ in names],
+                   'nameWoeids' : [y for _, y in names]}
+        
+        #Return the indexes
+        return(indexes)
+    
+    def __len__(self):
+        return(len(self._Indexes()['woeid']))
+    
+    def __contains__(self, woeid):
+        return(woeid in self._Indexes()['woeid'])
+    
+    def Get(self, woeid):
+        '''
+        Return the location of a WOEID, or None if it is not in the catalog.
+        '''
+        return(self._Indexes()['woeid'].get(woeid))
+    
+    def Children(self, woeid, recursive = False):
+        '''
+        Return the WOEIDs whose parent is woeid, or every descendant if
+        recursive is True.
+        '''
+        byParent = self._Indexes()['parentid']
+        
+        children = set(byParent.get(woeid, ()))
+        
+        if recursive:
+            #Walk down the tree
+            pending = list(children)
+            
+            while pending:
+                for child in byParent.get(pending.pop(), ()):
+                    if child not in children:
+                        children.add(child)
+                        pending.append(child)
+                        
+        #Return the WOEIDs
+        return(sorted(children))
+    
+    def Search(self, prefix):
+        '''
+        Return the WOEIDs whose name starts with prefix, ignoring case.
+        '''
+        indexes = self._Indexes()
+        prefix = prefix.lower()
+        
+        #Find the block of sorted names starting with the prefix
+        start = bisect.bisect_left(indexes['names'], prefix)
+        end = start
+        
+        while end < len(indexes['names']) and indexes['names'][end].startswith(prefix):
+            end += 1
+            
+        #Return the WOEIDs
+        return(indexes['nameWoeids'][start:end])
+    
+    def Filter(self, countryCode = None, placeType = None, parentID = None):
+        '''
+        Return the WOEIDs matching every filter given, in WOEID order.
+        '''
+        indexes = self._Indexes()
+        
+        #Look up the WOEIDs matching each filter
+        matches = []
+        
+        if countryCode is not None:
+            matches.append(indexes['countryCode'].get(countryCode.upper(), frozenset()))
+        if placeType is not None:
+            matches.append(indexes['placeType'].get(placeType.lower(), frozenset()))
+        if parentID is not None:
+            matches.append(indexes['parentid'].get(parentID, frozenset()))
+            
+        if not matches:
+            #Return every WOEID
+            return(sorted(indexes['woeid']))
+        
+        #Return the WOEIDs in every match
+        return(sorted(frozenset.intersection(*matches)))
+    
+    
+#%% Bounding Box Cache
+
+#Define a class for storing resolved bounding boxes on disk
+class BBoxCache():
+    '''
+    This class stores the bounding boxes and shapes of WOEIDs in a JSON file
+    so they only need to be requested from the Flickr API once.
+    
+    Arguments:
+        path : filepath of the cache
+        ttl  : seconds before a cached entry is requested again
+    '''
+    
+    def __init__(self, path = 'bboxCache.json', ttl = 30 * 24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        
+        try:
+            #Read the cache file
+            with open(path) as infile:
+                self.entries = json.load(infile)
+                
+        except FileNotFoundError:
+            self.entries = {}
+            
+    def Get(self, locationID, allowExpired = False):
+        '''
+        Return the cached entry of a WOEID, or None if missing or expired.
+        Expired entries are kept and returned if allowExpired is True.
+        '''
+        with self.lock:
+            entry = self.entries.get(str(locationID))
+            
+        if entry is None or (not allowExpired and time.time() - entry['fetched'] > self.ttl):
+            return(None)
+        
+        #Return the entry
+        return(entry)
+    
+    def Set(self, locationID, bbox, shape):
+        '''
+        Store the bounding box and shape of a WOEID.
+        '''
+        with self.lock:
+            self.entries[str(locationID)] = {'bbox' : bbox, 'shape' : shape, 'fetched' : time.time()}
+            
+    def Save(self):
+        '''
+        Write the cache to disk.
+        '''
+        with self.lock:
+            #Write atomically so a crash cannot corrupt the cache
+            temporaryPath = self.path + '.tmp'
+            
+            with open(temporaryPath, 'w') as outfile:
+                json.dump(self.entries, outfile)
+                
+            os.replace(temporaryPath, self.path)
+            
+            
+#%% Spatial Routing
+
+#Define a class for finding the streamed regions a tweet belongs to
+class LocationRouter():
+    '''
+    This class routes tweets from a stream filtered on several bounding boxes
+    back to the WOEIDs they belong to. The bounding boxes are indexed in a
+    uniform grid so each tweet is only compared with the regions that share
+    its grid cells rather than every region.
+    
+    Twitter matches a tweet to a bounding box if its coordinates fall inside
+    the box or, for tweets without coordinates, if its place's bounding box
+    intersects the box. Tweets are routed the same way.
+    
+    Arguments:
+        regions : dictionary of {WOEID : [minLon, minLat, maxLon, maxLat]}
+    '''
+    
+    #Regions covering more cells than this are checked for every tweet
+    MAX_REGION_CELLS = 4096
+    
+    #Place bounding boxes covering more cells than this are checked against
+    #every region instead of through the grid
+    MAX_QUERY_CELLS = 64
+    
+    def __init__(self, regions):
+        self.locationIDs = list(regions)
+        self.bboxes = [regions[locationID] for locationID in self.locationIDs]
+        
+        #Size the cells on the typical region so each covers only a few cells
+        sizes = sorted(max(maxLon - minLon, maxLat - minLat) for minLon, minLat, maxLon, maxLat in self.bboxes)
+        self.cellSize = max(sizes[len(sizes) // 2], 1e-6) if sizes else 1.0
+        
+        #Map each grid cell to the regions overlapping it
+        self.grid = {}
+        self.large = []
+        
+        for i, bbox in enumerate(self.bboxes):
+            xs, ys = self._CellRange(bbox)
+            
+            if len(xs) * len(ys) > self.MAX_REGION_CELLS:
+                self.large.append(i)
+                continue
+            
+            for x in xs:
+                for y in ys:
+                    self.grid.setdefault((x, y), []).append(i)
+                
+    def Locations(self):
+        '''
+        Return the bounding boxes as one flat list for the streaming API.
+        '''
+        return([value for bbox in self.bboxes for value in bbox])
+                
+    def Route(self, dataJSON):
+        '''
+        Return the WOEIDs of the regions a parsed tweet belongs to.
+        '''
+        
+        #Route on the exact coordinates when the tweet has them
+        coordinates = dataJSON.get('coordinates')
+        
+        if coordinates:
+            lon, lat = coordinates['coordinates'][:2]
+            matches = self.RoutePoint(lon, lat)
+            
+            if matches:
+                return(matches)
+            
+        #Otherwise use the place the tweet was tagged with
+        place = dataJSON.get('place')
+        
+        if place and place.get('bounding_box'):
+            corners = place['bounding_box']['coordinates'][0]
+            lons = [corner[0] for corner in corners]
+            lats = [corner[1] for corner in corners]
+            
+            return(self.RouteBBox([min(lons), min(lats), max(lons), max(lats)]))
+        
+        #Return no matches
+        return([])
+        
+    def RoutePoint(self, lon, lat):
+        '''
+        Return the WOEIDs of the regions containing a point.
+        '''
+        candidates = self.grid.get((math.floor(lon / self.cellSize), math.floor(lat / self.cellSize)), [])
+        
+        if self.large:
+            candidates = sorted(candidates + self.large)
+        
+        #Return the regions containing the point
+        return([self.locationIDs[i] for i in candidates
+                if self.bboxes[i][0] <= lon <= self.bboxes[i][2] and self.bboxes[i][1] <= lat <= self.bboxes[i][3]])
+    
+    def RouteBBox(self, bbox):
+        '''
+        Return the WOEIDs of the regions intersecting a bounding box.
+        '''
+        minLon, minLat, maxLon, maxLat = bbox
+        
+        xs, ys = self._CellRange(bbox)
+        
+        if len(xs) * len(ys) > self.MAX_QUERY_CELLS:
+            #Large boxes are cheaper to check against every region
+            candidates = range(len(self.bboxes))
+        else:
+            candidates = set(self.large)
+            
+            for x in xs:
+                for y in ys:
+                    candidates.update(self.grid.get((x, y), []))
+                    
+            candidates = sorted(candidates)
+        
+        #Return the regions intersecting the box
+        return([self.locationIDs[i] for i in candidates
+                if self.bboxes[i][0] <= maxLon and minLon <= self.bboxes[i][2]
+                and self.bboxes[i][1] <= maxLat and minLat <= self.bboxes[i][3]])
+        
+    def _CellRange(self, bbox):
+        #Return the ranges of grid columns and rows a bounding box overlaps
+        minLon, minLat, maxLon, maxLat = bbox
+        
+        xs = range(math.floor(minLon / self.cellSize), math.floor(maxLon / self.cellSize) + 1)
+        ys = range(math.floor(minLat / self.cellSize), math.floor(maxLat / self.cellSize) + 1)
+        
+        #Return the ranges
+        return(xs, ys)